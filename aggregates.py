@@ -0,0 +1,164 @@
+import itertools
+import os
+import numpy as np
+import pandas as pd
+
+
+# Materialized patient counts per Study, Seizure, Lateralization and Medication and the co-occurrence matrix of
+# every pair of them. They are kept next to the database in a local NumPy store and updated from the same rows
+# GraphParser.parse_study_rows / parse_epilepsy_rows produce for the import, so reports do not need to traverse
+# Patient -> Diagnosis. The kinds are the ones of database_api.COHORT_PATTERNS.
+
+KINDS = ['studies', 'seizures', 'lateralizations', 'medications']
+
+
+# np.savez_compressed appends .npz to a path without it, every store path goes through here so that saving,
+# loading and the existence check of load_or_create all use the same file
+def store_path(path):
+    return path if path.endswith('.npz') else path + '.npz'
+
+
+class AggregateStore:
+
+    # names maps every kind to the reference node names known up front, unknown names get a column when seen
+    def __init__(self, names=None):
+        names = names or {}
+        self.__names = {kind: list(dict.fromkeys(names.get(kind, []))) for kind in KINDS}
+        self.__columns = {kind: {name: column for column, name in enumerate(self.__names[kind])} for kind in KINDS}
+        self.__patients = {}
+        self.__free = []
+        # One boolean patient x name membership matrix per kind, all sharing the patient rows
+        self.__matrices = {kind: np.zeros((0, len(self.__names[kind])), dtype=bool) for kind in KINDS}
+        self.__counts = {kind: np.zeros(len(self.__names[kind]), dtype=np.int64) for kind in KINDS}
+        self.__pairs = {(first, second): np.zeros((len(self.__names[first]), len(self.__names[second])), dtype=np.int64)
+                        for first, second in itertools.combinations(KINDS, 2)}
+
+    @classmethod
+    def from_parser(cls, parser):
+        return cls({
+            'studies': parser.study_protocol_dict.values(),
+            'seizures': parser.seizure_types_dict.values(),
+            'lateralizations': parser.lateralization,
+            'medications': parser.medication_list,
+        })
+
+    # Replaces the memberships of kind for the given patients (by default the patients in rows) with rows
+    def replace(self, kind, rows, patient_ids=None):
+        if patient_ids is None:
+            patient_ids = [row['id'] for row in rows]
+        patient_ids = list(dict.fromkeys(list(patient_ids) + [row['id'] for row in rows]))
+        if not patient_ids:
+            return
+        self.__add_columns(kind, [row['name'] for row in rows])
+        positions = self.__rows(patient_ids)
+        new = np.zeros((len(positions), len(self.__names[kind])), dtype=bool)
+        local = {patient_id: row for row, patient_id in enumerate(patient_ids)}
+        new[[local[row['id']] for row in rows], [self.__columns[kind][row['name']] for row in rows]] = True
+        self.__apply(kind, positions, new)
+
+    def update_studies(self, study_rows, patient_ids=None):
+        self.replace('studies', study_rows, patient_ids)
+
+    def update_epilepsy(self, seizure_rows, lateralization_rows, medication_rows, patient_ids=None):
+        self.replace('seizures', seizure_rows, patient_ids)
+        self.replace('lateralizations', lateralization_rows, patient_ids)
+        self.replace('medications', medication_rows, patient_ids)
+
+    # Drops deleted patients from every aggregate
+    def remove(self, patient_ids):
+        patient_ids = [patient_id for patient_id in dict.fromkeys(patient_ids) if patient_id in self.__patients]
+        if not patient_ids:
+            return
+        positions = np.array([self.__patients[patient_id] for patient_id in patient_ids])
+        for kind in KINDS:
+            self.__apply(kind, positions, np.zeros((len(positions), len(self.__names[kind])), dtype=bool))
+        for patient_id in patient_ids:
+            self.__free.append(self.__patients.pop(patient_id))
+
+    def counts(self, kind):
+        return pd.Series(self.__counts[kind], index=self.__names[kind], name='patients')
+
+    def co_occurrence(self, first, second):
+        if KINDS.index(first) > KINDS.index(second):
+            return self.co_occurrence(second, first).T
+        return pd.DataFrame(self.__pairs[(first, second)], index=self.__names[first], columns=self.__names[second])
+
+    def patient_count(self):
+        return len(self.__patients)
+
+    # The old rows of the patients are subtracted from and the new rows added to the counts and pair matrices, so
+    # the cost of an update depends on the number of changed patients and not on the size of the store
+    def __apply(self, kind, positions, new):
+        matrix = self.__matrices[kind]
+        old = matrix[positions]
+        self.__counts[kind] += new.sum(axis=0) - old.sum(axis=0)
+        for (first, second), pairs in self.__pairs.items():
+            if kind == first:
+                other = self.__matrices[second][positions].astype(np.int64)
+                pairs += new.T.astype(np.int64) @ other - old.T.astype(np.int64) @ other
+            elif kind == second:
+                other = self.__matrices[first][positions].astype(np.int64)
+                pairs += other.T @ new.astype(np.int64) - other.T @ old.astype(np.int64)
+        matrix[positions] = new
+
+    def __rows(self, patient_ids):
+        added = [patient_id for patient_id in patient_ids if patient_id not in self.__patients]
+        for patient_id in added:
+            self.__patients[patient_id] = self.__free.pop() if self.__free else len(self.__patients) + len(self.__free)
+        size = len(self.__patients) + len(self.__free)
+        capacity = len(self.__matrices[KINDS[0]])
+        if size > capacity:
+            capacity = max(size, 2 * capacity)
+            for kind in KINDS:
+                matrix = self.__matrices[kind]
+                grown = np.zeros((capacity, matrix.shape[1]), dtype=bool)
+                grown[:len(matrix)] = matrix
+                self.__matrices[kind] = grown
+        return np.array([self.__patients[patient_id] for patient_id in patient_ids])
+
+    def __add_columns(self, kind, names):
+        added = [name for name in dict.fromkeys(names) if name not in self.__columns[kind]]
+        if not added:
+            return
+        for name in added:
+            self.__columns[kind][name] = len(self.__names[kind])
+            self.__names[kind].append(name)
+        width = len(added)
+        matrix = self.__matrices[kind]
+        self.__matrices[kind] = np.hstack([matrix, np.zeros((len(matrix), width), dtype=bool)])
+        self.__counts[kind] = np.concatenate([self.__counts[kind], np.zeros(width, dtype=np.int64)])
+        for (first, second), pairs in self.__pairs.items():
+            if kind == first:
+                self.__pairs[(first, second)] = np.vstack([pairs, np.zeros((width, pairs.shape[1]), dtype=np.int64)])
+            elif kind == second:
+                self.__pairs[(first, second)] = np.hstack([pairs, np.zeros((len(pairs), width), dtype=np.int64)])
+
+    # Only the bit-packed membership matrices are written, the counts and pair matrices are rebuilt on load
+    def save(self, path):
+        patient_ids = list(self.__patients)
+        positions = np.array([self.__patients[patient_id] for patient_id in patient_ids], dtype=np.int64)
+        arrays = {'patient_ids': np.array(patient_ids)}
+        for kind in KINDS:
+            arrays[f'{kind}_names'] = np.array(self.__names[kind], dtype=str)
+            arrays[f'{kind}_matrix'] = np.packbits(self.__matrices[kind][positions], axis=1)
+        np.savez_compressed(store_path(path), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(store_path(path)) as arrays:
+            store = cls({kind: arrays[f'{kind}_names'].tolist() for kind in KINDS})
+            patient_ids = arrays['patient_ids'].tolist()
+            if not patient_ids:
+                return store
+            positions = store.__rows(patient_ids)
+            for kind in KINDS:
+                width = len(store.__names[kind])
+                store.__apply(kind, positions, np.unpackbits(arrays[f'{kind}_matrix'], axis=1, count=width).astype(bool))
+        return store
+
+
+# Opens the store at path, or an empty one with the reference names of the parser when there is none yet
+def load_or_create(path, parser):
+    if os.path.exists(store_path(path)):
+        return AggregateStore.load(path)
+    return AggregateStore.from_parser(parser)
@@ -0,0 +1,64 @@
+import asyncio
+from neo4j import AsyncGraphDatabase
+
+
+class AsyncNeo4jConnection:
+
+    # asyncio counterpart of neo4jConnection.Neo4jConnection, every session is opened on the event loop so many
+    # queries can wait on the server at the same time over the driver's connection pool
+    def __init__(self, uri, user, pwd, **driver_config):
+        self.__uri = uri
+        self.__user = user
+        self.__pwd = pwd
+        self.__driver_config = driver_config
+        self.__driver = None
+        self.connect_db()
+
+    def connect_db(self):
+        try:
+            self.__driver = AsyncGraphDatabase.driver(self.__uri, auth=(self.__user, self.__pwd), **self.__driver_config)
+        except Exception as e:
+            print("Unable to create driver:", e)
+
+    async def close(self):
+        if self.__driver is not None:
+            await self.__driver.close()
+
+    async def run_query(self, query, parameters=None):
+        records, summary = await self.fetch_all(query, parameters)
+        return records
+
+    async def fetch_all(self, query, parameters=None):
+        records = None
+        summary = None
+        if self.__driver is not None:
+            async with self.__driver.session() as session:
+                result = await session.run(query, parameters)
+                records = [record async for record in result]
+                summary = await result.consume()
+        else:
+            print("Driver not initialized")
+        return records, summary
+
+    # Async generator, the records are pulled from the server in batches of fetch_size while it is iterated
+    async def stream(self, query, parameters=None, fetch_size=1000):
+        if self.__driver is None:
+            print("Driver not initialized")
+            return
+        async with self.__driver.session(fetch_size=fetch_size) as session:
+            result = await session.run(query, parameters)
+            async for record in result:
+                yield record
+
+
+# Awaits the coroutines with at most limit of them running at once and returns their results in input order.
+# The limit should stay below the driver's max_connection_pool_size, otherwise the extra sessions only queue
+# for a connection until connection_acquisition_timeout.
+async def gather_limited(coroutines, limit=10):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
@@ -0,0 +1,70 @@
+import asyncio
+import asyncNeo4jConnection as con
+import database_api as api
+import pandas as pd
+
+
+class AsyncDatabaseAPI:
+
+    db_connection = None
+
+    # concurrency bounds how many lookups of one bulk call are in flight at the same time
+    def __init__(self, uri, user, pwd, connection=None, concurrency=10, **driver_config):
+        if connection is None:
+            connection = con.AsyncNeo4jConnection(uri, user, pwd, **driver_config)
+        self.db_connection = connection
+        self.concurrency = concurrency
+
+    async def close(self):
+        await self.db_connection.close()
+
+    async def find_patient(self, patient_id):
+        return await self.db_connection.run_query(api.FIND_PATIENT_QUERY, {'id': patient_id})
+
+    async def find_patient_by_seizure(self, seizure):
+        return await self.db_connection.run_query(api.FIND_PATIENT_BY_SEIZURE_QUERY, {'name': seizure})
+
+    async def find_patient_by_study(self, study):
+        return await self.db_connection.run_query(api.FIND_PATIENT_BY_STUDY_QUERY, {'name': study})
+
+    async def find_patient_by_dob(self, dob):
+        return await self.db_connection.run_query(api.FIND_PATIENT_BY_DOB_QUERY,
+                                                  {'dob': str(pd.Timestamp(dob).date())})
+
+    def stream_patients_by_seizure(self, seizure, fetch_size=1000):
+        return self.db_connection.stream(api.FIND_PATIENT_BY_SEIZURE_QUERY, {'name': seizure}, fetch_size)
+
+    def stream_patients_by_study(self, study, fetch_size=1000):
+        return self.db_connection.stream(api.FIND_PATIENT_BY_STUDY_QUERY, {'name': study}, fetch_size)
+
+    # Bulk lookups, one query per key run concurrently up to self.concurrency, returned like the ones of
+    # database_api.DatabaseAPI as {key: [patient nodes]} with an empty list for keys without a match
+
+    async def __gather(self, lookup, keys, column):
+        keys = list(dict.fromkeys(keys))
+        results = await con.gather_limited([lookup(key) for key in keys], self.concurrency)
+        return {key: [record[column] for record in records or []] for key, records in zip(keys, results)}
+
+    async def find_patients(self, patient_ids):
+        return await self.__gather(self.find_patient, patient_ids, 'n')
+
+    async def find_patients_by_seizures(self, seizures):
+        return await self.__gather(self.find_patient_by_seizure, seizures, 'p')
+
+    async def find_patients_by_studies(self, studies):
+        return await self.__gather(self.find_patient_by_study, studies, 'p')
+
+
+# Example: python -c "import async_database_api as a; print(a.run_example([1, 2, 3]))"
+def run_example(patient_ids, config_path='config.ini'):
+    import main
+
+    async def lookup():
+        uri, username, password = main.read_config(config_path)
+        db = AsyncDatabaseAPI(uri, username, password, **main.read_driver_config(config_path))
+        try:
+            return await db.find_patients(patient_ids)
+        finally:
+            await db.close()
+
+    return asyncio.run(lookup())
@@ -0,0 +1,177 @@
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import resource
+import tempfile
+import timeit
+import graphParser as gp
+import main as org
+import neo4jConnection as con
+import schema
+import synthetic_data
+
+
+# Throughput benchmark of the import path of main.py. Synthetic REDCap exports of the requested sizes are
+# imported stage by stage and for every stage the rows/s, queries/s, bytes sent, peak RSS and the time spent
+# parsing vs. waiting for the database are reported. Every size runs in a fresh process so the peak RSS of one
+# size is not inherited by the next. With --dry-run nothing is sent and only the parsing side is measured.
+
+CLEAR_QUERY = "MATCH (n) CALL { WITH n DETACH DELETE n } IN TRANSACTIONS OF 10000 ROWS"
+
+
+# Size of what goes over the wire, estimated as the query text plus the JSON encoding of the parameters
+def payload_size(query, parameters):
+    return len(query.encode('utf-8')) + len(json.dumps(parameters, default=str).encode('utf-8'))
+
+
+class MeasuringConnection:
+
+    def __init__(self, connection=None):
+        self.connection = connection
+        self.reset()
+
+    def reset(self):
+        self.queries = 0
+        self.rows = 0
+        self.bytes = 0
+        self.wire_time = 0
+
+    def run_batched(self, query, rows, batch_size):
+        for start in range(0, len(rows), batch_size):
+            self.bytes += payload_size(query, {'rows': rows[start:start + batch_size]})
+            self.queries += 1
+        self.rows += len(rows)
+        if self.connection is not None:
+            start = timeit.default_timer()
+            self.connection.run_batched(query, rows, batch_size)
+            self.wire_time += timeit.default_timer() - start
+
+    def run_query_list(self, queries, transaction_size=0):
+        for query in queries:
+            if isinstance(query, tuple):
+                self.bytes += payload_size(*query)
+                self.rows += len(query[1].get('rows', [None])) if query[1] else 1
+            else:
+                self.bytes += payload_size(query, None)
+                self.rows += 1
+            self.queries += 1
+        if self.connection is not None:
+            start = timeit.default_timer()
+            self.connection.run_query_list(queries, transaction_size)
+            self.wire_time += timeit.default_timer() - start
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Every stage is (name, parse, write): parse builds the stage's queries or rows from the frames, write(db, output)
+# sends them
+def import_stages(parser, frames, mode, batch_size, transaction_size):
+    patient_df, study_df, events_df, summary_df = frames
+
+    def query_list(db, queries):
+        db.run_query_list(queries, transaction_size)
+
+    def batched(query):
+        return lambda db, rows: db.run_batched(query, rows, batch_size)
+
+    def epilepsy_links(db, rows):
+        seizure_rows, lateralization_rows, medication_rows = rows
+        db.run_batched(gp.SEIZURE_BATCH_QUERY, seizure_rows, batch_size)
+        db.run_batched(gp.LATERALIZATION_BATCH_QUERY, lateralization_rows, batch_size)
+        db.run_batched(gp.MEDICATION_BATCH_QUERY, medication_rows, batch_size)
+
+    stages = [
+        ("reference nodes",
+         lambda: parser.create_studies() + parser.create_medications() + parser.create_epilepsy_nodes(), query_list),
+    ]
+    if mode == "per-row":
+        stages += [
+            ("patients", lambda: parser.parse_patients(patient_df), query_list),
+            ("study links", lambda: parser.parse_studies(study_df), query_list),
+            ("events", lambda: parser.parse_events(events_df), query_list),
+            ("epilepsy links", lambda: parser.parse_epilepsy(summary_df), query_list),
+        ]
+    else:
+        stages += [
+            ("patients", lambda: parser.parse_patient_rows(patient_df), batched(gp.PATIENT_BATCH_QUERY)),
+            ("study links", lambda: parser.parse_study_rows(study_df), batched(gp.STUDY_BATCH_QUERY)),
+            ("events", lambda: parser.parse_event_rows(events_df), batched(parser.event_batch_query())),
+            ("epilepsy links", lambda: parser.parse_epilepsy_rows(summary_df), epilepsy_links),
+        ]
+    return stages
+
+
+def run_size(size, seed, config, dry_run, mode, batch_size, transaction_size):
+    connection = None
+    if not dry_run:
+        uri, username, password = org.read_config(config)
+        connection = con.Neo4jConnection(uri, username, password, **org.read_driver_config(config))
+        connection.run_query(CLEAR_QUERY)
+        schema.SchemaManager(connection).apply()
+    db = MeasuringConnection(connection)
+    parser = gp.GraphParser()
+    report = []
+    with tempfile.TemporaryDirectory() as path:
+        synthetic_data.write_input_files(path, size, seed)
+        start = timeit.default_timer()
+        frames = org.read_all_files(path)
+        read_time = timeit.default_timer() - start
+    report.append({"stage": "read files", "rows": size * 4, "queries": 0, "bytes": 0, "parse_time": read_time,
+                   "wire_time": 0, "peak_rss_mb": peak_rss_mb()})
+    for name, parse, write in import_stages(parser, frames, mode, batch_size, transaction_size):
+        db.reset()
+        start = timeit.default_timer()
+        output = parse()
+        parse_time = timeit.default_timer() - start
+        write(db, output)
+        report.append({"stage": name, "rows": db.rows, "queries": db.queries, "bytes": db.bytes,
+                       "parse_time": parse_time, "wire_time": db.wire_time, "peak_rss_mb": peak_rss_mb()})
+    if connection is not None:
+        connection.close()
+    return report
+
+
+def print_report(size, report):
+    print(f"\n{size} patients")
+    print(f"{'stage':<22}{'rows':>10}{'queries':>10}{'MB sent':>10}{'parse s':>10}{'wire s':>10}"
+          f"{'rows/s':>12}{'queries/s':>12}{'peak RSS MB':>13}")
+    for stage in report:
+        total = stage["parse_time"] + stage["wire_time"]
+        rows_per_second = stage["rows"] / total if total else 0
+        queries_per_second = stage["queries"] / stage["wire_time"] if stage["wire_time"] else 0
+        print(f"{stage['stage']:<22}{stage['rows']:>10}{stage['queries']:>10}{stage['bytes'] / 2 ** 20:>10.2f}"
+              f"{stage['parse_time']:>10.3f}{stage['wire_time']:>10.3f}{rows_per_second:>12.0f}"
+              f"{queries_per_second:>12.1f}{stage['peak_rss_mb']:>13.1f}")
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Throughput benchmark of the main.py import path")
+    argument_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    argument_parser.add_argument("--seed", type=int, default=0)
+    argument_parser.add_argument("--config", default="config.ini")
+    argument_parser.add_argument("--mode", choices=["batched", "per-row"], default="batched")
+    argument_parser.add_argument("--batch-size", type=int, default=1000)
+    argument_parser.add_argument("--transaction-size", type=int, default=1000)
+    argument_parser.add_argument("--dry-run", action="store_true", help="only parse, do not send anything")
+    argument_parser.add_argument("--output", help="JSON file for the results")
+    args = argument_parser.parse_args()
+
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for size in args.sizes:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            report = executor.submit(run_size, size, args.seed, args.config, args.dry_run, args.mode,
+                                     args.batch_size, args.transaction_size).result()
+        print_report(size, report)
+        results[size] = report
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import tempfile
+import timeit
+import pandas as pd
+import graphParser as gp
+import main as org
+import synthetic_data
+
+
+# Compares the vectorized GraphParser transformation with the row by row iterrows implementation it replaced.
+# Both are run on the same synthetic exports and their output is checked for equality before timing.
+
+def iterrows_patient_rows(parser, df):
+    rows = []
+    for index, row in df.iterrows():
+        if pd.isna(row['record_id']) or not row['record_id']:
+            continue
+        properties = {}
+        for key, value in row.items():
+            if key in parser.patient_property_dict and not pd.isna(value):
+                if key == "record_id":
+                    properties[parser.patient_property_dict.get(key)] = int(value)
+                elif isinstance(value, pd.Timestamp):
+                    properties[parser.patient_property_dict.get(key)] = value.date()
+                else:
+                    properties[parser.patient_property_dict.get(key)] = str(value)
+        rows.append({'id': int(row['record_id']), 'properties': properties})
+    return rows
+
+
+def iterrows_event_rows(parser, df):
+    dates_df = df.drop(['record_id', 'T3_subject_id', 'T7_subject_id', 'Surgical_intervention'], axis=1)
+    rows = []
+    for index, row in dates_df.iterrows():
+        if pd.isna(df.loc[index].at["record_id"]):
+            continue
+        row = row.dropna().sort_values(kind='mergesort')
+        if not row.empty:
+            events = []
+            for event, date in row.items():
+                event_name = event.removesuffix('_date').replace("_", " ")
+                events.append({'name': event_name, 'date': date.date()})
+            rows.append({'id': int(df.loc[index].at["record_id"]), 'events': events})
+    return rows
+
+
+def iterrows_study_rows(parser, df):
+    rows = []
+    for index, row in df.iterrows():
+        if pd.isna(row['record_id']):
+            continue
+        for key, value in parser.study_protocol_dict.items():
+            if key in row and row[key] == "Checked":
+                rows.append({'id': int(row['record_id']), 'name': value})
+    return rows
+
+
+def iterrows_epilepsy_rows(parser, df):
+    seizures = []
+    lateralizations = []
+    medications = []
+    for index, row in df.iterrows():
+        if pd.isna(row['record_id']):
+            continue
+        patient = int(row['record_id'])
+        for key, value in parser.seizure_types_dict.items():
+            if key in row and row[key] == 1:
+                seizures.append({'id': patient, 'name': value})
+        if not pd.isna(row['emu_seizure_lateralization_pecclinical']):
+            lateralization = gp.normalized_term(str(row['emu_seizure_lateralization_pecclinical']))
+            if lateralization in parser.vocabulary_lookup['lateralization']:
+                lateralizations.append({'id': patient, 'name': parser.vocabulary_lookup['lateralization'][lateralization]})
+        if not pd.isna(row['medication']):
+            for medication in [gp.normalized_term(x) for x in row['medication'].split(',')]:
+                if medication in parser.vocabulary_lookup['medication']:
+                    medications.append({'id': patient, 'name': parser.vocabulary_lookup['medication'][medication]})
+    return seizures, lateralizations, medications
+
+
+def stages(parser, patient_df, study_df, events_df, summary_df):
+    return [
+        ("patients", patient_df, iterrows_patient_rows, parser.parse_patient_rows),
+        ("studies", study_df, iterrows_study_rows, parser.parse_study_rows),
+        ("events", events_df, iterrows_event_rows, parser.parse_event_rows),
+        ("epilepsy", summary_df, iterrows_epilepsy_rows, parser.parse_epilepsy_rows),
+    ]
+
+
+def measure(function, *args):
+    start = timeit.default_timer()
+    output = function(*args)
+    end = timeit.default_timer()
+    return output, end - start
+
+
+def run(sizes, reference_limit, seed):
+    parser = gp.GraphParser()
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as path:
+            synthetic_data.write_input_files(path, size, seed)
+            frames = org.read_all_files(path)
+        for name, df, reference, vectorized in stages(parser, *frames):
+            rows, vectorized_time = measure(vectorized, df)
+            if size <= reference_limit:
+                expected, reference_time = measure(reference, parser, df)
+                if rows != expected:
+                    raise AssertionError(f"Vectorized {name} output differs from the iterrows output at {size} rows")
+                print(f"{size:>8} rows {name:<9} iterrows {reference_time:8.3f}s  "
+                      f"vectorized {vectorized_time:8.3f}s  speedup {reference_time / vectorized_time:6.1f}x")
+            else:
+                print(f"{size:>8} rows {name:<9} iterrows  skipped  vectorized {vectorized_time:8.3f}s")
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Micro-benchmark of the GraphParser transformation stage")
+    argument_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    argument_parser.add_argument("--reference-limit", type=int, default=100000,
+                                 help="largest size for which the slow iterrows implementation is also run")
+    argument_parser.add_argument("--seed", type=int, default=0)
+    args = argument_parser.parse_args()
+    run(args.sizes, args.reference_limit, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+import os
+import random
+import neo4jConnection as con
+import database_api
+import graphParser as gp
+import main as org
+
+
+# Counts how many distinct query texts a typical workload sends to the server. Neo4j caches one plan per
+# query text, so every distinct text is a plan compilation. No database is needed, the queries are only recorded.
+
+class RecordingConnection(con.Neo4jConnection):
+
+    def __init__(self):
+        self.queries = []
+        super().__init__(None, None, None)
+
+    def connect_db(self):
+        pass
+
+    def run_query(self, query, parameters=None):
+        self.queries.append(query)
+
+    def run_query_list(self, queries, transaction_size=0):
+        for query in queries:
+            self.queries.append(query[0] if isinstance(query, tuple) else query)
+
+    def run_batched(self, query, rows, batch_size):
+        batches = (len(rows) + batch_size - 1) // batch_size
+        self.queries.extend([query] * batches)
+        return batches
+
+
+def create_lookup_workload(lookups, patient_ids, seed=0):
+    rnd = random.Random(seed)
+    parser = gp.GraphParser()
+    seizures = list(parser.seizure_types_dict.values())
+    studies = list(parser.study_protocol_dict.values())
+    workload = []
+    for i in range(lookups):
+        kind = rnd.choice(["id", "seizure", "study", "dob"])
+        if kind == "id":
+            workload.append((kind, rnd.choice(patient_ids)))
+        elif kind == "seizure":
+            workload.append((kind, rnd.choice(seizures)))
+        elif kind == "study":
+            workload.append((kind, rnd.choice(studies)))
+        else:
+            workload.append((kind, f"{rnd.randint(1950, 2000)}-{rnd.randint(1, 12):02d}-{rnd.randint(1, 28):02d}"))
+    return workload
+
+
+# Query texts as the DatabaseAPI built them before it used parameters
+def interpolated_queries(workload):
+    queries = []
+    for kind, value in workload:
+        if kind == "id":
+            queries.append(f"MATCH (n:Patient) WHERE n.id={value} RETURN n")
+        elif kind == "seizure":
+            queries.append(f"MATCH (p:Patient)-[experiences]->(s:Seizure) WHERE s.name=\"{value}\" RETURN p")
+        elif kind == "study":
+            queries.append(f"MATCH (p:Patient)-[consents]->(s:Study) WHERE s.name=\"{value}\" RETURN p")
+        else:
+            queries.append(f"MATCH (p:Patient) WHERE p.\"date_of_birth\"=\"{value}\" RETURN p")
+    return queries
+
+
+def parameterized_queries(workload):
+    recorder = RecordingConnection()
+    api = database_api.DatabaseAPI(None, None, None, connection=recorder)
+    for kind, value in workload:
+        if kind == "id":
+            api.find_patient(value)
+        elif kind == "seizure":
+            api.find_patient_by_seizure(value)
+        elif kind == "study":
+            api.find_patient_by_study(value)
+        else:
+            api.find_patient_by_dob(value)
+    return recorder.queries
+
+
+def import_queries(path, batch_size):
+    parser = gp.GraphParser()
+    patient_df, study_df, events_df, summary_df = org.read_all_files(path)
+    recorder = RecordingConnection()
+    recorder.run_query_list(parser.parse_patients(patient_df))
+    recorder.run_query_list(parser.parse_studies(study_df))
+    recorder.run_query_list(parser.parse_events(events_df))
+    recorder.run_query_list(parser.parse_epilepsy(summary_df))
+    per_row = recorder.queries
+    recorder = RecordingConnection()
+    org.load_batched(recorder, parser, patient_df, study_df, events_df, summary_df, batch_size)
+    return per_row, recorder.queries
+
+
+def print_counts(label, queries):
+    print(f"{label}: {len(queries)} queries, {len(set(queries))} distinct query texts")
+
+
+def main():
+    patient_ids = list(range(1000, 11000))
+    workload = create_lookup_workload(10000, patient_ids)
+    print_counts("Lookups with interpolated values", interpolated_queries(workload))
+    print_counts("Lookups with parameters", parameterized_queries(workload))
+
+    per_row, batched = import_queries(os.path.join(os.getcwd(), "input"), 1000)
+    print_counts("Per-row import", per_row)
+    print_counts("Batched import", batched)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import tempfile
+import timeit
+import numpy as np
+import graphParser as gp
+import main as org
+import similarity
+import synthetic_data
+
+
+# Latency of the top-k similar patient search of similarity.FeatureMatrix on synthetic exports, for single
+# patients and for batches. The single and batched results of a few patients, over all features and over subsets
+# of the kinds, are checked against a brute force set comparison before timing.
+
+CHECK_KINDS = [None, ['seizures', 'medications'], ['events']]
+
+
+def brute_force(matrix, patient_ids, patient_id, k, metric, kinds=None):
+    features = {other: {feature for feature in matrix.patient_features(other) if kinds is None or feature[0] in kinds}
+                for other in patient_ids}
+    target = features[patient_id]
+    scores = []
+    for other, other_features in features.items():
+        shared = len(target & other_features)
+        if other == patient_id or not shared:
+            continue
+        if metric == 'jaccard':
+            scores.append((other, shared / len(target | other_features)))
+        else:
+            scores.append((other, shared / np.sqrt(len(target) * len(other_features))))
+    return sorted(scores, key=lambda entry: (-entry[1], entry[0]))[:k]
+
+
+def same_result(found, expected):
+    return [other for other, score in found] == [other for other, score in expected] and \
+        np.allclose([score for other, score in found], [score for other, score in expected])
+
+
+def check(matrix, patient_ids, queries, k):
+    for metric in similarity.METRICS:
+        for kinds in CHECK_KINDS:
+            batched = matrix.top_k_many(queries, k, metric, kinds)
+            for patient_id in queries:
+                expected = brute_force(matrix, patient_ids, patient_id, k, metric, kinds)
+                if not same_result(matrix.top_k(patient_id, k, metric, kinds), expected):
+                    raise AssertionError(f"{metric} top {k} of patient {patient_id} over {kinds or 'all kinds'} "
+                                         f"differs from the brute force result")
+                if not same_result(batched[patient_id], expected):
+                    raise AssertionError(f"batched {metric} top {k} of patient {patient_id} over "
+                                         f"{kinds or 'all kinds'} differs from the brute force result")
+
+
+def run(sizes, k, queries, batch_size, check_limit, seed):
+    parser = gp.GraphParser()
+    rnd = np.random.default_rng(seed)
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as path:
+            synthetic_data.write_input_files(path, size, seed)
+            patient_df, study_df, events_df, summary_df = org.read_all_files(path)
+        start = timeit.default_timer()
+        matrix = similarity.build(parser, study_df, events_df, summary_df)
+        build_time = timeit.default_timer() - start
+        patient_ids = summary_df['record_id'].dropna().astype('int64').unique().tolist()
+        sample = rnd.choice(patient_ids, queries).tolist()
+        if size <= check_limit:
+            check(matrix, patient_ids, sample[:5], k)
+        print(f"{size:>8} patients {len(matrix.features()):>4} features  build {build_time:8.3f}s")
+        for metric in similarity.METRICS:
+            start = timeit.default_timer()
+            for patient_id in sample:
+                matrix.top_k(patient_id, k, metric)
+            single = (timeit.default_timer() - start) / len(sample)
+            batches = [sample[offset:offset + batch_size] for offset in range(0, len(sample), batch_size)]
+            start = timeit.default_timer()
+            for batch in batches:
+                matrix.top_k_many(batch, k, metric)
+            batched = (timeit.default_timer() - start) / len(sample)
+            print(f"{size:>8} patients {metric:<8} top {k}  single {single * 1000:8.3f}ms  "
+                  f"batched ({batch_size}) {batched * 1000:8.3f}ms per patient")
+
+
+def main():
+    argument_parser = argparse.ArgumentParser(description="Latency of the top-k similar patient search")
+    argument_parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    argument_parser.add_argument("--k", type=int, default=10)
+    argument_parser.add_argument("--queries", type=int, default=200)
+    argument_parser.add_argument("--batch-size", type=int, default=100)
+    argument_parser.add_argument("--check-limit", type=int, default=10000,
+                                 help="largest size for which results are checked against a brute force search")
+    argument_parser.add_argument("--seed", type=int, default=0)
+    args = argument_parser.parse_args()
+    run(args.sizes, args.k, args.queries, args.batch_size, args.check_limit, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+import csv
+import os
+import graphParser as gp
+import main as org
+
+
+# Offline bulk load export. Writes node and relationship CSV files with neo4j-admin headers from the same
+# parser output the online import sends to the database, for first-time loads with
+# `neo4j-admin database import full`. The input is read in chunks and written row by row, only the patient ids
+# are kept in memory to skip duplicates and links to patients that do not exist (which the online MATCH skips).
+
+DIAGNOSIS_NAME = "Summary Clinical History"
+DATE_PROPERTIES = ["date_of_birth", "date_of_death"]
+
+NODE_FILES = {
+    "Patient": "patients.csv",
+    "Diagnosis": "diagnoses.csv",
+    "Event": "events.csv",
+    "Study": "studies.csv",
+    "Seizure": "seizures.csv",
+    "Lateralization": "lateralizations.csv",
+    "Medication": "medications.csv",
+}
+RELATIONSHIP_FILES = {
+    "diagnosed": ["diagnosed.csv"],
+    "next": ["next_patient.csv", "next_event.csv"],
+    "last": ["last.csv"],
+    "consents": ["consents.csv"],
+    "experiences": ["experiences.csv"],
+    "localized": ["localized.csv"],
+    "takes": ["takes.csv"],
+}
+
+
+class CsvFiles:
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.writers = {}
+
+    def writer(self, filename, header):
+        if filename not in self.writers:
+            self.files[filename] = open(os.path.join(self.path, filename), 'w', newline='', encoding='utf-8')
+            self.writers[filename] = csv.writer(self.files[filename])
+            self.writers[filename].writerow(header)
+        return self.writers[filename]
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+
+
+def patient_properties(parser):
+    names = []
+    for name in parser.patient_property_dict.values():
+        if name != "id" and name not in names:
+            names.append(name)
+    return names
+
+
+def write_reference_nodes(files, parser):
+    references = [
+        ("Study", parser.study_protocol_dict.values()),
+        ("Seizure", parser.seizure_types_dict.values()),
+        ("Lateralization", parser.lateralization),
+        ("Medication", parser.medication_list),
+    ]
+    for label, names in references:
+        writer = files.writer(NODE_FILES[label], [f"name:ID({label})", ":LABEL"])
+        for name in dict.fromkeys(names):
+            writer.writerow([name, label])
+
+
+def write_patients(files, parser, filename, chunk_size):
+    properties = patient_properties(parser)
+    header = [":ID(Patient)", "id:long", ":LABEL"]
+    header += [f"{name}:date" if name in DATE_PROPERTIES else name for name in properties]
+    patients = files.writer(NODE_FILES["Patient"], header)
+    diagnoses = files.writer(NODE_FILES["Diagnosis"], [":ID(Diagnosis)", "name", ":LABEL"])
+    diagnosed = files.writer("diagnosed.csv", [":START_ID(Patient)", ":END_ID(Diagnosis)", ":TYPE"])
+    patient_ids = set()
+    for chunk in org.read_patient_chunks(filename, parser, chunk_size):
+        for row in parser.parse_patient_rows(chunk):
+            if row['id'] in patient_ids:
+                continue
+            patient_ids.add(row['id'])
+            values = [row['properties'].get(name) for name in properties]
+            patients.writerow([row['id'], row['id'], "Patient"] + ["" if value is None else value for value in values])
+            diagnoses.writerow([row['id'], DIAGNOSIS_NAME, "Diagnosis"])
+            diagnosed.writerow([row['id'], row['id'], "diagnosed"])
+    return patient_ids
+
+
+def write_events(files, parser, filename, chunk_size, patient_ids):
+    events = files.writer(NODE_FILES["Event"], [":ID(Event)", "name", "date:date", ":LABEL"])
+    next_patient = files.writer("next_patient.csv", [":START_ID(Patient)", ":END_ID(Event)", ":TYPE"])
+    next_event = files.writer("next_event.csv", [":START_ID(Event)", ":END_ID(Event)", ":TYPE"])
+    last = files.writer("last.csv", [":START_ID(Patient)", ":END_ID(Event)", ":TYPE"])
+    event_id = 0
+    for chunk in org.read_event_chunks(filename, parser, chunk_size):
+        for row in parser.parse_event_rows(chunk):
+            if row['id'] not in patient_ids:
+                continue
+            chain = []
+            for event in row['events']:
+                event_id += 1
+                events.writerow([event_id, event['name'], event['date'], "Event"])
+                if not chain:
+                    next_patient.writerow([row['id'], event_id, "next"])
+                else:
+                    next_event.writerow([chain[-1], event_id, "next"])
+                chain.append(event_id)
+            last.writerow([row['id'], chain[-1], "last"])
+            write_timeline_links(files, parser, row, chain)
+
+
+# Skip pointers and express links of the configured skip list, the same ones GraphParser.event_batch_query creates
+def write_timeline_links(files, parser, row, chain):
+    if parser.express_step > 1:
+        for level in range(1, parser.express_levels + 1):
+            step = parser.express_step ** level
+            relationship = gp.express_relationship(level)
+            writer = files.writer(f"{relationship}.csv", [":START_ID(Event)", ":END_ID(Event)", ":TYPE"])
+            for i in range(0, len(chain) - step, step):
+                writer.writerow([chain[i], chain[i + step], relationship])
+    for name in parser.skip_list_events:
+        relationship = gp.skip_relationship(name)
+        from_patient = files.writer(f"{relationship}_patient.csv", [":START_ID(Patient)", ":END_ID(Event)", ":TYPE"])
+        from_event = files.writer(f"{relationship}_event.csv", [":START_ID(Event)", ":END_ID(Event)", ":TYPE"])
+        previous = None
+        for event, current in zip(row['events'], chain):
+            if event['name'] == name:
+                if previous is None:
+                    from_patient.writerow([row['id'], current, relationship])
+                else:
+                    from_event.writerow([previous, current, relationship])
+                previous = current
+
+
+def write_links(files, filename, start_space, end_space, relationship, rows, patient_ids, names, written):
+    writer = files.writer(filename, [f":START_ID({start_space})", f":END_ID({end_space})", ":TYPE"])
+    for row in rows:
+        # MERGE in the online import creates every link only once
+        if row['id'] in patient_ids and row['name'] in names and (row['id'], row['name']) not in written:
+            written.add((row['id'], row['name']))
+            writer.writerow([row['id'], row['name'], relationship])
+
+
+def write_study_links(files, parser, filename, chunk_size, patient_ids):
+    names = set(parser.study_protocol_dict.values())
+    written = set()
+    for chunk in org.read_study_chunks(filename, parser, chunk_size):
+        write_links(files, "consents.csv", "Patient", "Study", "consents", parser.parse_study_rows(chunk),
+                    patient_ids, names, written)
+
+
+def write_epilepsy_links(files, parser, filename, chunk_size, patient_ids):
+    targets = [
+        ("experiences.csv", "Seizure", "experiences", set(parser.seizure_types_dict.values()), set()),
+        ("localized.csv", "Lateralization", "localized", set(parser.lateralization), set()),
+        ("takes.csv", "Medication", "takes", set(parser.medication_list), set()),
+    ]
+    for chunk in org.read_summary_chunks(filename, parser, chunk_size):
+        for rows, (target_file, label, relationship, names, written) in zip(parser.parse_epilepsy_rows(chunk), targets):
+            write_links(files, target_file, "Diagnosis", label, relationship, rows, patient_ids, names, written)
+
+
+# filenames are the files written by this export, files left in path by an earlier export with other settings
+# (e.g. other skip list events) are not part of the import
+def import_command(path, filenames, database="neo4j"):
+    command = ["neo4j-admin", "database", "import", "full", database]
+    for label, filename in NODE_FILES.items():
+        if filename in filenames:
+            command.append(f"--nodes={label}={os.path.join(path, filename)}")
+    # Every other written file holds relationships, including the skip list files whose names depend on the settings
+    for filename in sorted(filenames):
+        if filename not in NODE_FILES.values():
+            command.append(f"--relationships={os.path.join(path, filename)}")
+    return command
+
+
+def export(parser, input_path, export_path, chunk_size=10000):
+    os.makedirs(export_path, exist_ok=True)
+    files = CsvFiles(export_path)
+    try:
+        write_reference_nodes(files, parser)
+        patient_ids = write_patients(files, parser, os.path.join(input_path, "patient.csv"), chunk_size)
+        write_events(files, parser, os.path.join(input_path, "events.csv"), chunk_size, patient_ids)
+        write_study_links(files, parser, os.path.join(input_path, "protocols.csv"), chunk_size, patient_ids)
+        write_epilepsy_links(files, parser, os.path.join(input_path, "summary.csv"), chunk_size, patient_ids)
+    finally:
+        files.close()
+    return import_command(export_path, list(files.files))
+
+
+# The two functions below describe a graph as plain Python sets and dictionaries: the patient properties by id,
+# the ordered (name, date) events of every patient and the set of (type, patient id, name) links. online_graph
+# applies the semantics of the online import to the parser rows, read_export reads the exported CSV files back,
+# so a local check can compare both without a database.
+
+def online_graph(parser, patient_df, study_df, events_df, summary_df):
+    patients = {}
+    for row in parser.parse_patient_rows(patient_df):
+        properties = patients.setdefault(row['id'], {})
+        properties.update({key: str(value) for key, value in row['properties'].items() if key != "id"})
+    events = {}
+    for row in parser.parse_event_rows(events_df):
+        if row['id'] in patients:
+            events.setdefault(row['id'], []).extend((event['name'], str(event['date'])) for event in row['events'])
+    links = set()
+    targets = [
+        ("consents", parser.parse_study_rows(study_df), set(parser.study_protocol_dict.values())),
+    ]
+    targets += list(zip(["experiences", "localized", "takes"], parser.parse_epilepsy_rows(summary_df),
+                        [set(parser.seizure_types_dict.values()), set(parser.lateralization),
+                         set(parser.medication_list)]))
+    for relationship, rows, names in targets:
+        links.update((relationship, row['id'], row['name']) for row in rows
+                     if row['id'] in patients and row['name'] in names)
+    return patients, events, links
+
+
+def read_export(path):
+    def read(filename):
+        if not os.path.exists(os.path.join(path, filename)):
+            return [], []
+        with open(os.path.join(path, filename), newline='', encoding='utf-8') as infile:
+            reader = csv.reader(infile)
+            header = [column.split(':')[0] for column in next(reader)]
+            return header, list(reader)
+
+    patients = {}
+    header, rows = read(NODE_FILES["Patient"])
+    for row in rows:
+        patients[int(row[1])] = {key: value for key, value in zip(header[3:], row[3:]) if value}
+    event_nodes = {row[0]: (row[1], row[2]) for row in read(NODE_FILES["Event"])[1]}
+    following = {row[0]: row[1] for row in read("next_event.csv")[1]}
+    events = {}
+    for start, current, relationship in read("next_patient.csv")[1]:
+        chain = events.setdefault(int(start), [])
+        while current is not None:
+            chain.append(event_nodes[current])
+            current = following.get(current)
+    links = set()
+    for relationship in ["consents", "experiences", "localized", "takes"]:
+        for start, end, relationship_type in read(RELATIONSHIP_FILES[relationship][0])[1]:
+            links.add((relationship_type, int(start), end))
+    return patients, events, links
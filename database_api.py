@@ -1,59 +1,303 @@
 import neo4jConnection as con
+import graphParser as gp
 import pandas as pd
 import configparser
+import schema
+
+
+FIND_PATIENT_QUERY = "MATCH (n:Patient) WHERE n.id = $id RETURN n"
+FIND_PATIENT_BY_SEIZURE_QUERY = (
+    "MATCH (p:Patient)-[:diagnosed]->(:Diagnosis)-[:experiences]->(s:Seizure) WHERE s.name = $name RETURN p"
+)
+FIND_PATIENT_BY_STUDY_QUERY = "MATCH (p:Patient)-[:consents]->(s:Study) WHERE s.name = $name RETURN p"
+FIND_PATIENT_BY_DOB_QUERY = "MATCH (p:Patient) WHERE p.date_of_birth = date($dob) RETURN p"
+
+FIND_PATIENTS_QUERY = "UNWIND $ids AS id MATCH (p:Patient {id: id}) RETURN id AS key, collect(p) AS patients"
+FIND_PATIENTS_BY_SEIZURES_QUERY = (
+    "MATCH (p:Patient)-[:diagnosed]->(:Diagnosis)-[:experiences]->(s:Seizure) WHERE s.name IN $names "
+    "RETURN s.name AS key, collect(p) AS patients"
+)
+FIND_PATIENTS_BY_STUDIES_QUERY = (
+    "MATCH (p:Patient)-[:consents]->(s:Study) WHERE s.name IN $names RETURN s.name AS key, collect(p) AS patients"
+)
+
+# Date range lookups, served by the Event.date and (Event.name, Event.date) range indexes of schema.INDEXES so
+# they only touch the matching events; the patient is reached backwards over the next chain of each of them
+FIND_EVENTS_BETWEEN_QUERY = (
+    "MATCH (e:Event) WHERE e.date >= date($start) AND e.date <= date($end) "
+    "WITH e MATCH (e)<-[:next*]-(p:Patient) RETURN p.id AS id, e ORDER BY e.date"
+)
+FIND_NAMED_EVENTS_BETWEEN_QUERY = (
+    "MATCH (e:Event) WHERE e.name = $name AND e.date >= date($start) AND e.date <= date($end) "
+    "WITH e MATCH (e)<-[:next*]-(p:Patient) RETURN p.id AS id, e ORDER BY e.date"
+)
+FIND_PATIENT_EVENTS_BETWEEN_QUERY = (
+    "MATCH (p:Patient {id: $id})-[:next*]->(e:Event) WHERE e.date >= date($start) AND e.date <= date($end) "
+    "RETURN e ORDER BY e.date"
+)
+FIND_EVENT_GAPS_QUERY = (
+    "MATCH (b:Event {name: $second}) "
+    "WITH b MATCH (b)<-[:next*]-(p:Patient) "
+    "MATCH (p)-[:next*]->(a:Event {name: $first}) "
+    "WITH p, a, b, duration.inDays(a.date, b.date).days AS gap "
+    "WHERE gap >= $min_days AND ($max_days IS NULL OR gap <= $max_days) "
+    "RETURN p.id AS id, a.date AS first, b.date AS second, gap ORDER BY id, first, second"
+)
+
+# Pattern from a patient p to the reference node x of every cohort filter, see DatabaseAPI.find_cohort
+COHORT_PATTERNS = {
+    'studies': "(p)-[:consents]->(x:Study)",
+    'seizures': "(p)-[:diagnosed]->(:Diagnosis)-[:experiences]->(x:Seizure)",
+    'lateralizations': "(p)-[:diagnosed]->(:Diagnosis)-[:localized]->(x:Lateralization)",
+    'medications': "(p)-[:diagnosed]->(:Diagnosis)-[:takes]->(x:Medication)",
+}
+
+# Features compared by DatabaseAPI.similar_patients, the cohort filters and the types of the patient's events
+FEATURE_PATTERNS = dict(COHORT_PATTERNS, events="(p)-[:next*]->(x:Event)")
+METRIC_SCORES = {
+    'jaccard': "toFloat(shared) / (size + target_size - shared)",
+    'cosine': "shared / sqrt(size * target_size)",
+}
+
+
+# Distinct 'kind:name' features of the patient bound to variable, as a list expression
+def features_expression(variable, kinds):
+    lists = " + ".join(f"[{FEATURE_PATTERNS[kind].replace('(p)', f'({variable})')} | '{kind}:' + x.name]"
+                       for kind in kinds)
+    return f"reduce(seen = [], feature IN {lists} | CASE WHEN feature IN seen THEN seen ELSE seen + feature END)"
+
+
+# Top-k similar patients of every patient in $ids, comparing each of them with every other patient
+def similar_patients_query(kinds, metric):
+    return (
+        "UNWIND $ids AS target_id "
+        "MATCH (q:Patient {id: target_id}) "
+        f"WITH target_id, q, {features_expression('q', kinds)} AS target "
+        "MATCH (p:Patient) WHERE p <> q "
+        f"WITH target_id, p, target, {features_expression('p', kinds)} AS features "
+        "WITH target_id, p.id AS id, size(target) AS target_size, size(features) AS size, "
+        "size([feature IN features WHERE feature IN target]) AS shared "
+        "WHERE shared > 0 "
+        f"WITH target_id, id, {METRIC_SCORES[metric]} AS score ORDER BY score DESC, id "
+        "RETURN target_id, collect([id, score])[..$k] AS similar"
+    )
 
 
 class DatabaseAPI:
 
     db_connection = None
 
-    def __init__(self, uri, user, pwd):
+    # With a query_cache.QueryCache as cache the find_* lookups are served from memory while their entry is valid,
+    # with an aggregates.AggregateStore as aggregates the report counts are served without a query and with a
+    # similarity.FeatureMatrix as features the similar patient searches as well
+    def __init__(self, uri, user, pwd, connection=None, cache=None, aggregates=None, features=None):
         self.__uri = uri
         self.__user = user
         self.__pwd = pwd
-        self.db_connection = con.Neo4jConnection(self.__uri, self.__user, self.__pwd)
+        if connection is None:
+            connection = con.Neo4jConnection(self.__uri, self.__user, self.__pwd)
+        self.db_connection = connection
+        self.cache = cache
+        self.aggregates = aggregates
+        self.features = features
+
+    def __read(self, query, parameters=None):
+        if self.cache is None:
+            return self.db_connection.run_query(query, parameters)
+        return self.cache.get(query, parameters, lambda: self.db_connection.run_query(query, parameters))
+
+    # Called after writes that bypass create_patient, e.g. an import, with the ids of the changed patients
+    def invalidate(self, patient_ids=None):
+        if self.cache is not None:
+            self.cache.invalidate_patients(patient_ids)
+
+    def cache_stats(self):
+        return None if self.cache is None else self.cache.stats()
 
     def find_patient(self, patient_id):
-        query = f"MATCH (n:Patient) WHERE n.id={patient_id} RETURN n"
-        return self.db_connection.run_query(query)
+        query = FIND_PATIENT_QUERY
+        return self.__read(query, {'id': patient_id})
 
     def find_patient_by_seizure(self, seizure):
-        query = f"MATCH (p:Patient)-[experiences]->(s:Seizure) WHERE s.name=\"{seizure}\" RETURN p"
-        return self.db_connection.run_query(query)
+        query = FIND_PATIENT_BY_SEIZURE_QUERY
+        return self.__read(query, {'name': seizure})
 
     def find_patient_by_study(self, study):
-        query = f"MATCH (p:Patient)-[consents]->(s:Study) WHERE s.name=\"{study}\" RETURN p"
-        return self.db_connection.run_query(query)
+        query = FIND_PATIENT_BY_STUDY_QUERY
+        return self.__read(query, {'name': study})
+
+    def stream_patients_by_seizure(self, seizure, fetch_size=1000):
+        query = FIND_PATIENT_BY_SEIZURE_QUERY
+        return self.db_connection.stream(query, {'name': seizure}, fetch_size)
+
+    def stream_patients_by_study(self, study, fetch_size=1000):
+        query = FIND_PATIENT_BY_STUDY_QUERY
+        return self.db_connection.stream(query, {'name': study}, fetch_size)
+
+    # Bulk lookups, one query for all keys, returned as {key: [patient nodes]} with an empty list for keys
+    # without a match
+
+    def find_patients(self, patient_ids):
+        return self.__grouped(FIND_PATIENTS_QUERY, 'ids', patient_ids)
+
+    def find_patients_by_seizures(self, seizures):
+        return self.__grouped(FIND_PATIENTS_BY_SEIZURES_QUERY, 'names', seizures)
+
+    def find_patients_by_studies(self, studies):
+        return self.__grouped(FIND_PATIENTS_BY_STUDIES_QUERY, 'names', studies)
+
+    def __grouped(self, query, parameter, keys):
+        keys = list(dict.fromkeys(keys))
+        grouped = {key: [] for key in keys}
+        for record in self.__read(query, {parameter: keys}) or []:
+            grouped[record['key']] = record['patients']
+        return grouped
+
+    # Patients linked to every name in all_of, at least one name of each list in any_of and none of the names
+    # in none_of, each a dict keyed like COHORT_PATTERNS, e.g. consents to Study A and experiences Seizure B
+    # but does not take Medication C:
+    #   find_cohort(all_of={'studies': ['A'], 'seizures': ['B']}, none_of={'medications': ['C']})
+    # The set operations run as one query, the query text only depends on which filters are given.
+    def find_cohort(self, all_of=None, any_of=None, none_of=None):
+        conditions = []
+        parameters = {}
+        anchor = None
+        for operation, filters in (('all', all_of), ('any', any_of), ('none', none_of)):
+            for kind, names in (filters or {}).items():
+                if kind not in COHORT_PATTERNS:
+                    raise ValueError(f"Unknown cohort filter {kind}, expected one of {list(COHORT_PATTERNS)}")
+                name = f"{operation}_{kind}"
+                parameters[name] = list(dict.fromkeys(names))
+                # An empty all_of list matches every patient, so it can not be the anchor
+                if anchor is None and operation != 'none' and parameters[name]:
+                    anchor = f"MATCH {COHORT_PATTERNS[kind]} WHERE x.name IN ${name} WITH DISTINCT p "
+                matches = f"size([{COHORT_PATTERNS[kind]} WHERE x.name IN ${name} | x.name])"
+                if operation == 'all':
+                    conditions.append(f"{matches} = size(${name})")
+                elif operation == 'any':
+                    conditions.append(f"{matches} > 0")
+                else:
+                    conditions.append(f"{matches} = 0")
+        # Starting from the name index of a positive filter avoids scanning every patient
+        query = anchor or "MATCH (p:Patient) "
+        if conditions:
+            query += "WHERE " + " AND ".join(conditions) + " "
+        query += "RETURN p"
+        return self.__read(query, parameters)
+
+    # Number of patients per name of kind (a COHORT_PATTERNS key) as a Series
+    def patient_counts(self, kind):
+        if self.aggregates is not None:
+            return self.aggregates.counts(kind)
+        query = f"MATCH {COHORT_PATTERNS[kind]} RETURN x.name AS name, count(DISTINCT p) AS patients"
+        records = self.__read(query) or []
+        return pd.Series({record['name']: record['patients'] for record in records}, name='patients', dtype='int64')
+
+    # Number of patients per pair of names as a DataFrame, e.g. co_occurrence('seizures', 'medications')
+    def co_occurrence(self, first, second):
+        if self.aggregates is not None:
+            return self.aggregates.co_occurrence(first, second)
+        query = (f"MATCH {COHORT_PATTERNS[first]} WITH p, x.name AS first "
+                 f"MATCH {COHORT_PATTERNS[second]} "
+                 "RETURN first, x.name AS second, count(DISTINCT p) AS patients")
+        records = self.__read(query) or []
+        frame = pd.DataFrame([dict(record) for record in records], columns=['first', 'second', 'patients'])
+        return frame.pivot(index='first', columns='second', values='patients').fillna(0).astype('int64')
+
+    # The k patients most similar to patient_id as [(patient id, score)], best first, by the jaccard or cosine
+    # similarity of their studies, seizures, lateralizations, medications and event types (kinds restricts them
+    # to some of the FEATURE_PATTERNS keys)
+    def similar_patients(self, patient_id, k=10, metric='jaccard', kinds=None):
+        return self.similar_patients_many([patient_id], k, metric, kinds)[patient_id]
+
+    # similar_patients of many patients in one search, as {patient id: [(patient id, score)]}
+    def similar_patients_many(self, patient_ids, k=10, metric='jaccard', kinds=None):
+        if metric not in METRIC_SCORES:
+            raise ValueError(f"Unknown metric {metric}, expected one of {', '.join(METRIC_SCORES)}")
+        if self.features is not None:
+            return self.features.top_k_many(patient_ids, k, metric, kinds)
+        patient_ids = list(dict.fromkeys(patient_ids))
+        query = similar_patients_query(kinds or list(FEATURE_PATTERNS), metric)
+        records = self.__read(query, {'ids': patient_ids, 'k': k}) or []
+        similar = {patient_id: [] for patient_id in patient_ids}
+        for record in records:
+            similar[record['target_id']] = [(other, score) for other, score in record['similar']]
+        return similar
 
     def find_patient_by_dob(self, dob):
-        query = f"MATCH (p:Patient) WHERE p.\"date_of_birth\"=\"{dob}\" RETURN p"
-        return self.db_connection.run_query(query)
+        query = FIND_PATIENT_BY_DOB_QUERY
+        return self.__read(query, {'dob': str(pd.Timestamp(dob).date())})
+
+    # Events dated between start and end (inclusive), optionally of one type, as records of the patient id and
+    # the event, e.g. all implants from 2016 to 2018: find_events_between("2016-01-01", "2018-12-31", "Implant")
+    def find_events_between(self, start, end, event_name=None):
+        parameters = {'start': str(pd.Timestamp(start).date()), 'end': str(pd.Timestamp(end).date())}
+        if event_name is None:
+            return self.__read(FIND_EVENTS_BETWEEN_QUERY, parameters)
+        return self.__read(FIND_NAMED_EVENTS_BETWEEN_QUERY, dict(parameters, name=event_name))
+
+    def find_patient_events_between(self, patient_id, start, end):
+        parameters = {'id': patient_id, 'start': str(pd.Timestamp(start).date()), 'end': str(pd.Timestamp(end).date())}
+        return self.__read(FIND_PATIENT_EVENTS_BETWEEN_QUERY, parameters)
+
+    # Interval join of two event types per patient: every pair of a first and a second event of the same patient
+    # whose gap in days (second minus first) lies in [min_days, max_days], e.g. a 7T scan within 90 days before
+    # surgery: find_event_gaps("T7 scan", "Surgical intervention", 0, 90)
+    def find_event_gaps(self, first, second, min_days=0, max_days=None):
+        return self.__read(FIND_EVENT_GAPS_QUERY, {'first': first, 'second': second, 'min_days': min_days,
+                                                   'max_days': max_days})
+
+    # Timeline lookups over the skip list built when the event type is listed in SKIP_LIST_EVENTS. They follow
+    # only the pointers of the requested type, so their cost depends on the number of matching events and not
+    # on the length of the patient's event chain.
+
+    def find_patient_events(self, patient_id, event_name):
+        query = f"MATCH (p:Patient {{id: $id}})-[:{gp.skip_relationship(event_name)}*]->(e:Event) RETURN e ORDER BY e.date"
+        return self.__read(query, {'id': patient_id})
+
+    def find_first_patient_event(self, patient_id, event_name):
+        query = f"MATCH (p:Patient {{id: $id}})-[:{gp.skip_relationship(event_name)}]->(e:Event) RETURN e"
+        return self.__read(query, {'id': patient_id})
+
+    def find_patients_by_event(self, event_name):
+        query = f"MATCH (p:Patient)-[:{gp.skip_relationship(event_name)}]->(:Event) RETURN p"
+        return self.__read(query)
+
+    # Same lookup on the plain next chain, for event types without a skip list
+    def scan_patient_events(self, patient_id, event_name):
+        query = "MATCH (p:Patient {id: $id})-[:next*]->(e:Event) WHERE e.name = $name RETURN e ORDER BY e.date"
+        return self.__read(query, {'id': patient_id, 'name': event_name})
+
+    # Reaches the event at a position of the chain over the express lanes: position // step hops on the
+    # nextLevel lane of the given level from the first event, then at most step - 1 single next hops
+    def find_patient_event_at(self, patient_id, position, express_step, level):
+        step = express_step ** level
+        express_hops, next_hops = divmod(position, step)
+        query = (
+            "MATCH (p:Patient {id: $id})-[:next]->(first:Event) "
+            f"MATCH lane = (first)-[:{gp.express_relationship(level)}*0..]->(stop:Event) "
+            "WHERE length(lane) = $express_hops "
+            f"MATCH walk = (stop)-[:next*0..{step - 1}]->(e:Event) "
+            "WHERE length(walk) = $next_hops "
+            "RETURN e"
+        )
+        return self.__read(query, {'id': patient_id, 'express_hops': express_hops, 'next_hops': next_hops})
 
     def create_patient(self, property_dict):
-        query = "CREATE (p: Patient { "
-        for key, value in property_dict:
-            if isinstance(value, int):
-                query += f"{key}: {value}, "
-            elif isinstance(value, pd.Timestamp):
-                query += f"{key}: date(\'{value.date()}\'), "
+        properties = {}
+        for key, value in property_dict.items():
+            if isinstance(value, pd.Timestamp):
+                properties[key] = value.date()
             else:
-                query += f"{key}: \"{value}\", "
-        query += "}) RETURN p"
-        return self.db_connection.run_query(query)
+                properties[key] = value
+        query = "CREATE (p:Patient) SET p = $properties RETURN p"
+        result = self.db_connection.run_query(query, {'properties': properties})
+        self.invalidate([properties.get('id')])
+        return result
 
+    # The schema itself is declared in schema.py
     def create_indexes(self):
-        self.db_connection.run_query('CREATE INDEX patient_name_index IF NOT EXISTS FOR (p:Patient) ON (p.id)')
-        self.db_connection.run_query('CREATE INDEX event_name_index IF NOT EXISTS FOR (e:Event) ON (e.name)')
-        self.db_connection.run_query('CREATE INDEX study_name_index IF NOT EXISTS FOR (s:Study) ON (s.name)')
-        self.db_connection.run_query('CREATE INDEX seizure_name_index IF NOT EXISTS FOR (s:Seizure) ON (s.name)')
-        self.db_connection.run_query('CREATE INDEX later_name_index IF NOT EXISTS FOR (l:Lateralization) ON (l.name)')
-        self.db_connection.run_query('CREATE INDEX medication_name_index IF NOT EXISTS FOR (m:Medication) ON (m.name)')
+        schema.SchemaManager(self.db_connection).create_indexes()
 
     def create_constrains(self):
-        self.db_connection.run_query('CREATE CONSTRAINT patients IF NOT EXISTS ON (p:Patient)     ASSERT p.id IS UNIQUE')
-        self.db_connection.run_query('CREATE CONSTRAINT studies IF NOT EXISTS ON (s:Study)     ASSERT s.name IS UNIQUE')
-        self.db_connection.run_query('CREATE CONSTRAINT seizures IF NOT EXISTS ON (s:Seizure)     ASSERT s.name IS UNIQUE')
-        self.db_connection.run_query(
-            'CREATE CONSTRAINT lateralizations IF NOT EXISTS ON (l:Lateralization) ASSERT l.name IS UNIQUE')
-        self.db_connection.run_query(
-            'CREATE CONSTRAINT medications IF NOT EXISTS ON (m:Medication)     ASSERT m.name IS UNIQUE')
+        schema.SchemaManager(self.db_connection).create_constraints()
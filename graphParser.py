@@ -1,8 +1,84 @@
 import pandas as pd
+import collections
 import csv
 import numpy as np
 
 
+# Fixed query templates used by both load modes. Each one receives a list of parameter
+# rows produced by the matching parse_*_rows method as $rows.
+STUDY_NODE_BATCH_QUERY = "UNWIND $rows AS row MERGE (s:Study {name: row.name})"
+MEDICATION_NODE_BATCH_QUERY = "UNWIND $rows AS row MERGE (m:Medication {name: row.name})"
+SEIZURE_NODE_BATCH_QUERY = "UNWIND $rows AS row MERGE (s:Seizure {name: row.name})"
+LATERALIZATION_NODE_BATCH_QUERY = "UNWIND $rows AS row MERGE (l:Lateralization {name: row.name})"
+PATIENT_BATCH_QUERY = (
+    "UNWIND $rows AS row "
+    "MERGE (p:Patient {id: row.id}) "
+    "SET p += row.properties "
+    "MERGE (p)-[:diagnosed]->(d:Diagnosis {name: \"Summary Clinical History\"})"
+)
+# The events are collected per row and not per patient, so a record_id appearing in several rows of a batch gets
+# one chain per row like in the per-row import
+EVENT_BATCH_QUERY = (
+    "UNWIND range(0, size($rows) - 1) AS index "
+    "WITH index, $rows[index] AS row "
+    "MATCH (p:Patient {id: row.id}) "
+    "UNWIND row.events AS event "
+    "CREATE (e:Event {name: event.name, date: event.date}) "
+    "WITH index, p, collect(e) AS events "
+    "WITH p, events, head(events) AS first, last(events) AS final "
+    "CREATE (p)-[:next]->(first), (p)-[:last]->(final) "
+    "FOREACH (i IN range(0, size(events) - 2) | "
+    "FOREACH (a IN [events[i]] | FOREACH (b IN [events[i + 1]] | CREATE (a)-[:next]->(b))))"
+)
+# Optional skip list over the event chain. For every event type listed in skip_list_events a pointer chain
+# (p)-[:nextImplant]->(e)-[:nextImplant]->(e') links the patient to its events of that type only, and with an
+# express_step k every level l in 1..express_levels links each k^l-th event of the chain to the one k^l further.
+SKIP_LIST_QUERY = (
+    "WITH p, events, [p] + [e IN events WHERE e.name = \"{name}\"] AS hits "
+    "FOREACH (i IN range(0, size(hits) - 2) | "
+    "FOREACH (a IN [hits[i]] | FOREACH (b IN [hits[i + 1]] | CREATE (a)-[:{relationship}]->(b)))) "
+)
+EXPRESS_QUERY = (
+    "FOREACH (i IN range(0, size(events) - 1 - {step}, {step}) | "
+    "FOREACH (a IN [events[i]] | FOREACH (b IN [events[i + {step}]] | CREATE (a)-[:{relationship}]->(b)))) "
+)
+
+
+def skip_relationship(event_name):
+    words = "".join(character if character.isalnum() else " " for character in event_name).split()
+    return "next" + "".join(word[:1].upper() + word[1:] for word in words)
+
+
+def express_relationship(level):
+    return f"nextLevel{level}"
+
+
+STUDY_BATCH_QUERY = (
+    "UNWIND $rows AS row "
+    "MATCH (p:Patient {id: row.id}), (s:Study {name: row.name}) "
+    "MERGE (p)-[:consents]->(s)"
+)
+SEIZURE_BATCH_QUERY = (
+    "UNWIND $rows AS row "
+    "MATCH (p:Patient {id: row.id})-[:diagnosed]->(d:Diagnosis), (s:Seizure {name: row.name}) "
+    "MERGE (d)-[:experiences]->(s)"
+)
+LATERALIZATION_BATCH_QUERY = (
+    "UNWIND $rows AS row "
+    "MATCH (p:Patient {id: row.id})-[:diagnosed]->(d:Diagnosis), (l:Lateralization {name: row.name}) "
+    "MERGE (d)-[:localized]->(l)"
+)
+MEDICATION_BATCH_QUERY = (
+    "UNWIND $rows AS row "
+    "MATCH (p:Patient {id: row.id})-[:diagnosed]->(d:Diagnosis), (m:Medication {name: row.name}) "
+    "MERGE (d)-[:takes]->(m)"
+)
+
+
+def normalized_term(term):
+    return " ".join(term.lower().split())
+
+
 class GraphParser:
     patient_property_dict = None
     study_protocol_dict = None
@@ -17,7 +93,10 @@ class GraphParser:
         'Eslicarbazepine acetate', 'Pregabalin', 'Primidone', 'Cenobamate'
     ]
 
-    def __init__(self):
+    def __init__(self, skip_list_events=(), express_step=0, express_levels=0):
+        self.skip_list_events = list(skip_list_events)
+        self.express_step = express_step
+        self.express_levels = express_levels
         with open('dictionaries/patient_property_map.csv') as infile:
             reader = csv.reader(infile)
             self.patient_property_dict = dict((rows[0], rows[1]) for rows in reader)
@@ -27,113 +106,188 @@ class GraphParser:
         with open('dictionaries/epilepsy_type_map.csv') as infile:
             reader = csv.reader(infile)
             self.seizure_types_dict = dict((rows[0], rows[1]) for rows in reader)
+        # Controlled vocabularies of the free-text columns as hashed lookups from the normalized spelling (see
+        # normalize_terms) to the name of the reference node, with the synonyms of vocabulary_synonyms.csv
+        self.vocabulary = {'seizure': list(dict.fromkeys(self.seizure_types_dict.values())),
+                           'medication': list(self.medication_list), 'lateralization': list(self.lateralization)}
+        self.vocabulary_lookup = {kind: {normalized_term(name): name for name in names}
+                                  for kind, names in self.vocabulary.items()}
+        with open('dictionaries/vocabulary_synonyms.csv') as infile:
+            reader = csv.reader(infile)
+            for kind, term, name in reader:
+                self.vocabulary_lookup[kind][normalized_term(term)] = name
+        self.unknown_terms = {kind: collections.Counter() for kind in self.vocabulary}
+
+    # The per-row load mode sends every row as its own statement, but through the same fixed
+    # templates as the batched mode so the server compiles each of them only once.
 
     def parse_patients(self, df):
-        queries = []
-        for index, row in df.iterrows():
-            query = ""
-            if row['record_id']:
-                query += "MERGE (p:Patient { "
-            else:
-                continue
-            for key, value in row.items():
-                if value is not np.nan and value is not pd.NaT and key in self.patient_property_dict:
-                    if key == "record_id":
-                        query += self.patient_property_dict.get(key) + f": {value}, "
-                    elif isinstance(value, pd.Timestamp):
-                        query += self.patient_property_dict.get(key) + f": date(\'{value.date()}\'), "
-                    else:
-                        query += self.patient_property_dict.get(key) + f": \"{value}\", "
-            query = query[:-2]
-            query += " })-[:diagnosed]->(d:Diagnosis {name: \"Summary Clinical History\"})"
-            queries.append(query)
-        return queries
+        return [(PATIENT_BATCH_QUERY, {'rows': [row]}) for row in self.parse_patient_rows(df)]
 
     def parse_events(self, df):
-        dates_df = df.drop(['record_id', 'T3_subject_id', 'T7_subject_id', 'Surgical_intervention'], axis=1)
-        queries = []
-        for index, row in dates_df.iterrows():
-            patient = str(int(df.loc[index].at["record_id"]))
-            row.sort_values(inplace=True)
-            row.dropna(inplace=True)
-            if not row.empty:
-                query = f"MATCH (p:Patient) WHERE p.id = {patient} "
-                i = 1
-                for event, date in row.items():
-                    if i == 1:
-                        event_name = event.removesuffix('_date').replace("_", " ")
-                        query += "CREATE (e" + str(i) + ":Event { name:\"" + event_name + "\", "
-                        query += f"date: date(\'{date.date()}\')" + "}), "
-                        query += f"(p) -[:next]-> (e{i}), "
-                    else:
-                        event_name = event.removesuffix('_date').replace("_", " ")
-                        query += "(e" + str(i) + ":Event { name:\"" + event_name + "\", "
-                        query += f"date: date(\'{date.date()}\')" + "}), "
-                        query += f"(e{i-1}) -[:next]-> (e{i}), "
-                    i += 1
-                query += f"(p)-[:last]->(e{i - 1})"
-                queries.append(query)
-        return queries
+        return [(self.event_batch_query(), {'rows': [row]}) for row in self.parse_event_rows(df)]
 
     def parse_studies(self, df):
-        queries = []
-        for index, row in df.iterrows():
-            for key, value in self.study_protocol_dict.items():
-                if key in row:
-                    if row[key] == "Checked":
-                        query = "MATCH (p:Patient {id: " + str(row['record_id']) + "}), "
-                        query += "(s:Study {name: \"" + value + "\"}) "
-                        query += "MERGE (p) -[r:consents]-> (s)"
-                        # query += "SET r" + key + ".date = \"" + str(row[key + "_date"]) + "\" "
-                        queries.append(query)
-        return queries
+        return [(STUDY_BATCH_QUERY, {'rows': [row]}) for row in self.parse_study_rows(df)]
 
     def parse_epilepsy(self, df):
-        queries = []
-        for index, row in df.iterrows():
-            for key, value in self.seizure_types_dict.items():
-                if key in row:
-                    if row[key] == 1:
-                        query = "MATCH (p:Patient {id: " + str(int(row['record_id'])) + "})-[:diagnosed]->(d:Diagnosis), "
-                        query += "(s:Seizure {name: \"" + value + "\"}) "
-                        query += "MERGE (d) -[r:experiences]-> (s)"
-                        queries.append(query)
-            if row['emu_seizure_lateralization_pecclinical'] is not np.nan:
-                query = "MATCH (p:Patient {id: " + str(int(row['record_id'])) + "})-[:diagnosed]->(d:Diagnosis), "
-                query += "(l:Lateralization {name: \"" + row['emu_seizure_lateralization_pecclinical'] + "\"}) "
-                query += "MERGE (d) -[r:localized]-> (l)"
-                queries.append(query)
-            if row['medication'] is not np.nan:
-                medications = [x.strip() for x in row['medication'].split(',')]
-                for medication in medications:
-                    if medication in self.medication_list:
-                        query = "MATCH (p:Patient {id: " + str(
-                            int(row['record_id'])) + "})-[:diagnosed]->(d:Diagnosis), "
-                        query += "(m:Medication {name: \"" + medication + "\"}) "
-                        query += "MERGE (d) -[r:takes]-> (m) "
-                queries.append(query)
+        seizures, lateralizations, medications = self.parse_epilepsy_rows(df)
+        queries = [(SEIZURE_BATCH_QUERY, {'rows': [row]}) for row in seizures]
+        queries += [(LATERALIZATION_BATCH_QUERY, {'rows': [row]}) for row in lateralizations]
+        queries += [(MEDICATION_BATCH_QUERY, {'rows': [row]}) for row in medications]
         return queries
 
+    # The event statement with the configured skip pointers and express links appended. Relationship types can
+    # not be parameters, but the text only depends on the configuration so it is still compiled once.
+    def event_batch_query(self):
+        query = EVENT_BATCH_QUERY + " "
+        if self.express_step > 1:
+            for level in range(1, self.express_levels + 1):
+                query += EXPRESS_QUERY.format(step=self.express_step ** level, relationship=express_relationship(level))
+        for name in self.skip_list_events:
+            literal = name.replace('\\', '\\\\').replace('"', '\\"')
+            query += SKIP_LIST_QUERY.format(name=literal, relationship=skip_relationship(name))
+        return query.strip()
+
     def create_studies(self):
-        queries = []
-        for study in self.study_protocol_dict.values():
-            query = "MERGE (s:Study {name: \"" + study + "\"})"
-            queries.append(query)
-        return queries
+        rows = [{'name': study} for study in self.study_protocol_dict.values()]
+        return [(STUDY_NODE_BATCH_QUERY, {'rows': rows})]
 
     def create_medications(self):
-        queries = []
-        for med in self.medication_list:
-            query = "MERGE (s:Medication {name: \"" + med + "\"})"
-            queries.append(query)
-        return queries
+        rows = [{'name': med} for med in self.medication_list]
+        return [(MEDICATION_NODE_BATCH_QUERY, {'rows': rows})]
 
     def create_epilepsy_nodes(self):
-        queries = []
-        for seizure in self.seizure_types_dict.values():
-            query = "MERGE (s:Seizure {name: \"" + seizure + "\"})"
-            queries.append(query)
-        for later in self.lateralization:
-            queries.append("MERGE (l:Lateralization {name: \"" + later + "\"})")
-        return queries
+        seizures = [{'name': seizure} for seizure in self.seizure_types_dict.values()]
+        lateralizations = [{'name': later} for later in self.lateralization]
+        return [(SEIZURE_NODE_BATCH_QUERY, {'rows': seizures}), (LATERALIZATION_NODE_BATCH_QUERY, {'rows': lateralizations})]
+
+    # Vectorized transformation stage. Every input frame is turned into column-oriented frames of node and
+    # relationship records (one column per property), the parse_*_rows methods below convert them into the
+    # parameter rows sent with the *_BATCH_QUERY statements above.
+
+    def patient_frame(self, df):
+        df = df[df['record_id'].notna() & (df['record_id'] != 0)]
+        columns = {}
+        for key in df.columns:
+            if key not in self.patient_property_dict:
+                continue
+            if key == "record_id":
+                columns[key] = df[key].astype('int64').astype(object)
+            elif pd.api.types.is_datetime64_any_dtype(df[key]):
+                columns[key] = df[key].dt.date.where(df[key].notna(), None)
+            else:
+                columns[key] = df[key].astype(str).where(df[key].notna(), None)
+        # Long format: one record per (patient, property) pair, missing values are dropped by stack
+        # and the index still points at the input row
+        long = pd.DataFrame(columns, index=df.index).stack().reset_index(level=1)
+        long.columns = ['key', 'value']
+        long['key'] = long['key'].map(self.patient_property_dict)
+        long['id'] = df['record_id'].astype('int64').reindex(long.index).to_numpy()
+        return long[['id', 'key', 'value']]
+
+    # With as_date=False the dates stay datetime64 instead of datetime.date objects
+    def event_frame(self, df, as_date=True):
+        df = df[df['record_id'].notna()]
+        dates_df = df.drop(['record_id', 'T3_subject_id', 'T7_subject_id', 'Surgical_intervention'], axis=1,
+                           errors='ignore')
+        long = dates_df.stack().reset_index(level=1)
+        long.columns = ['event', 'date']
+        long['id'] = df['record_id'].astype('int64').reindex(long.index).to_numpy()
+        # Order the events of every patient by date, keeping the file order of the patients themselves
+        long['position'] = np.arange(len(df)).repeat(dates_df.notna().sum(axis=1).to_numpy())
+        long = long.sort_values(['position', 'date'], kind='mergesort')
+        names = {event: event.removesuffix('_date').replace("_", " ") for event in dates_df.columns}
+        long['name'] = long['event'].map(names)
+        long['date'] = pd.to_datetime(long['date'])
+        if as_date:
+            long['date'] = long['date'].dt.date
+        return long[['id', 'name', 'date']]
+
+    def study_frame(self, df):
+        df = df[df['record_id'].notna()]
+        keys = [key for key in self.study_protocol_dict if key in df.columns]
+        return self.__checked_frame(df, keys, self.study_protocol_dict, df[keys].eq("Checked"))
+
+    def epilepsy_frames(self, df):
+        df = df[df['record_id'].notna()]
+        ids = df['record_id'].astype('int64')
+        keys = [key for key in self.seizure_types_dict if key in df.columns]
+        seizures = self.__checked_frame(df, keys, self.seizure_types_dict, df[keys].eq(1))
+
+        lateralization = self.normalize_terms('lateralization', df['emu_seizure_lateralization_pecclinical'].dropna())
+        lateralizations = pd.DataFrame({'id': ids.reindex(lateralization.index).to_numpy(), 'name': lateralization.to_numpy()})
+
+        medication = df['medication'].dropna().astype(str).str.split(',').explode()
+        medication = self.normalize_terms('medication', medication)
+        medications = pd.DataFrame({'id': ids.reindex(medication.index).to_numpy(), 'name': medication.to_numpy()})
+        return seizures, lateralizations, medications
+
+    # Maps the terms of a free-text column to the names of the vocabulary of kind, ignoring case, surrounding
+    # and repeated whitespace and resolving synonyms. Terms outside the vocabulary are dropped from the result
+    # and counted in unknown_terms, see unknown_report.
+    def normalize_terms(self, kind, terms):
+        terms = terms.astype(str).str.strip()
+        terms = terms[terms != '']
+        names = terms.str.lower().str.replace(r'\s+', ' ', regex=True).map(self.vocabulary_lookup[kind])
+        unknown = names.isna()
+        if unknown.any():
+            self.unknown_terms[kind].update(terms[unknown].value_counts().to_dict())
+        return names[~unknown]
+
+    # Terms dropped by normalize_terms since the parser was created or reset_unknown_terms was called, most
+    # frequent first
+    def unknown_report(self):
+        rows = [(kind, term, count) for kind, counter in self.unknown_terms.items() for term, count in counter.items()]
+        report = pd.DataFrame(rows, columns=['kind', 'term', 'count'])
+        return report.sort_values(['count', 'kind', 'term'], ascending=[False, True, True], ignore_index=True)
+
+    def reset_unknown_terms(self):
+        for counter in self.unknown_terms.values():
+            counter.clear()
+
+    @staticmethod
+    def __checked_frame(df, keys, names, checked):
+        # np.nonzero walks the checkbox matrix row by row, giving the same order as a loop over the rows
+        row_index, column_index = np.nonzero(checked.to_numpy())
+        ids = df['record_id'].to_numpy()[row_index].astype('int64')
+        values = np.array([names[key] for key in keys], dtype=object)[column_index]
+        return pd.DataFrame({'id': ids, 'name': values})
+
+    def parse_patient_rows(self, df):
+        long = self.patient_frame(df)
+        rows = []
+        properties = None
+        previous = None
+        for index, patient, key, value in zip(long.index, long['id'].tolist(), long['key'].tolist(), long['value'].tolist()):
+            if index != previous:
+                properties = {}
+                rows.append({'id': patient, 'properties': properties})
+                previous = index
+            properties[key] = value
+        return rows
+
+    def parse_event_rows(self, df):
+        long = self.event_frame(df)
+        rows = []
+        events = None
+        previous = None
+        for index, patient, name, date in zip(long.index, long['id'].tolist(), long['name'].tolist(), long['date'].tolist()):
+            if index != previous:
+                events = []
+                rows.append({'id': patient, 'events': events})
+                previous = index
+            events.append({'name': name, 'date': date})
+        return rows
+
+    def parse_study_rows(self, df):
+        return self.__relationship_rows(self.study_frame(df))
+
+    def parse_epilepsy_rows(self, df):
+        seizures, lateralizations, medications = self.epilepsy_frames(df)
+        return self.__relationship_rows(seizures), self.__relationship_rows(lateralizations), \
+            self.__relationship_rows(medications)
 
+    @staticmethod
+    def __relationship_rows(frame):
+        return [{'id': patient, 'name': name} for patient, name in zip(frame['id'].tolist(), frame['name'].tolist())]
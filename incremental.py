@@ -0,0 +1,165 @@
+import sqlite3
+import pandas as pd
+import reference_cache
+
+
+# Incremental import. A content hash of every record_id of every input file is kept in a small SQLite state
+# file; each run hashes the new export, compares it with the stored hashes and only sends the inserted, updated
+# and deleted records to the database. The relationships and event chains of a changed patient are deleted and
+# rebuilt from the new rows (inserted records included, in case the database was loaded by a full import
+# before), so re-running the import never duplicates them.
+
+DELETE_PATIENT_QUERY = (
+    "UNWIND $rows AS row "
+    "MATCH (p:Patient {id: row.id}) "
+    "OPTIONAL MATCH (p)-[:diagnosed]->(d:Diagnosis) "
+    "OPTIONAL MATCH (p)-[:next*]->(e:Event) "
+    "DETACH DELETE p, d, e"
+)
+DELETE_EVENTS_QUERY = (
+    "UNWIND $rows AS row "
+    "MATCH (p:Patient {id: row.id})-[:next*]->(e:Event) "
+    "DETACH DELETE e"
+)
+DELETE_STUDY_LINKS_QUERY = (
+    "UNWIND $rows AS row "
+    "MATCH (p:Patient {id: row.id})-[r:consents]->(:Study) "
+    "DELETE r"
+)
+DELETE_DIAGNOSIS_LINKS_QUERY = (
+    "UNWIND $rows AS row "
+    "MATCH (p:Patient {id: row.id})-[:diagnosed]->(d:Diagnosis)-[r:experiences|localized|takes]->() "
+    "DELETE r"
+)
+REPLACE_PATIENT_QUERY = (
+    "UNWIND $rows AS row "
+    "MERGE (p:Patient {id: row.id}) "
+    "SET p = row.properties "
+    "MERGE (p)-[:diagnosed]->(d:Diagnosis {name: \"Summary Clinical History\"})"
+)
+
+
+class ImportState:
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS record_hashes ("
+            "file TEXT NOT NULL, record_id INTEGER NOT NULL, hash INTEGER NOT NULL, PRIMARY KEY (file, record_id))"
+        )
+
+    def load(self, file):
+        rows = self.connection.execute("SELECT record_id, hash FROM record_hashes WHERE file = ?", (file,))
+        return dict(rows.fetchall())
+
+    def save(self, file, changed, deleted):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO record_hashes (file, record_id, hash) VALUES (?, ?, ?)",
+                [(file, record_id, hash_value) for record_id, hash_value in changed.items()]
+            )
+            self.connection.executemany(
+                "DELETE FROM record_hashes WHERE file = ? AND record_id = ?",
+                [(file, record_id) for record_id in deleted]
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+# One signed 64-bit content hash per record_id, rows sharing a record_id are combined
+def record_hashes(df):
+    df = df[df['record_id'].notna()]
+    hashes = pd.util.hash_pandas_object(df, index=False)
+    ids = df['record_id'].astype('int64')
+    combined = hashes.groupby(ids.to_numpy()).sum()
+    return dict(zip(combined.index.tolist(), combined.to_numpy().view('int64').tolist()))
+
+
+def diff(old, new):
+    inserted = [record_id for record_id in new if record_id not in old]
+    updated = [record_id for record_id in new if record_id in old and old[record_id] != new[record_id]]
+    deleted = [record_id for record_id in old if record_id not in new]
+    return inserted, updated, deleted
+
+
+def select_records(df, record_ids):
+    return df[df['record_id'].isin(record_ids)]
+
+
+# A query_cache.QueryCache passed as cache loses the entries of every changed patient, an
+# aggregates.AggregateStore passed as aggregates and a similarity.FeatureMatrix passed as features are updated for
+# the changed patients only, with a reference_cache.ReferenceCache as references the links are written by
+# element id
+def run_incremental(db, parser, state_path, patient_df, study_df, events_df, summary_df, batch_size, cache=None,
+                    aggregates=None, references=None, features=None):
+    state = ImportState(state_path)
+    reference_queries = parser.create_studies() + parser.create_medications() + parser.create_epilepsy_nodes()
+    db.run_query_list(reference_queries, len(reference_queries))
+    if references is not None:
+        references.sync(parser)
+    changes = {}
+    patients = []
+    try:
+        for file, df in [("patient.csv", patient_df), ("protocols.csv", study_df), ("events.csv", events_df),
+                         ("summary.csv", summary_df)]:
+            new = record_hashes(df)
+            inserted, updated, deleted = diff(state.load(file), new)
+            changed = inserted + updated
+            changes[file] = (len(inserted), len(updated), len(deleted))
+            if file == "patient.csv":
+                # Updated patients keep their links and events, REPLACE_PATIENT_QUERY only sets the properties
+                patients = inserted
+            else:
+                # The links and events of an added patient (or one deleted and added again) were not written or
+                # were removed with the patient, while the rows of this file can hash as unchanged
+                known = set(changed)
+                changed += [record_id for record_id in patients if record_id in new and record_id not in known]
+            apply_changes(db, parser, file, select_records(df, changed), changed + deleted, deleted, batch_size,
+                          aggregates, references, features)
+            state.save(file, {record_id: new[record_id] for record_id in changed}, deleted)
+            if cache is not None and changed + deleted:
+                cache.invalidate_patients(changed + deleted)
+    finally:
+        state.close()
+    for file, (inserted, updated, deleted) in changes.items():
+        print(f"{file:<14} inserted {inserted:>7}  updated {updated:>7}  deleted {deleted:>7}")
+    return changes
+
+
+def apply_changes(db, parser, file, changed_df, stale_ids, deleted_ids, batch_size, aggregates=None,
+                  references=None, features=None):
+    stale = [{'id': record_id} for record_id in stale_ids]
+    if file == "patient.csv":
+        db.run_batched(DELETE_PATIENT_QUERY, [{'id': record_id} for record_id in deleted_ids], batch_size)
+        # The element ids of deleted nodes can be reused for the nodes created next
+        if references is not None:
+            references.invalidate_patients(deleted_ids)
+        db.run_batched(REPLACE_PATIENT_QUERY, parser.parse_patient_rows(changed_df), batch_size)
+        if aggregates is not None:
+            aggregates.remove(deleted_ids)
+        if features is not None:
+            features.remove(deleted_ids)
+    elif file == "protocols.csv":
+        study_rows = parser.parse_study_rows(changed_df)
+        db.run_batched(DELETE_STUDY_LINKS_QUERY, stale, batch_size)
+        reference_cache.write_links(db, references, 'studies', study_rows, batch_size)
+        if aggregates is not None:
+            aggregates.update_studies(study_rows, stale_ids)
+        if features is not None:
+            features.update_studies(study_rows, stale_ids)
+    elif file == "events.csv":
+        db.run_batched(DELETE_EVENTS_QUERY, stale, batch_size)
+        event_rows = parser.parse_event_rows(changed_df)
+        db.run_batched(parser.event_batch_query(), event_rows, batch_size)
+        if features is not None:
+            features.update_events(event_rows, stale_ids)
+    elif file == "summary.csv":
+        db.run_batched(DELETE_DIAGNOSIS_LINKS_QUERY, stale, batch_size)
+        seizure_rows, lateralization_rows, medication_rows = parser.parse_epilepsy_rows(changed_df)
+        reference_cache.write_epilepsy_links(db, references, seizure_rows, lateralization_rows, medication_rows,
+                                             batch_size)
+        if aggregates is not None:
+            aggregates.update_epilepsy(seizure_rows, lateralization_rows, medication_rows, stale_ids)
+        if features is not None:
+            features.update_epilepsy(seizure_rows, lateralization_rows, medication_rows, stale_ids)
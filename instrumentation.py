@@ -0,0 +1,181 @@
+import json
+import logging
+import os
+import re
+import threading
+
+
+# Per query template statistics for Neo4jConnection. Every query is timed on the client in three phases, send
+# (until the server accepted the query), first record and consume (the remaining records and the summary), and
+# the ResultSummary adds the server timings and update counters. With profile=True the queries are prefixed
+# with PROFILE and the db hits of every operator of the plan are summed as well.
+
+PHASES = ['send', 'first_record', 'consume']
+COUNTERS = ['nodes_created', 'nodes_deleted', 'relationships_created', 'relationships_deleted', 'properties_set',
+            'labels_added', 'labels_removed', 'indexes_added', 'indexes_removed', 'constraints_added',
+            'constraints_removed']
+
+LITERALS = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|\b\d+(?:\.\d+)?\b")
+WHITESPACE = re.compile(r"\s+")
+
+
+# Queries that only differ in their inlined literals belong to the same template
+def template(query):
+    return WHITESPACE.sub(" ", LITERALS.sub("?", query)).strip()
+
+
+class TemplateStats:
+
+    def __init__(self, name):
+        self.template = name
+        self.count = 0
+        self.client_seconds = {phase: 0.0 for phase in PHASES}
+        self.client_max_seconds = {phase: 0.0 for phase in PHASES}
+        self.server_seconds = {'available_after': 0.0, 'consumed_after': 0.0}
+        self.records = 0
+        self.counters = {counter: 0 for counter in COUNTERS}
+        self.db_hits = {}
+
+    def add(self, timings, records, summary):
+        self.count += 1
+        for phase, seconds in zip(PHASES, timings):
+            self.client_seconds[phase] += seconds
+            self.client_max_seconds[phase] = max(self.client_max_seconds[phase], seconds)
+        self.records += records
+        if summary is None:
+            return
+        self.server_seconds['available_after'] += (summary.result_available_after or 0) / 1000
+        self.server_seconds['consumed_after'] += (summary.result_consumed_after or 0) / 1000
+        for counter in COUNTERS:
+            self.counters[counter] += getattr(summary.counters, counter, 0)
+        if summary.profile:
+            add_db_hits(self.db_hits, summary.profile)
+
+    def to_dict(self):
+        total = sum(self.client_seconds.values())
+        return {
+            'template': self.template,
+            'count': self.count,
+            'total_seconds': total,
+            'mean_seconds': total / self.count if self.count else 0.0,
+            'client_seconds': dict(self.client_seconds),
+            'client_max_seconds': dict(self.client_max_seconds),
+            'server_seconds': dict(self.server_seconds),
+            'records': self.records,
+            'counters': {counter: value for counter, value in self.counters.items() if value},
+            'db_hits': dict(self.db_hits),
+        }
+
+
+# Sums the db hits of a PROFILE plan per operator type, walking the plan tree
+def add_db_hits(db_hits, plan):
+    operator = plan.get('operatorType', 'unknown')
+    db_hits[operator] = db_hits.get(operator, 0) + plan.get('dbHits', 0)
+    for child in plan.get('children', []):
+        add_db_hits(db_hits, child)
+
+
+class Instrumentation:
+
+    def __init__(self, profile=False, exporters=()):
+        self.profile = profile
+        self.exporters = list(exporters)
+        self.__templates = {}
+        self.__lock = threading.Lock()
+
+    # The query text actually sent to the server
+    def prepare(self, query):
+        if self.profile and not query.lstrip().upper().startswith(("PROFILE", "EXPLAIN", "SHOW", "CREATE INDEX",
+                                                                   "CREATE CONSTRAINT", "DROP")):
+            return "PROFILE " + query
+        return query
+
+    # timings are the send, first record and consume phases in seconds
+    def record(self, query, timings, records, summary):
+        name = template(query)
+        with self.__lock:
+            stats = self.__templates.get(name)
+            if stats is None:
+                stats = self.__templates[name] = TemplateStats(name)
+            stats.add(timings, records, summary)
+
+    # Statistics of every template, the slowest first
+    def stats(self):
+        with self.__lock:
+            stats = [stats.to_dict() for stats in self.__templates.values()]
+        return sorted(stats, key=lambda entry: entry['total_seconds'], reverse=True)
+
+    def reset(self):
+        with self.__lock:
+            self.__templates.clear()
+
+    def export(self):
+        stats = self.stats()
+        for exporter in self.exporters:
+            exporter.export(stats)
+
+
+class LogExporter:
+
+    def __init__(self, logger=None, limit=20):
+        self.logger = logger or logging.getLogger("neo4j.queries")
+        self.limit = limit
+
+    def export(self, stats):
+        for entry in stats[:self.limit]:
+            client = entry['client_seconds']
+            self.logger.info("%6d x %8.3fs (send %.3fs, first record %.3fs, consume %.3fs, server %.3fs) %s",
+                             entry['count'], entry['total_seconds'], client['send'], client['first_record'],
+                             client['consume'], entry['server_seconds']['consumed_after'], entry['template'])
+
+
+class JsonExporter:
+
+    def __init__(self, path):
+        self.path = path
+
+    def export(self, stats):
+        write_atomic(self.path, json.dumps(stats, indent=2))
+
+
+# Text exposition format, e.g. for the textfile collector of the Prometheus node exporter
+class PrometheusExporter:
+
+    def __init__(self, path, prefix="neo4j_query"):
+        self.path = path
+        self.prefix = prefix
+
+    def export(self, stats):
+        lines = [f"# TYPE {self.prefix}_count counter",
+                 f"# TYPE {self.prefix}_client_seconds_total counter",
+                 f"# TYPE {self.prefix}_client_seconds_max gauge",
+                 f"# TYPE {self.prefix}_server_seconds_total counter",
+                 f"# TYPE {self.prefix}_updates_total counter",
+                 f"# TYPE {self.prefix}_db_hits_total counter"]
+        for entry in stats:
+            name = label(entry['template'])
+            lines.append(f'{self.prefix}_count{{template="{name}"}} {entry["count"]}')
+            for phase in PHASES:
+                lines.append(f'{self.prefix}_client_seconds_total{{template="{name}",phase="{phase}"}} '
+                             f'{entry["client_seconds"][phase]}')
+                lines.append(f'{self.prefix}_client_seconds_max{{template="{name}",phase="{phase}"}} '
+                             f'{entry["client_max_seconds"][phase]}')
+            for phase, seconds in entry['server_seconds'].items():
+                lines.append(f'{self.prefix}_server_seconds_total{{template="{name}",phase="{phase}"}} {seconds}')
+            for counter, value in entry['counters'].items():
+                lines.append(f'{self.prefix}_updates_total{{template="{name}",counter="{counter}"}} {value}')
+            for operator, hits in entry['db_hits'].items():
+                lines.append(f'{self.prefix}_db_hits_total{{template="{name}",operator="{label(operator)}"}} {hits}')
+        write_atomic(self.path, "\n".join(lines) + "\n")
+
+
+def label(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+# Readers such as the node exporter never see a half written file
+def write_atomic(path, text):
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as outfile:
+        outfile.write(text)
+    os.replace(temporary, path)
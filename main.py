@@ -1,6 +1,12 @@
 import pandas as pd
 import neo4jConnection as con
 import graphParser as gp
+import incremental
+import aggregates
+import similarity
+import schema
+import reference_cache
+import instrumentation
 import numpy as np
 import configparser
 import os
@@ -18,6 +24,98 @@ def read_config(path):
     return uri, username, password
 
 
+def read_driver_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    driver_config = {}
+    if config.has_option('DATABASE', 'POOL_SIZE'):
+        driver_config['max_connection_pool_size'] = config.getint('DATABASE', 'POOL_SIZE')
+    if config.has_option('DATABASE', 'ACQUISITION_TIMEOUT'):
+        driver_config['connection_acquisition_timeout'] = config.getfloat('DATABASE', 'ACQUISITION_TIMEOUT')
+    if config.has_option('DATABASE', 'RETRY_TIME'):
+        driver_config['max_transaction_retry_time'] = config.getfloat('DATABASE', 'RETRY_TIME')
+    return driver_config
+
+
+def read_import_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    batch_size = config.getint('IMPORT', 'BATCH_SIZE', fallback=0)
+    transaction_size = config.getint('IMPORT', 'TRANSACTION_SIZE', fallback=0)
+    chunk_size = config.getint('IMPORT', 'CHUNK_SIZE', fallback=0)
+    writers = config.getint('IMPORT', 'WRITERS', fallback=0)
+    state_file = config.get('IMPORT', 'STATE_FILE', fallback='')
+    # The streaming and pipeline modes create every node and chain again, on top of an incremental state they
+    # would duplicate the event chains
+    if state_file and (chunk_size > 0 or writers > 0):
+        raise ValueError("STATE_FILE can not be combined with CHUNK_SIZE or WRITERS, set them to 0 for an "
+                         "incremental import")
+    # Only the streaming, incremental and batched modes write links through a reference_cache.ReferenceCache, the
+    # pipeline and per-row modes would silently ignore it
+    pipeline = not chunk_size and writers > 0
+    per_row = not chunk_size and not writers and not state_file and not batch_size
+    if config.getint('IMPORT', 'REFERENCE_CACHE_SIZE', fallback=0) > 0 and (pipeline or per_row):
+        raise ValueError("REFERENCE_CACHE_SIZE is not used by the pipeline (WRITERS) or per-row (BATCH_SIZE = 0) "
+                         "import, set it to 0 or use CHUNK_SIZE, STATE_FILE or BATCH_SIZE")
+    return batch_size, transaction_size, chunk_size, writers, state_file
+
+
+def read_reference_cache_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config.getint('IMPORT', 'REFERENCE_CACHE_SIZE', fallback=0)
+
+
+def read_defer_indexes_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config.getboolean('IMPORT', 'DEFER_INDEXES', fallback=False)
+
+
+def read_instrumentation_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    if not config.getboolean('INSTRUMENTATION', 'ENABLED', fallback=False):
+        return None
+    exporters = []
+    if config.getboolean('INSTRUMENTATION', 'LOG', fallback=False):
+        exporters.append(instrumentation.LogExporter())
+    if config.get('INSTRUMENTATION', 'PROMETHEUS_FILE', fallback=''):
+        exporters.append(instrumentation.PrometheusExporter(config.get('INSTRUMENTATION', 'PROMETHEUS_FILE')))
+    if config.get('INSTRUMENTATION', 'JSON_FILE', fallback=''):
+        exporters.append(instrumentation.JsonExporter(config.get('INSTRUMENTATION', 'JSON_FILE')))
+    return instrumentation.Instrumentation(config.getboolean('INSTRUMENTATION', 'PROFILE', fallback=False), exporters)
+
+
+def read_timeline_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    events = config.get('TIMELINE', 'SKIP_LIST_EVENTS', fallback='')
+    return {
+        'skip_list_events': [event.strip() for event in events.split(',') if event.strip()],
+        'express_step': config.getint('TIMELINE', 'EXPRESS_STEP', fallback=0),
+        'express_levels': config.getint('TIMELINE', 'EXPRESS_LEVELS', fallback=0),
+    }
+
+
+def read_export_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config.get('EXPORT', 'ADMIN_IMPORT_PATH', fallback='')
+
+
+def read_aggregates_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config.get('AGGREGATES', 'PATH', fallback='')
+
+
+def read_similarity_config(path):
+    config = configparser.ConfigParser()
+    config.read(path)
+    return config.get('SIMILARITY', 'PATH', fallback='')
+
+
 def read_patient_csv(filename):
     df = pd.read_csv(filename)
     df = df.fillna(0)
@@ -50,32 +148,15 @@ def read_event_csv(filename):
     return df
 
 
-def create_constrains(connection):
-    connection.run_query('CREATE CONSTRAINT patients IF NOT EXISTS ON (p:Patient)     ASSERT p.id IS UNIQUE')
-    connection.run_query('CREATE CONSTRAINT studies IF NOT EXISTS ON (s:Study)     ASSERT s.name IS UNIQUE')
-    connection.run_query('CREATE CONSTRAINT seizures IF NOT EXISTS ON (s:Seizure)     ASSERT s.name IS UNIQUE')
-    connection.run_query('CREATE CONSTRAINT lateralizations IF NOT EXISTS ON (l:Lateralization) ASSERT l.name IS UNIQUE')
-    connection.run_query('CREATE CONSTRAINT medications IF NOT EXISTS ON (m:Medication)     ASSERT m.name IS UNIQUE')
-
-
-def create_indexes(connection):
-    connection.run_query('CREATE INDEX patient_name_index IF NOT EXISTS FOR (p:Patient) ON (p.id)')
-    connection.run_query('CREATE INDEX event_name_index IF NOT EXISTS FOR (e:Event) ON (e.name)')
-    connection.run_query('CREATE INDEX study_name_index IF NOT EXISTS FOR (s:Study) ON (s.name)')
-    connection.run_query('CREATE INDEX seizure_name_index IF NOT EXISTS FOR (s:Seizure) ON (s.name)')
-    connection.run_query('CREATE INDEX later_name_index IF NOT EXISTS FOR (l:Lateralization) ON (l.name)')
-    connection.run_query('CREATE INDEX medication_name_index IF NOT EXISTS FOR (m:Medication) ON (m.name)')
-
-
 def read_all_files(path):
     patient_file = "patient.csv"
     study_file = "protocols.csv"
     event_file = "events.csv"
     summary_file = "summary.csv"
-    patient_path = "{}\{}".format(path, patient_file)
-    study_path = "{}\{}".format(path, study_file)
-    events_path = "{}\{}".format(path, event_file)
-    summary_path = "{}\{}".format(path, summary_file)
+    patient_path = os.path.join(path, patient_file)
+    study_path = os.path.join(path, study_file)
+    events_path = os.path.join(path, event_file)
+    summary_path = os.path.join(path, summary_file)
     patient_df = read_patient_csv(patient_path)
     study_df = pd.read_csv(study_path)
     events_df = read_event_csv(events_path)
@@ -83,36 +164,231 @@ def read_all_files(path):
     return patient_df, study_df, events_df, summary_df
 
 
+# Chunked readers for the streaming mode. Only the columns the parser maps are read, with explicit dtypes, and
+# the dates are parsed once per chunk instead of the fillna/astype/replace round trips of the readers above.
+
+def read_csv_chunks(filename, columns, date_columns, chunk_size):
+    dtype = {column: column_type for column, column_type in columns.items() if column not in date_columns}
+    reader = pd.read_csv(filename, usecols=lambda column: column in columns, dtype=dtype, chunksize=chunk_size)
+    for chunk in reader:
+        for column in date_columns:
+            if column in chunk:
+                chunk[column] = pd.to_datetime(chunk[column], dayfirst=False)
+        yield chunk
+
+
+def read_patient_chunks(filename, parser, chunk_size):
+    columns = {key: 'object' for key in parser.patient_property_dict}
+    columns['record_id'] = 'float64'
+    return read_csv_chunks(filename, columns, ['dob', 'dod'], chunk_size)
+
+
+def read_study_chunks(filename, parser, chunk_size):
+    columns = {key: 'object' for key in parser.study_protocol_dict}
+    columns['record_id'] = 'float64'
+    return read_csv_chunks(filename, columns, [], chunk_size)
+
+
+def read_event_chunks(filename, parser, chunk_size):
+    date_columns = [column for column in pd.read_csv(filename, nrows=0).columns if column.endswith('_date')]
+    columns = {column: 'object' for column in date_columns}
+    columns['record_id'] = 'float64'
+    return read_csv_chunks(filename, columns, date_columns, chunk_size)
+
+
+def read_summary_chunks(filename, parser, chunk_size):
+    columns = {key: 'float64' for key in parser.seizure_types_dict}
+    columns['record_id'] = 'float64'
+    columns['emu_seizure_lateralization_pecclinical'] = 'object'
+    columns['medication'] = 'object'
+    return read_csv_chunks(filename, columns, [], chunk_size)
+
+
+# With a reference_cache.ReferenceCache as references the links are written by element id, a
+# similarity.FeatureMatrix passed as features gets the features of the loaded patients
+def load_batched(db, parser, patient_df, study_df, events_df, summary_df, batch_size, cache=None, aggregates=None,
+                 references=None, features=None):
+    reference_queries = parser.create_studies() + parser.create_medications() + parser.create_epilepsy_nodes()
+    db.run_query_list(reference_queries, len(reference_queries))
+    if references is not None:
+        references.sync(parser)
+
+    db.run_batched(gp.PATIENT_BATCH_QUERY, parser.parse_patient_rows(patient_df), batch_size)
+    study_rows = parser.parse_study_rows(study_df)
+    reference_cache.write_links(db, references, 'studies', study_rows, batch_size)
+    event_rows = parser.parse_event_rows(events_df)
+    db.run_batched(parser.event_batch_query(), event_rows, batch_size)
+
+    seizure_rows, lateralization_rows, medication_rows = parser.parse_epilepsy_rows(summary_df)
+    reference_cache.write_epilepsy_links(db, references, seizure_rows, lateralization_rows, medication_rows, batch_size)
+    if cache is not None:
+        cache.invalidate_patients()
+    if aggregates is not None:
+        aggregates.update_studies(study_rows)
+        aggregates.update_epilepsy(seizure_rows, lateralization_rows, medication_rows)
+    if features is not None:
+        features.update_studies(study_rows)
+        features.update_events(event_rows)
+        features.update_epilepsy(seizure_rows, lateralization_rows, medication_rows)
+
+
+# Streaming mode: every chunk is parsed and written before the next one is read, so the memory use depends on
+# the chunk size and not on the size of the export. All patients are written before any relationship.
+def load_streaming(db, parser, path, chunk_size, batch_size, aggregates=None, references=None, features=None):
+    reference_queries = parser.create_studies() + parser.create_medications() + parser.create_epilepsy_nodes()
+    db.run_query_list(reference_queries, len(reference_queries))
+    if references is not None:
+        references.sync(parser)
+
+    for chunk in read_patient_chunks(os.path.join(path, "patient.csv"), parser, chunk_size):
+        db.run_batched(gp.PATIENT_BATCH_QUERY, parser.parse_patient_rows(chunk), batch_size)
+    for chunk in read_study_chunks(os.path.join(path, "protocols.csv"), parser, chunk_size):
+        study_rows = parser.parse_study_rows(chunk)
+        reference_cache.write_links(db, references, 'studies', study_rows, batch_size)
+        if aggregates is not None:
+            aggregates.update_studies(study_rows)
+        if features is not None:
+            features.update_studies(study_rows)
+    for chunk in read_event_chunks(os.path.join(path, "events.csv"), parser, chunk_size):
+        event_rows = parser.parse_event_rows(chunk)
+        db.run_batched(parser.event_batch_query(), event_rows, batch_size)
+        if features is not None:
+            features.update_events(event_rows)
+    for chunk in read_summary_chunks(os.path.join(path, "summary.csv"), parser, chunk_size):
+        seizure_rows, lateralization_rows, medication_rows = parser.parse_epilepsy_rows(chunk)
+        reference_cache.write_epilepsy_links(db, references, seizure_rows, lateralization_rows, medication_rows,
+                                             batch_size)
+        if aggregates is not None:
+            aggregates.update_epilepsy(seizure_rows, lateralization_rows, medication_rows)
+        if features is not None:
+            features.update_epilepsy(seizure_rows, lateralization_rows, medication_rows)
+
+
+# The pipeline and per-row modes update the stores once all rows are parsed, reusing the rows they sent
+def update_stores(store, features, study_rows, event_rows, epilepsy_rows):
+    if store is not None:
+        store.update_studies(study_rows)
+        store.update_epilepsy(*epilepsy_rows)
+    if features is not None:
+        features.update_studies(study_rows)
+        features.update_events(event_rows)
+        features.update_epilepsy(*epilepsy_rows)
+
+
+# Writes an aggregates.AggregateStore or similarity.FeatureMatrix, if there is one
+def save_store(store, path):
+    if store is not None:
+        store.save(path)
+
+
 def main():
+    parser = gp.GraphParser(**read_timeline_config('config.ini'))
+    export_path = read_export_config('config.ini')
+    if export_path:
+        # Offline mode: write neo4j-admin import files instead of loading the database
+        # (imported here since the export module itself imports main for the chunked readers)
+        import bulk_export
+        command = bulk_export.export(parser, os.path.join(os.getcwd(), "input"), export_path)
+        print(" ".join(command))
+        return
+
     uri, username, password = read_config('config.ini')
-    db = con.Neo4jConnection(uri, username, password)
-    create_constrains(db)
-    create_indexes(db)
+    db = con.Neo4jConnection(uri, username, password, instrumentation=read_instrumentation_config('config.ini'),
+                             **read_driver_config('config.ini'))
+
+    # Materialized report aggregates, refreshed after every load and served by DatabaseAPI.patient_counts
+    aggregates_path = read_aggregates_config('config.ini')
+    store = aggregates.load_or_create(aggregates_path, parser) if aggregates_path else None
+    # Patient x feature matrix of the similar patient search, kept up to date like the aggregates
+    features_path = read_similarity_config('config.ini')
+    features = similarity.load_or_create(features_path, parser) if features_path else None
+
+    path = os.path.join(os.getcwd(), "input")
+    manager = schema.SchemaManager(db)
+    if read_defer_indexes_config('config.ini'):
+        # The event indexes are dropped during the load and rebuilt once all events are written
+        with manager.bulk_load():
+            import_input(db, parser, path, store, features)
+    else:
+        manager.apply()
+        import_input(db, parser, path, store, features)
+    save_store(store, aggregates_path)
+    save_store(features, features_path)
+    # Also writes the query statistics to the configured exporters
+    db.close()
+    print_unknown_terms(parser)
+
+
+# Free-text values that matched neither the vocabulary nor a synonym, so they were not linked. Every input row is
+# parsed once per import, in the pipeline mode the counts of the worker processes are merged into the parser.
+def print_unknown_terms(parser):
+    report = parser.unknown_report()
+    if len(report):
+        print(f"{report['count'].sum()} values outside the vocabulary were not imported "
+              "(add them to dictionaries/vocabulary_synonyms.csv to map them):")
+        print(report.to_string(index=False))
+
+
+def import_input(db, parser, path, store, features=None):
+    batch_size, transaction_size, chunk_size, writers, state_file = read_import_config('config.ini')
+    # Element ids of the reference nodes and of up to REFERENCE_CACHE_SIZE patients, for the link statements
+    reference_cache_size = read_reference_cache_config('config.ini')
+    references = reference_cache.ReferenceCache(db, reference_cache_size) if reference_cache_size > 0 else None
+    if chunk_size > 0:
+        load_streaming(db, parser, path, chunk_size, batch_size if batch_size > 0 else chunk_size, store, references,
+                       features)
+        return
+    if writers > 0:
+        # Imported here since the pipeline module itself imports main for the readers
+        import pipeline
+        times, results = pipeline.run_pipeline(db, parser, path, batch_size if batch_size > 0 else 1000, writers)
+        update_stores(store, features, results["parse studies"], results["parse events"],
+                      results["parse epilepsy"][:3])
+        return
 
-    path = os.getcwd() + r"\input"
     patient_df, study_df, events_df, summary_df = read_all_files(path)
+    if state_file:
+        # Incremental mode: only the records whose content changed since the last run are sent
+        incremental.run_incremental(db, parser, state_file, patient_df, study_df, events_df, summary_df,
+                                    batch_size if batch_size > 0 else 1000, aggregates=store, references=references,
+                                    features=features)
+        return
+    if batch_size > 0:
+        # Batched mode: a handful of UNWIND statements per stage instead of one query per row
+        load_batched(db, parser, patient_df, study_df, events_df, summary_df, batch_size, aggregates=store,
+                     references=references, features=features)
+        return
 
-    parser = gp.GraphParser()
     patient_queries = parser.parse_patients(patient_df)
-    db.run_query_list(patient_queries)
+    db.run_query_list(patient_queries, transaction_size)
 
     study_queries = parser.create_studies()
-    db.run_query_list(study_queries)
+    db.run_query_list(study_queries, transaction_size)
 
     medication_queries = parser.create_medications()
-    db.run_query_list(medication_queries)
+    db.run_query_list(medication_queries, transaction_size)
 
     study_queries = parser.parse_studies(study_df)
-    db.run_query_list(study_queries)
+    db.run_query_list(study_queries, transaction_size)
 
     event_queries = parser.parse_events(events_df)
-    db.run_query_list(event_queries)
+    db.run_query_list(event_queries, transaction_size)
 
     epilepsy_queries = parser.create_epilepsy_nodes()
-    db.run_query_list(epilepsy_queries)
+    db.run_query_list(epilepsy_queries, transaction_size)
 
     epilepsy_connections = parser.parse_epilepsy(summary_df)
-    db.run_query_list(epilepsy_connections)
+    db.run_query_list(epilepsy_connections, transaction_size)
+
+    epilepsy_rows = [query_rows(epilepsy_connections, query)
+                     for query in (gp.SEIZURE_BATCH_QUERY, gp.LATERALIZATION_BATCH_QUERY, gp.MEDICATION_BATCH_QUERY)]
+    update_stores(store, features, query_rows(study_queries, gp.STUDY_BATCH_QUERY),
+                  query_rows(event_queries, parser.event_batch_query()), epilepsy_rows)
+
+
+# The rows of the statements of query in the (query, parameters) list of a parse_* method
+def query_rows(queries, query):
+    return [row for statement, parameters in queries if statement == query for row in parameters['rows']]
 
 
 # Press the green button in the gutter to run the script.
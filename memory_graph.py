@@ -0,0 +1,370 @@
+import numpy as np
+import pandas as pd
+import database_api as api
+
+
+# Embedded read-only copy of the graph GraphParser describes, for analytics jobs and CI runs without a Neo4j
+# server. Nodes are integers numbered label by label (patients, their diagnoses, events, then the reference
+# nodes), the label of a node is an interned code, every relationship type is stored as a NumPy CSR adjacency in
+# both directions and the properties are kept in columns per label. The event chain of an input row occupies
+# consecutive node numbers in date order, so next walks and positional lookups are index arithmetic.
+
+LABELS = ['Patient', 'Diagnosis', 'Event', 'Study', 'Seizure', 'Lateralization', 'Medication']
+
+# Relationship type of the reference nodes of every database_api.COHORT_PATTERNS kind, and whether it starts
+# at the patient or at its diagnosis
+REFERENCES = {
+    'studies': ('Study', 'consents', False),
+    'seizures': ('Seizure', 'experiences', True),
+    'lateralizations': ('Lateralization', 'localized', True),
+    'medications': ('Medication', 'takes', True),
+}
+
+
+class Adjacency:
+
+    # Compressed sparse rows over the sources, the targets of each source keep their insertion order
+    def __init__(self, sources, targets, size):
+        order = np.argsort(sources, kind='stable')
+        self.indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=size), out=self.indptr[1:])
+        self.indices = np.asarray(targets, dtype=np.int64)[order]
+
+    def neighbors(self, node):
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    # Neighbors of every node in nodes, concatenated
+    def expand(self, nodes):
+        starts = self.indptr[nodes]
+        lengths = self.indptr[np.asarray(nodes) + 1] - starts
+        if not lengths.sum():
+            return np.zeros(0, dtype=np.int64)
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self.indices[offsets + np.arange(lengths.sum())]
+
+    def degree(self):
+        return np.diff(self.indptr)
+
+
+class MemoryGraph:
+
+    def __init__(self, parser, patient_df, study_df, events_df, summary_df):
+        # Same patients as PATIENT_BATCH_QUERY, repeated ids are merged with the last non-missing value winning
+        patient_df = patient_df[patient_df['record_id'].notna() & (patient_df['record_id'] != 0)]
+        if patient_df['record_id'].duplicated().any():
+            patient_df = patient_df.groupby('record_id', sort=False, as_index=False).last()
+        patient_ids = patient_df['record_id'].to_numpy().astype('int64')
+        events = parser.event_frame(events_df, as_date=False)
+        events = events[events['id'].isin(patient_ids)]
+        references = {
+            'Study': list(dict.fromkeys(parser.study_protocol_dict.values())),
+            'Seizure': list(dict.fromkeys(parser.seizure_types_dict.values())),
+            'Lateralization': list(dict.fromkeys(parser.lateralization)),
+            'Medication': list(dict.fromkeys(parser.medication_list)),
+        }
+
+        sizes = [len(patient_ids), len(patient_ids), len(events)] + [len(references[label]) for label in LABELS[3:]]
+        self.starts = dict(zip(LABELS, np.concatenate([[0], np.cumsum(sizes)[:-1]]).tolist()))
+        self.size = int(sum(sizes))
+        self.node_labels = np.repeat(np.arange(len(LABELS), dtype=np.int8), sizes)
+        self.patient_index = pd.Index(patient_ids)
+        self.names = {label: {name: self.starts[label] + offset for offset, name in enumerate(names)}
+                      for label, names in references.items()}
+        self.reference_names = references
+
+        # Columnar properties: the patient columns as read, converted like GraphParser.patient_frame when a node
+        # is returned, and the event names as codes into a vocabulary
+        keys = {}
+        for key in patient_df.columns:
+            if key in parser.patient_property_dict:
+                keys.setdefault(parser.patient_property_dict[key], []).append(key)
+        self.patient_properties = {name: combined_column(patient_df, columns) for name, columns in keys.items()}
+        self.patient_properties['id'] = patient_ids
+        self.event_names, self.event_vocabulary = pd.factorize(events['name'])
+        self.event_vocabulary = list(self.event_vocabulary)
+        self.event_dates = events['date'].to_numpy().astype('datetime64[D]')
+        self.event_owners = self.patient_index.get_indexer(events['id'])
+
+        self.adjacency = {}
+        self.reverse = {}
+        patient_nodes = np.arange(len(patient_ids))
+        self.__add('diagnosed', patient_nodes, patient_nodes + self.starts['Diagnosis'])
+
+        # One next chain per input row, linked to the patient by next (first event) and last (final event)
+        event_nodes = np.arange(len(events)) + self.starts['Event']
+        rows = events.index.to_numpy()
+        heads = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]]) if len(rows) else np.zeros(0, dtype=np.int64)
+        tails = np.r_[heads[1:], len(rows)] - 1
+        owners = self.patient_index.get_indexer(events['id'].to_numpy()[heads])
+        linked = np.ones(len(rows), dtype=bool)
+        linked[tails] = False
+        self.__add('next', np.r_[owners, event_nodes[linked]], np.r_[event_nodes[heads], event_nodes[linked] + 1])
+        self.__add('last', owners, event_nodes[tails])
+
+        seizures, lateralizations, medications = parser.epilepsy_frames(summary_df)
+        frames = {'studies': parser.study_frame(study_df), 'seizures': seizures, 'lateralizations': lateralizations,
+                  'medications': medications}
+        for kind, (label, relationship, diagnosis) in REFERENCES.items():
+            frame = frames[kind]
+            frame = frame[frame['id'].isin(patient_ids) & frame['name'].isin(self.names[label])]
+            frame = frame.drop_duplicates()
+            sources = self.patient_index.get_indexer(frame['id'])
+            if diagnosis:
+                sources = sources + self.starts['Diagnosis']
+            self.__add(relationship, sources, frame['name'].map(self.names[label]).to_numpy(dtype=np.int64))
+
+    def __add(self, relationship, sources, targets):
+        sources = np.asarray(sources, dtype=np.int64)
+        targets = np.asarray(targets, dtype=np.int64)
+        self.adjacency[relationship] = Adjacency(sources, targets, self.size)
+        self.reverse[relationship] = Adjacency(targets, sources, self.size)
+
+    def label(self, node):
+        return LABELS[self.node_labels[node]]
+
+    def patient_node(self, patient_id):
+        try:
+            return int(self.patient_index.get_loc(patient_id))
+        except KeyError:
+            return None
+
+    def properties(self, node):
+        label = self.label(node)
+        offset = node - self.starts[label]
+        if label == 'Patient':
+            properties = {}
+            for key, column in self.patient_properties.items():
+                value = column[offset]
+                if not pd.isna(value):
+                    properties[key] = property_value(key, value)
+            return properties
+        if label == 'Event':
+            return {'name': self.event_vocabulary[self.event_names[offset]], 'date': self.event_dates[offset].item()}
+        if label == 'Diagnosis':
+            return {'name': "Summary Clinical History"}
+        return {'name': self.reference_names[label][offset]}
+
+    # Patients linked to any of the reference nodes, in patient order
+    def patients_of(self, kind, names):
+        label, relationship, diagnosis = REFERENCES[kind]
+        nodes = [self.names[label][name] for name in names if name in self.names[label]]
+        sources = self.reverse[relationship].expand(np.array(nodes, dtype=np.int64))
+        if diagnosis:
+            sources = sources - self.starts['Diagnosis']
+        return np.unique(sources)
+
+    # Event nodes of the patient in chain order, following next from the patient and then along the chain
+    def events_of(self, patient_node):
+        events = []
+        for head, tail in zip(self.adjacency['next'].neighbors(patient_node),
+                              self.adjacency['last'].neighbors(patient_node)):
+            events.append(np.arange(head, tail + 1))
+        return np.concatenate(events) if events else np.zeros(0, dtype=np.int64)
+
+    # Follows single next hops from a node, steps of 0 returns the node itself
+    def walk(self, node, steps, relationship='next'):
+        for _ in range(steps):
+            following = self.adjacency[relationship].neighbors(node)
+            if not len(following):
+                return None
+            node = int(following[0])
+        return node
+
+
+# Several input columns can map to the same property (employment_status), like in GraphParser.patient_frame the
+# last column with a value wins for every row
+def combined_column(df, keys):
+    column = df[keys[0]]
+    for key in keys[1:]:
+        column = df[key].where(df[key].notna(), column)
+    return column.to_numpy()
+
+
+def property_value(key, value):
+    if key == 'id':
+        return int(value)
+    if isinstance(value, np.datetime64):
+        return pd.Timestamp(value).date()
+    return str(value)
+
+
+# Read-only counterpart of database_api.DatabaseAPI over a MemoryGraph. The lookups return the same shape as the
+# Neo4j ones, lists of records keyed by the variable of the RETURN clause, with property dicts as nodes.
+class MemoryDatabaseAPI:
+
+    def __init__(self, graph):
+        self.graph = graph
+
+    def __nodes(self, nodes, variable='p'):
+        return [{variable: self.graph.properties(int(node))} for node in nodes]
+
+    def find_patient(self, patient_id):
+        node = self.graph.patient_node(patient_id)
+        return [] if node is None else self.__nodes([node], 'n')
+
+    def find_patient_by_seizure(self, seizure):
+        return self.__nodes(self.graph.patients_of('seizures', [seizure]))
+
+    def find_patient_by_study(self, study):
+        return self.__nodes(self.graph.patients_of('studies', [study]))
+
+    def stream_patients_by_seizure(self, seizure, fetch_size=1000):
+        for node in self.graph.patients_of('seizures', [seizure]):
+            yield {'p': self.graph.properties(int(node))}
+
+    def stream_patients_by_study(self, study, fetch_size=1000):
+        for node in self.graph.patients_of('studies', [study]):
+            yield {'p': self.graph.properties(int(node))}
+
+    def find_patients(self, patient_ids):
+        return {patient_id: [record['n'] for record in self.find_patient(patient_id)]
+                for patient_id in dict.fromkeys(patient_ids)}
+
+    def find_patients_by_seizures(self, seizures):
+        return {seizure: [record['p'] for record in self.find_patient_by_seizure(seizure)]
+                for seizure in dict.fromkeys(seizures)}
+
+    def find_patients_by_studies(self, studies):
+        return {study: [record['p'] for record in self.find_patient_by_study(study)]
+                for study in dict.fromkeys(studies)}
+
+    def find_cohort(self, all_of=None, any_of=None, none_of=None):
+        selected = np.ones(len(self.graph.patient_index), dtype=bool)
+        for operation, filters in (('all', all_of), ('any', any_of), ('none', none_of)):
+            for kind, names in (filters or {}).items():
+                if kind not in api.COHORT_PATTERNS:
+                    raise ValueError(f"Unknown cohort filter {kind}, expected one of {list(api.COHORT_PATTERNS)}")
+                names = list(dict.fromkeys(names))
+                if operation == 'all':
+                    for name in names:
+                        selected &= self.__mask(kind, [name])
+                elif operation == 'any':
+                    selected &= self.__mask(kind, names)
+                else:
+                    selected &= ~self.__mask(kind, names)
+        return self.__nodes(np.flatnonzero(selected))
+
+    def __mask(self, kind, names):
+        mask = np.zeros(len(self.graph.patient_index), dtype=bool)
+        mask[self.graph.patients_of(kind, names)] = True
+        return mask
+
+    def find_patient_by_dob(self, dob):
+        column = self.graph.patient_properties.get('date_of_birth')
+        if column is None:
+            return []
+        return self.__nodes(np.flatnonzero(column.astype('datetime64[D]') == np.datetime64(pd.Timestamp(dob).date())))
+
+    def patient_counts(self, kind):
+        label, relationship, diagnosis = REFERENCES[kind]
+        start = self.graph.starts[label]
+        names = self.graph.reference_names[label]
+        degree = self.graph.reverse[relationship].degree()[start:start + len(names)]
+        return pd.Series(degree, index=names, name='patients')
+
+    def co_occurrence(self, first, second):
+        matrices = []
+        for kind in (first, second):
+            label = REFERENCES[kind][0]
+            names = self.graph.reference_names[label]
+            matrix = np.zeros((len(self.graph.patient_index), len(names)), dtype=np.int64)
+            for column, name in enumerate(names):
+                matrix[self.graph.patients_of(kind, [name]), column] = 1
+            matrices.append(matrix)
+        return pd.DataFrame(matrices[0].T @ matrices[1], index=self.graph.reference_names[REFERENCES[first][0]],
+                            columns=self.graph.reference_names[REFERENCES[second][0]])
+
+    # Date range lookups over the event columns, see DatabaseAPI.find_events_between and find_event_gaps
+
+    def find_events_between(self, start, end, event_name=None):
+        graph = self.graph
+        selected = ((graph.event_dates >= np.datetime64(pd.Timestamp(start).date()))
+                    & (graph.event_dates <= np.datetime64(pd.Timestamp(end).date())))
+        if event_name is not None:
+            selected &= self.__event_mask(event_name)
+        events = np.flatnonzero(selected)
+        events = events[np.argsort(graph.event_dates[events], kind='stable')]
+        return [{'id': int(graph.patient_properties['id'][graph.event_owners[event]]),
+                 'e': graph.properties(int(event) + graph.starts['Event'])} for event in events]
+
+    def find_patient_events_between(self, patient_id, start, end):
+        events = self.__events(patient_id)
+        dates = self.graph.event_dates[events - self.graph.starts['Event']]
+        selected = ((dates >= np.datetime64(pd.Timestamp(start).date()))
+                    & (dates <= np.datetime64(pd.Timestamp(end).date())))
+        events = events[selected][np.argsort(dates[selected], kind='stable')]
+        return self.__nodes(events, 'e')
+
+    def find_event_gaps(self, first, second, min_days=0, max_days=None):
+        graph = self.graph
+        frames = []
+        for name in (first, second):
+            events = np.flatnonzero(self.__event_mask(name))
+            frames.append(pd.DataFrame({'owner': graph.event_owners[events], 'date': graph.event_dates[events]}))
+        pairs = frames[0].merge(frames[1], on='owner', suffixes=('_first', '_second'))
+        pairs['gap'] = (pairs['date_second'] - pairs['date_first']).dt.days
+        pairs = pairs[pairs['gap'] >= min_days]
+        if max_days is not None:
+            pairs = pairs[pairs['gap'] <= max_days]
+        pairs['id'] = graph.patient_properties['id'][pairs['owner'].to_numpy()]
+        pairs = pairs.sort_values(['id', 'date_first', 'date_second'], kind='mergesort')
+        return [{'id': int(patient), 'first': first_date.date(), 'second': second_date.date(), 'gap': int(gap)}
+                for patient, first_date, second_date, gap in zip(pairs['id'], pairs['date_first'],
+                                                                 pairs['date_second'], pairs['gap'])]
+
+    def __event_mask(self, event_name):
+        if event_name not in self.graph.event_vocabulary:
+            return np.zeros(len(self.graph.event_names), dtype=bool)
+        return self.graph.event_names == self.graph.event_vocabulary.index(event_name)
+
+    # Timeline lookups, answered from the event chain whether or not a skip list was configured for the import
+
+    def __events(self, patient_id, event_name=None):
+        node = self.graph.patient_node(patient_id)
+        if node is None:
+            return np.zeros(0, dtype=np.int64)
+        events = self.graph.events_of(node)
+        if event_name is not None and event_name in self.graph.event_vocabulary:
+            code = self.graph.event_vocabulary.index(event_name)
+            events = events[self.graph.event_names[events - self.graph.starts['Event']] == code]
+        elif event_name is not None:
+            events = events[:0]
+        return events
+
+    def find_patient_events(self, patient_id, event_name):
+        events = self.__events(patient_id, event_name)
+        order = np.argsort(self.graph.event_dates[events - self.graph.starts['Event']], kind='stable')
+        return self.__nodes(events[order], 'e')
+
+    def scan_patient_events(self, patient_id, event_name):
+        return self.find_patient_events(patient_id, event_name)
+
+    def find_first_patient_event(self, patient_id, event_name):
+        return self.__nodes(self.__events(patient_id, event_name)[:1], 'e')
+
+    def find_patients_by_event(self, event_name):
+        if event_name not in self.graph.event_vocabulary:
+            return []
+        events = np.flatnonzero(self.graph.event_names == self.graph.event_vocabulary.index(event_name))
+        return self.__nodes(np.unique(self.graph.event_owners[events]))
+
+    # The express lanes are not needed in memory, the chain is addressed directly; the arguments are kept for
+    # compatibility with DatabaseAPI.find_patient_event_at
+    def find_patient_event_at(self, patient_id, position, express_step=None, level=None):
+        node = self.graph.patient_node(patient_id)
+        if node is None:
+            return []
+        events = self.graph.events_of(node)
+        return self.__nodes(events[position:position + 1], 'e')
+
+    def find_last_patient_event(self, patient_id):
+        node = self.graph.patient_node(patient_id)
+        if node is None:
+            return []
+        return self.__nodes(self.graph.adjacency['last'].neighbors(node), 'e')
+
+
+# Builds the embedded graph from the input directory main.main imports
+def load(parser, path):
+    import main
+    return MemoryGraph(parser, *main.read_all_files(path))
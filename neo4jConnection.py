@@ -1,35 +1,128 @@
+import timeit
 from neo4j import GraphDatabase
 
 
 class Neo4jConnection:
 
-    def __init__(self, uri, user, pwd):
+    # driver_config is passed on to the driver, e.g. max_connection_pool_size, connection_acquisition_timeout
+    # and max_transaction_retry_time as read by main.read_driver_config. With an instrumentation.Instrumentation
+    # every query is timed and its ResultSummary recorded per query template.
+    def __init__(self, uri, user, pwd, instrumentation=None, **driver_config):
         self.__uri = uri
         self.__user = user
         self.__pwd = pwd
+        self.__driver_config = driver_config
         self.__driver = None
+        self.instrumentation = instrumentation
         self.connect_db()
 
     def connect_db(self):
         try:
-            self.__driver = GraphDatabase.driver(self.__uri, auth=(self.__user, self.__pwd))
+            self.__driver = GraphDatabase.driver(self.__uri, auth=(self.__user, self.__pwd), **self.__driver_config)
         except Exception as e:
             print("Unable to create driver:", e)
 
     def close(self):
         if self.__driver is not None:
             self.__driver.close()
+        if self.instrumentation is not None:
+            self.instrumentation.export()
 
-    def run_query(self, query):
-        result = None
+    # Runs the query in its own session and returns the fully consumed list of records
+    def run_query(self, query, parameters=None):
+        records, summary = self.fetch_all(query, parameters)
+        return records
+
+    # Fully consumes the result inside the session, returns the records together with the ResultSummary
+    # holding the server timings (result_available_after, result_consumed_after) and counters
+    def fetch_all(self, query, parameters=None):
+        records = None
+        summary = None
+        if self.__driver is not None:
+            with self.__driver.session() as session:
+                records, summary = self.__execute(session, query, parameters)
+        else:
+            print("Driver not initialized")
+        return records, summary
+
+    # Yields the records one at a time while the session stays open, the driver pulls them from the server
+    # in batches of fetch_size so only one batch is held in memory at a time
+    def stream(self, query, parameters=None, fetch_size=1000):
+        if self.__driver is None:
+            print("Driver not initialized")
+            return
+        with self.__driver.session(fetch_size=fetch_size) as session:
+            if self.instrumentation is None:
+                result = session.run(query, parameters)
+                for record in result:
+                    yield record
+                return
+            start = timeit.default_timer()
+            result = session.run(self.instrumentation.prepare(query), parameters)
+            sent = first = timeit.default_timer()
+            records = 0
+            for record in result:
+                if records == 0:
+                    first = timeit.default_timer()
+                records += 1
+                yield record
+            summary = result.consume()
+            # The consume phase includes the time the caller spent on the yielded records
+            self.instrumentation.record(query, (sent - start, first - sent, timeit.default_timer() - first),
+                                        records, summary)
+
+    # Entries are either plain query strings or (query, parameters) tuples. With a transaction_size of 0 every
+    # query is auto-committed on its own, otherwise the list is sent over one session in managed write
+    # transactions of transaction_size queries each, which the driver retries on transient errors.
+    def run_query_list(self, queries, transaction_size=0):
+        if transaction_size <= 0:
+            for query in queries:
+                if isinstance(query, tuple):
+                    self.run_query(*query)
+                elif query:
+                    self.run_query(query)
+            return
+        queries = [query for query in queries if query]
         if self.__driver is not None:
             with self.__driver.session() as session:
-                result = session.run(query)
+                for start in range(0, len(queries), transaction_size):
+                    session.execute_write(self.__run_transaction, queries[start:start + transaction_size])
         else:
             print("Driver not initialized")
-        return result
 
-    def run_query_list(self, queries):
+    def __run_transaction(self, tx, queries):
         for query in queries:
-            if query:
-                self.run_query(query)
+            if isinstance(query, tuple):
+                self.__execute(tx, *query, keep_records=False)
+            else:
+                self.__execute(tx, query, keep_records=False)
+
+    # Runs the query on a session or transaction and returns the records (None without keep_records) and the
+    # ResultSummary
+    def __execute(self, runner, query, parameters=None, keep_records=True):
+        if self.instrumentation is None:
+            result = runner.run(query, parameters)
+            records = list(result) if keep_records else None
+            return records, result.consume()
+        start = timeit.default_timer()
+        result = runner.run(self.instrumentation.prepare(query), parameters)
+        sent = timeit.default_timer()
+        result.peek()
+        first = timeit.default_timer()
+        records = list(result) if keep_records else None
+        summary = result.consume()
+        self.instrumentation.record(query, (sent - start, first - sent, timeit.default_timer() - first),
+                                    len(records) if keep_records else 0, summary)
+        return records, summary
+
+    # Sends the rows to an UNWIND $rows statement in chunks of batch_size and returns the number of batches
+    def run_batched(self, query, rows, batch_size):
+        batches = 0
+        if self.__driver is not None:
+            with self.__driver.session() as session:
+                for start in range(0, len(rows), batch_size):
+                    session.execute_write(self.__run_transaction, [(query, {'rows': rows[start:start + batch_size]})])
+                    batches += 1
+        else:
+            print("Driver not initialized")
+        return batches
@@ -0,0 +1,115 @@
+import concurrent.futures
+import os
+import pandas as pd
+import timeit
+import graphParser as gp
+import main as org
+
+
+# Dependency aware import pipeline. The four input files are parsed in parallel in a process pool while the
+# reference nodes are written, every write stage starts as soon as the stages it requires have finished and at
+# most `writers` stages write to the database at the same time, each over its own session.
+
+class Stage:
+
+    def __init__(self, name, function, requires=(), pool="write"):
+        self.name = name
+        self.function = function
+        self.requires = tuple(requires)
+        self.pool = pool
+
+
+def parse_input(kind, filename):
+    parser = gp.GraphParser()
+    if kind == "patients":
+        return parser.parse_patient_rows(org.read_patient_csv(filename))
+    if kind == "studies":
+        return parser.parse_study_rows(pd.read_csv(filename))
+    if kind == "events":
+        return parser.parse_event_rows(org.read_event_csv(filename))
+    if kind == "epilepsy":
+        # The terms outside the vocabulary are counted in this process, they travel back with the rows
+        return parser.parse_epilepsy_rows(pd.read_csv(filename)) + (parser.unknown_terms,)
+    raise ValueError(f"Unknown input kind: {kind}")
+
+
+def create_import_stages(db, parser, path, batch_size, process_pool):
+    files = {"patients": "patient.csv", "studies": "protocols.csv", "events": "events.csv", "epilepsy": "summary.csv"}
+
+    def parse(kind):
+        return lambda results: process_pool.submit(parse_input, kind, os.path.join(path, files[kind])).result()
+
+    def write(query, source, position=None):
+        def function(results):
+            rows = results[source] if position is None else results[source][position]
+            return db.run_batched(query, rows, batch_size)
+        return function
+
+    def write_reference(results):
+        queries = parser.create_studies() + parser.create_medications() + parser.create_epilepsy_nodes()
+        db.run_query_list(queries, len(queries))
+
+    stages = [Stage(f"parse {kind}", parse(kind), pool="parse") for kind in files]
+    stages += [
+        Stage("reference nodes", write_reference),
+        Stage("patients", write(gp.PATIENT_BATCH_QUERY, "parse patients"), ["parse patients"]),
+        Stage("study links", write(gp.STUDY_BATCH_QUERY, "parse studies"), ["parse studies", "patients", "reference nodes"]),
+        Stage("events", write(parser.event_batch_query(), "parse events"), ["parse events", "patients"]),
+        Stage("seizure links", write(gp.SEIZURE_BATCH_QUERY, "parse epilepsy", 0),
+              ["parse epilepsy", "patients", "reference nodes"]),
+        Stage("lateralization links", write(gp.LATERALIZATION_BATCH_QUERY, "parse epilepsy", 1),
+              ["parse epilepsy", "patients", "reference nodes"]),
+        Stage("medication links", write(gp.MEDICATION_BATCH_QUERY, "parse epilepsy", 2),
+              ["parse epilepsy", "patients", "reference nodes"]),
+    ]
+    return stages
+
+
+def timed(function, results):
+    start = timeit.default_timer()
+    value = function(results)
+    end = timeit.default_timer()
+    return value, end - start
+
+
+# Runs every stage once all the stages named in its requires have finished and returns the wall time and the
+# result per stage
+def run_stages(stages, executors):
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        missing = [name for name in stage.requires if name not in names]
+        if missing:
+            raise ValueError(f"Stage {stage.name} requires unknown stages: {missing}")
+    results = {}
+    times = {}
+    pending = list(stages)
+    running = {}
+    while pending or running:
+        for stage in list(pending):
+            if all(name in results for name in stage.requires):
+                running[executors[stage.pool].submit(timed, stage.function, results)] = stage
+                pending.remove(stage)
+        if not running:
+            raise ValueError(f"Circular stage dependencies: {[stage.name for stage in pending]}")
+        finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in finished:
+            stage = running.pop(future)
+            results[stage.name], times[stage.name] = future.result()
+    return times, results
+
+
+# Returns the wall time and the result of every stage, the parse stages' results being the parsed rows
+def run_pipeline(db, parser, path, batch_size, writers):
+    start = timeit.default_timer()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as process_pool, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=4) as parse_threads, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=writers) as write_threads:
+        stages = create_import_stages(db, parser, path, batch_size, process_pool)
+        times, results = run_stages(stages, {"parse": parse_threads, "write": write_threads})
+    end = timeit.default_timer()
+    for kind, counter in results["parse epilepsy"][3].items():
+        parser.unknown_terms[kind].update(counter)
+    for stage in stages:
+        print(f"{stage.name:<22} {times[stage.name]:8.3f}s")
+    print(f"{'total':<22} {end - start:8.3f}s")
+    return times, results
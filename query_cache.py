@@ -0,0 +1,73 @@
+import collections
+import threading
+import time
+
+
+# Read-through cache for query results, keyed on the query template and its parameters. The size is bounded by
+# evicting the least recently used entry and every entry expires ttl seconds after it was stored.
+
+class QueryCache:
+
+    def __init__(self, max_size=1024, ttl=60.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.__entries = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(query, parameters):
+        return query, tuple(sorted((name, tuple(value) if isinstance(value, list) else value)
+                                   for name, value in (parameters or {}).items()))
+
+    def get(self, query, parameters, load):
+        key = self.key(query, parameters)
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                stored, value = entry
+                if time.monotonic() - stored <= self.ttl:
+                    self.__entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.__entries[key]
+                self.expirations += 1
+            self.misses += 1
+        value = load()
+        with self.__lock:
+            self.__entries[key] = (time.monotonic(), value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.max_size:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    # Drops the entries of the given patients and every entry that is not keyed on a single patient (cohort
+    # lookups), since a changed patient can enter or leave any cohort. Without ids everything is dropped.
+    def invalidate_patients(self, patient_ids=None):
+        with self.__lock:
+            if patient_ids is None:
+                self.invalidations += len(self.__entries)
+                self.__entries.clear()
+                return
+            patient_ids = set(patient_ids)
+            for key in list(self.__entries):
+                parameters = dict(key[1])
+                if 'id' not in parameters or parameters['id'] in patient_ids:
+                    del self.__entries[key]
+                    self.invalidations += 1
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'size': len(self.__entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+            }
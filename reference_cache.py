@@ -0,0 +1,164 @@
+import collections
+import threading
+import graphParser as gp
+
+
+# Element ids of the nodes the relationship statements link to. The reference nodes (fewer than a hundred) and
+# the Patient/Diagnosis pair of the patients seen last are resolved once and kept in process, so the links are
+# written by id with two id seeks per edge instead of a Patient index seek, the diagnosed expansion and a name
+# index seek for every row.
+
+RESOLVE_REFERENCES_QUERY = "MATCH (n:{label}) WHERE n.name IN $names RETURN n.name AS name, elementId(n) AS element_id"
+RESOLVE_PATIENTS_QUERY = (
+    "UNWIND $ids AS id "
+    "MATCH (p:Patient {id: id})-[:diagnosed]->(d:Diagnosis) "
+    "RETURN id, elementId(p) AS patient, elementId(d) AS diagnosis"
+)
+LINK_BY_ID_QUERY = (
+    "UNWIND $rows AS row "
+    "MATCH (a) WHERE elementId(a) = row.source "
+    "MATCH (b) WHERE elementId(b) = row.target "
+    "MERGE (a)-[:{relationship}]->(b)"
+)
+
+# Label of the reference node, relationship type and whether the link starts at the patient's diagnosis, for the
+# rows of parse_study_rows and the three lists of parse_epilepsy_rows
+LINKS = {
+    'studies': ('Study', 'consents', False),
+    'seizures': ('Seizure', 'experiences', True),
+    'lateralizations': ('Lateralization', 'localized', True),
+    'medications': ('Medication', 'takes', True),
+}
+
+# Name based statements of the same links, used without a cache
+LINK_QUERIES = {
+    'studies': gp.STUDY_BATCH_QUERY,
+    'seizures': gp.SEIZURE_BATCH_QUERY,
+    'lateralizations': gp.LATERALIZATION_BATCH_QUERY,
+    'medications': gp.MEDICATION_BATCH_QUERY,
+}
+
+
+NODE_LABELS = {
+    gp.STUDY_NODE_BATCH_QUERY: 'Study',
+    gp.MEDICATION_NODE_BATCH_QUERY: 'Medication',
+    gp.SEIZURE_NODE_BATCH_QUERY: 'Seizure',
+    gp.LATERALIZATION_NODE_BATCH_QUERY: 'Lateralization',
+}
+
+
+# Names of the reference nodes by label, as created by the statements of create_studies, create_medications and
+# create_epilepsy_nodes
+def reference_names(parser):
+    names = {}
+    for query, parameters in parser.create_studies() + parser.create_medications() + parser.create_epilepsy_nodes():
+        names.setdefault(NODE_LABELS[query], []).extend(row['name'] for row in parameters['rows'])
+    return {label: list(dict.fromkeys(label_names)) for label, label_names in names.items()}
+
+
+class ReferenceCache:
+
+    # max_patients bounds the number of patients whose element ids are kept, least recently used ones are dropped
+    def __init__(self, connection, max_patients=100000):
+        self.connection = connection
+        self.max_patients = max_patients
+        self.__references = {}
+        self.__names = None
+        self.__patients = collections.OrderedDict()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Called after the reference nodes are created. The reference ids are reloaded whenever the names returned by
+    # create_studies / create_medications / create_epilepsy_nodes differ from the ones they were loaded for.
+    def sync(self, parser):
+        names = reference_names(parser)
+        if names == self.__names:
+            return
+        references = {}
+        for label, label_names in names.items():
+            records = self.connection.run_query(RESOLVE_REFERENCES_QUERY.format(label=label), {'names': label_names})
+            references[label] = {record['name']: record['element_id'] for record in records or []}
+        with self.__lock:
+            self.__references = references
+            self.__names = names
+
+    # Patients deleted or recreated by an import, their element ids may be reused by new nodes
+    def invalidate_patients(self, patient_ids=None):
+        with self.__lock:
+            if patient_ids is None:
+                self.__patients.clear()
+                return
+            for patient_id in patient_ids:
+                self.__patients.pop(patient_id, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__references = {}
+            self.__names = None
+            self.__patients.clear()
+
+    # (patient, diagnosis) element ids of the given patients, the ones not cached are resolved in one query
+    def patients(self, patient_ids):
+        resolved = {}
+        missing = []
+        with self.__lock:
+            for patient_id in dict.fromkeys(patient_ids):
+                entry = self.__patients.get(patient_id)
+                if entry is None:
+                    missing.append(patient_id)
+                else:
+                    self.__patients.move_to_end(patient_id)
+                    resolved[patient_id] = entry
+            self.hits += len(resolved)
+            self.misses += len(missing)
+        if missing:
+            records = self.connection.run_query(RESOLVE_PATIENTS_QUERY, {'ids': missing}) or []
+            with self.__lock:
+                for record in records:
+                    entry = (record['patient'], record['diagnosis'])
+                    resolved[record['id']] = entry
+                    self.__patients[record['id']] = entry
+                while len(self.__patients) > self.max_patients:
+                    self.__patients.popitem(last=False)
+        return resolved
+
+    # The {'id', 'name'} rows of a link kind as {'source', 'target'} element id rows. Rows whose patient or
+    # reference node does not exist are left out, like the MATCH of the name based statements does.
+    def link_rows(self, kind, rows):
+        label, relationship, diagnosis = LINKS[kind]
+        references = self.__references.get(label, {})
+        patients = self.patients(row['id'] for row in rows)
+        link_rows = []
+        for row in rows:
+            entry = patients.get(row['id'])
+            target = references.get(row['name'])
+            if entry is not None and target is not None:
+                link_rows.append({'source': entry[1] if diagnosis else entry[0], 'target': target})
+        return link_rows
+
+    # Writes the links of kind in batches of batch_size rows, resolving the patients of one batch at a time
+    def write_links(self, db, kind, rows, batch_size):
+        query = LINK_BY_ID_QUERY.format(relationship=LINKS[kind][1])
+        batches = 0
+        for start in range(0, len(rows), batch_size):
+            batches += db.run_batched(query, self.link_rows(kind, rows[start:start + batch_size]), batch_size)
+        return batches
+
+    def stats(self):
+        with self.__lock:
+            return {'references': sum(len(names) for names in self.__references.values()),
+                    'patients': len(self.__patients), 'hits': self.hits, 'misses': self.misses}
+
+
+# Writes the links by element id when references is a ReferenceCache and by name when it is None
+def write_links(db, references, kind, rows, batch_size):
+    if references is None:
+        return db.run_batched(LINK_QUERIES[kind], rows, batch_size)
+    return references.write_links(db, kind, rows, batch_size)
+
+
+def write_epilepsy_links(db, references, seizure_rows, lateralization_rows, medication_rows, batch_size):
+    write_links(db, references, 'seizures', seizure_rows, batch_size)
+    write_links(db, references, 'lateralizations', lateralization_rows, batch_size)
+    write_links(db, references, 'medications', medication_rows, batch_size)
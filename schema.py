@@ -0,0 +1,195 @@
+import contextlib
+import re
+import time
+
+
+# Single declaration of the graph schema. Every entry maps the index or constraint name to its label and
+# properties; the uniqueness constraints also provide the index the importer's MATCH/MERGE lookups use, so the
+# same properties are not indexed a second time.
+
+CONSTRAINTS = {
+    'patients': ('Patient', ['id']),
+    'studies': ('Study', ['name']),
+    'seizures': ('Seizure', ['name']),
+    'lateralizations': ('Lateralization', ['name']),
+    'medications': ('Medication', ['name']),
+}
+
+INDEXES = {
+    'event_name_index': ('Event', ['name']),
+    'event_date_index': ('Event', ['date']),
+    'event_name_date_index': ('Event', ['name', 'date']),
+    'diagnosis_name_index': ('Diagnosis', ['name']),
+    'patient_dob_index': ('Patient', ['date_of_birth']),
+}
+
+# Indexes no import statement reads from, they only slow the event writes down and can be built after a bulk load
+DEFERRABLE_INDEXES = ['event_name_index', 'event_date_index', 'event_name_date_index']
+
+SHOW_INDEXES_QUERY = (
+    "SHOW INDEXES YIELD name, type, entityType, labelsOrTypes, properties, state, owningConstraint "
+    "WHERE entityType = 'NODE' AND type <> 'LOOKUP' "
+    "RETURN name, labelsOrTypes, properties, state, owningConstraint"
+)
+SHOW_CONSTRAINTS_QUERY = "SHOW CONSTRAINTS YIELD name, labelsOrTypes, properties RETURN name, labelsOrTypes, properties"
+
+
+def index_query(name, label, properties):
+    keys = ", ".join(f"n.{key}" for key in properties)
+    return f"CREATE INDEX {name} IF NOT EXISTS FOR (n:{label}) ON ({keys})"
+
+
+def constraint_query(name, label, properties):
+    keys = ", ".join(f"n.{key}" for key in properties)
+    if len(properties) > 1:
+        keys = f"({keys})"
+    return f"CREATE CONSTRAINT {name} IF NOT EXISTS FOR (n:{label}) REQUIRE {keys} IS UNIQUE"
+
+
+class SchemaManager:
+
+    def __init__(self, connection, indexes=None, constraints=None):
+        self.connection = connection
+        self.indexes = INDEXES if indexes is None else indexes
+        self.constraints = CONSTRAINTS if constraints is None else constraints
+
+    # The schema is compared on label and properties, so an index created under another name still counts
+    def existing_indexes(self):
+        records = self.connection.run_query(SHOW_INDEXES_QUERY) or []
+        return {record['name']: (record['labelsOrTypes'][0], list(record['properties']), record['state'],
+                                 record['owningConstraint']) for record in records}
+
+    def existing_constraints(self):
+        records = self.connection.run_query(SHOW_CONSTRAINTS_QUERY) or []
+        return {record['name']: (record['labelsOrTypes'][0], list(record['properties'])) for record in records}
+
+    # Returns the declared indexes and constraints missing from the database and the ones in the database that
+    # are not declared here (indexes backing a constraint are left out)
+    def diff(self):
+        indexes = {name: (label, properties) for name, (label, properties, state, owner)
+                   in self.existing_indexes().items() if owner is None}
+        constraints = self.existing_constraints()
+        index_schemas = {(label, tuple(properties)) for label, properties in indexes.values()}
+        constraint_schemas = {(label, tuple(properties)) for label, properties in constraints.values()}
+        declared_indexes = {(label, tuple(properties)) for label, properties in self.indexes.values()}
+        declared_constraints = {(label, tuple(properties)) for label, properties in self.constraints.values()}
+        return {
+            'missing_indexes': [name for name, (label, properties) in self.indexes.items()
+                                if (label, tuple(properties)) not in index_schemas],
+            'missing_constraints': [name for name, (label, properties) in self.constraints.items()
+                                    if (label, tuple(properties)) not in constraint_schemas],
+            'unknown_indexes': [name for name, (label, properties) in indexes.items()
+                                if (label, tuple(properties)) not in declared_indexes],
+            'unknown_constraints': [name for name, (label, properties) in constraints.items()
+                                    if (label, tuple(properties)) not in declared_constraints],
+        }
+
+    # Creates what is missing, with drop_unknown also drops what is not declared, and returns the diff it applied
+    def apply(self, drop_unknown=False, wait=True, timeout=300):
+        changes = self.diff()
+        # A plain index on the schema of a missing constraint blocks the constraint from being created
+        blocking = {(label, tuple(properties)) for name, (label, properties) in self.constraints.items()
+                    if name in changes['missing_constraints']}
+        for name, (label, properties, state, owner) in self.existing_indexes().items():
+            if owner is None and (label, tuple(properties)) in blocking:
+                self.connection.run_query(f"DROP INDEX {name} IF EXISTS")
+        if drop_unknown:
+            for name in changes['unknown_indexes']:
+                self.connection.run_query(f"DROP INDEX {name} IF EXISTS")
+            for name in changes['unknown_constraints']:
+                self.connection.run_query(f"DROP CONSTRAINT {name} IF EXISTS")
+        for name in changes['missing_constraints']:
+            self.connection.run_query(constraint_query(name, *self.constraints[name]))
+        for name in changes['missing_indexes']:
+            self.connection.run_query(index_query(name, *self.indexes[name]))
+        if wait:
+            self.wait_online(timeout)
+        return changes
+
+    def create_indexes(self, names=None):
+        for name in self.indexes if names is None else names:
+            self.connection.run_query(index_query(name, *self.indexes[name]))
+
+    def create_constraints(self, names=None):
+        for name in self.constraints if names is None else names:
+            self.connection.run_query(constraint_query(name, *self.constraints[name]))
+
+    def drop_indexes(self, names=None):
+        for name in self.indexes if names is None else names:
+            self.connection.run_query(f"DROP INDEX {name} IF EXISTS")
+
+    # Also drops the index backing each constraint, create_constraints builds it again
+    def drop_constraints(self, names=None):
+        for name in self.constraints if names is None else names:
+            self.connection.run_query(f"DROP CONSTRAINT {name} IF EXISTS")
+
+    # Indexes are populated in the background after CREATE INDEX, queries planned before they are ONLINE fall
+    # back to label scans. Raises RuntimeError on a FAILED index and TimeoutError after timeout seconds.
+    def wait_online(self, timeout=300, interval=0.5):
+        deadline = time.monotonic() + timeout
+        while True:
+            states = {name: state for name, (label, properties, state, owner) in self.existing_indexes().items()}
+            failed = [name for name, state in states.items() if state == 'FAILED']
+            if failed:
+                raise RuntimeError(f"Indexes failed to populate: {', '.join(failed)}")
+            pending = [name for name, state in states.items() if state != 'ONLINE']
+            if not pending:
+                return
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Indexes not online after {timeout}s: {', '.join(pending)}")
+            time.sleep(interval)
+
+    # Drops the deferrable indexes for the duration of a bulk load and rebuilds them afterwards:
+    #   with SchemaManager(db).bulk_load():
+    #       main.load_batched(...)
+    @contextlib.contextmanager
+    def bulk_load(self, timeout=300):
+        deferred = [name for name in DEFERRABLE_INDEXES if name in self.indexes]
+        self.apply(wait=True, timeout=timeout)
+        self.drop_indexes(deferred)
+        try:
+            yield self
+        finally:
+            self.create_indexes(deferred)
+            self.wait_online(timeout)
+
+    # Label/property pairs the given query templates look nodes up by that no declared or existing index or
+    # constraint covers, returned as the CREATE INDEX statements that would add them
+    def suggest(self, queries=None, existing=True):
+        covered = {(label, properties[0]) for label, properties in
+                   list(self.indexes.values()) + list(self.constraints.values())}
+        if existing:
+            covered |= {(label, properties[0]) for label, properties, state, owner
+                        in self.existing_indexes().values()}
+        suggestions = []
+        for label, key in lookups(query_templates() if queries is None else queries):
+            if (label, key) not in covered:
+                covered.add((label, key))
+                name = f"{label.lower()}_{key.lower()}_index"
+                suggestions.append(index_query(name, label, [key]))
+        return suggestions
+
+
+# Module level *_QUERY templates of the import and lookup modules
+def query_templates():
+    import database_api
+    import graphParser
+    import incremental
+    templates = []
+    for module in (graphParser, database_api, incremental):
+        templates += [value for name, value in vars(module).items() if name.endswith('_QUERY') and isinstance(value, str)]
+    return templates
+
+
+# (label, property) pairs a query filters on, from inline maps like (p:Patient {id: $id}) and from WHERE
+# predicates like p.id = $id / s.name IN $names / e.date >= $start on a variable bound to a label
+def lookups(queries):
+    found = []
+    for query in queries:
+        labels = dict(re.findall(r"\((\w+):(\w+)", query))
+        for label, keys in re.findall(r"\(\w*:(\w+)\s*\{([^}]*)\}", query):
+            found += [(label, key) for key in re.findall(r"(\w+)\s*:", keys)]
+        for variable, key in re.findall(r"\b(\w+)\.(\w+)\s*(?:=|IN\b|<|>|STARTS\b)", query):
+            if variable in labels:
+                found.append((labels[variable], key))
+    return list(dict.fromkeys(found))
@@ -0,0 +1,282 @@
+import os
+import numpy as np
+import aggregates
+
+
+# Patient x feature matrix for "patients most like this one" searches. A feature is a (kind, name) pair: the
+# studies, seizures, lateralizations and medications of a patient and the types of the events in its history.
+# Every patient is one bit-packed row, padded to whole 64 bit words, filled from the same rows
+# GraphParser.parse_study_rows / parse_epilepsy_rows / parse_event_rows produce for the import. Scores are the
+# Jaccard or cosine similarity of the feature sets, computed for all patients at once from the popcount of the
+# AND of the rows, so no query traverses Patient -> Diagnosis.
+
+KINDS = aggregates.KINDS + ['events']
+METRICS = ['jaccard', 'cosine']
+
+# Patients unpacked per matrix product and query patients per product of a batched search, they bound the
+# memory of a search to QUERY_ROWS x patients intersection counts
+BLOCK_ROWS = 65536
+QUERY_ROWS = 256
+
+M1 = np.uint64(0x5555555555555555)
+M2 = np.uint64(0x3333333333333333)
+M4 = np.uint64(0x0f0f0f0f0f0f0f0f)
+H01 = np.uint64(0x0101010101010101)
+
+
+# Number of set bits of every uint64 (SWAR, NumPy has no vectorized popcount before 2.0)
+def popcount(words):
+    words = words - ((words >> np.uint64(1)) & M1)
+    words = (words & M2) + ((words >> np.uint64(2)) & M2)
+    words = (words + (words >> np.uint64(4))) & M4
+    return (words * H01) >> np.uint64(56)
+
+
+def row_popcount(words):
+    return popcount(words).sum(axis=1, dtype=np.int64)
+
+
+# Scores of every (shared, size) pair, flattened as shared * width + size, against a patient with query_size
+# features
+def score_table(width, query_size, metric):
+    shared, sizes = np.divmod(np.arange(width * width, dtype=np.float64), width)
+    if metric == 'jaccard':
+        union = sizes + query_size - shared
+    else:
+        union = np.sqrt(sizes * query_size)
+    scores = np.zeros(width * width)
+    # Pairs with more shared features than either side has can not occur and keep a score of zero
+    np.divide(shared, union, out=scores, where=(union > 0) & (shared <= sizes) & (shared <= query_size))
+    return scores
+
+
+# The event rows of parse_event_rows as {'id', 'name'} rows with one row per event type of a patient
+def event_features(event_rows):
+    rows = []
+    for row in event_rows:
+        rows += [{'id': row['id'], 'name': name} for name in dict.fromkeys(event['name'] for event in row['events'])]
+    return rows
+
+
+class FeatureMatrix:
+
+    # names maps every kind to the names known up front, unknown names get a column when seen
+    def __init__(self, names=None):
+        names = names or {}
+        self.__features = []
+        self.__columns = {}
+        self.__words = np.zeros((0, 1), dtype=np.uint64)
+        self.__ids = np.zeros(0, dtype=np.int64)
+        self.__sizes = np.zeros(0, dtype=np.int64)
+        self.__patients = {}
+        self.__free = []
+        for kind in KINDS:
+            self.__add_columns(kind, names.get(kind, []))
+
+    @classmethod
+    def from_parser(cls, parser):
+        return cls({
+            'studies': parser.study_protocol_dict.values(),
+            'seizures': parser.seizure_types_dict.values(),
+            'lateralizations': parser.lateralization,
+            'medications': parser.medication_list,
+        })
+
+    # (kind, name) of every column
+    def features(self):
+        return list(self.__features)
+
+    def patient_count(self):
+        return len(self.__patients)
+
+    # Replaces the features of kind of the given patients (by default the patients in rows) with rows
+    def replace(self, kind, rows, patient_ids=None):
+        if patient_ids is None:
+            patient_ids = [row['id'] for row in rows]
+        patient_ids = list(dict.fromkeys(list(patient_ids) + [row['id'] for row in rows]))
+        if not patient_ids:
+            return
+        self.__add_columns(kind, [row['name'] for row in rows])
+        positions = self.__rows(patient_ids)
+        self.__words[positions] &= ~self.__mask([kind])
+        if rows:
+            columns = np.array([self.__columns[(kind, row['name'])] for row in rows], dtype=np.int64)
+            rows_positions = np.array([self.__patients[row['id']] for row in rows], dtype=np.int64)
+            bits = np.left_shift(np.uint64(1), (columns % 64).astype(np.uint64))
+            np.bitwise_or.at(self.__words, (rows_positions, columns // 64), bits)
+        self.__sizes[positions] = row_popcount(self.__words[positions])
+
+    def update_studies(self, study_rows, patient_ids=None):
+        self.replace('studies', study_rows, patient_ids)
+
+    def update_epilepsy(self, seizure_rows, lateralization_rows, medication_rows, patient_ids=None):
+        self.replace('seizures', seizure_rows, patient_ids)
+        self.replace('lateralizations', lateralization_rows, patient_ids)
+        self.replace('medications', medication_rows, patient_ids)
+
+    def update_events(self, event_rows, patient_ids=None):
+        self.replace('events', event_features(event_rows), patient_ids)
+
+    def remove(self, patient_ids):
+        patient_ids = [patient_id for patient_id in dict.fromkeys(patient_ids) if patient_id in self.__patients]
+        if not patient_ids:
+            return
+        positions = np.array([self.__patients[patient_id] for patient_id in patient_ids])
+        self.__words[positions] = 0
+        self.__sizes[positions] = 0
+        self.__ids[positions] = -1
+        for patient_id in patient_ids:
+            self.__free.append(self.__patients.pop(patient_id))
+
+    # The (kind, name) features of a patient
+    def patient_features(self, patient_id):
+        position = self.__patients.get(patient_id)
+        if position is None:
+            return []
+        words = self.__words[position]
+        return [feature for column, feature in enumerate(self.__features)
+                if int(words[column // 64]) >> (column % 64) & 1]
+
+    # The k patients most similar to patient_id as [(patient id, score)], best first, leaving out the patient
+    # itself and patients without a shared feature. kinds restricts the features compared, e.g. ['seizures',
+    # 'medications']. An unknown patient has no similar patients.
+    def top_k(self, patient_id, k=10, metric='jaccard', kinds=None):
+        return self.top_k_many([patient_id], k, metric, kinds)[patient_id]
+
+    # top_k of many patients at once as {patient id: [(patient id, score)]}. The intersections of a batch are
+    # one matrix product per block of patients instead of one pass over the matrix per patient.
+    def top_k_many(self, patient_ids, k=10, metric='jaccard', kinds=None):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}, expected one of {', '.join(METRICS)}")
+        patient_ids = list(dict.fromkeys(patient_ids))
+        known = [patient_id for patient_id in patient_ids if patient_id in self.__patients]
+        results = {patient_id: [] for patient_id in patient_ids}
+        if not known:
+            return results
+        size = len(self.__ids)
+        queries = np.array([self.__patients[patient_id] for patient_id in known], dtype=np.int64)
+        words = self.__words[:size]
+        sizes = self.__sizes[:size]
+        if kinds is not None:
+            words = words & self.__mask(kinds)
+            sizes = row_popcount(words)
+        width = len(self.__features) + 1
+        for start in range(0, len(known), QUERY_ROWS):
+            block = queries[start:start + QUERY_ROWS]
+            shared = self.__intersections(words, words[block])
+            for patient_id, position, counts in zip(known[start:start + QUERY_ROWS], block, shared):
+                # A score only depends on the shared and the own number of features, both at most the number of
+                # features, so every row is ranked through a table of the scores of all (shared, size) pairs
+                table = score_table(width, sizes[position], metric)
+                keys = counts.astype(np.int64) * width + sizes
+                results[patient_id] = self.__best(table, keys, position, k)
+        return results
+
+    # Shared features of every query row with every row, the batch through float32 products exact up to 2^24
+    def __intersections(self, words, query_words):
+        if len(query_words) == 1:
+            return row_popcount(words & query_words[0])[np.newaxis]
+        width = len(self.__features)
+        queries = self.__unpack(query_words, width)
+        shared = np.empty((len(query_words), len(words)), dtype=np.float32)
+        for start in range(0, len(words), BLOCK_ROWS):
+            block = self.__unpack(words[start:start + BLOCK_ROWS], width)
+            np.matmul(queries, block.T, out=shared[:, start:start + BLOCK_ROWS])
+        return shared
+
+    @staticmethod
+    def __unpack(words, width):
+        as_bytes = np.ascontiguousarray(words).astype('<u8').view(np.uint8).reshape(len(words), -1)
+        return np.unpackbits(as_bytes, axis=1, count=width, bitorder='little').astype(np.float32)
+
+    # The k rows with the best scores above zero other than position, ties ordered by patient id. The score
+    # threshold is found on the counts per (shared, size) pair, so only the rows above it are sorted.
+    def __best(self, table, keys, position, k):
+        counts = np.bincount(keys, minlength=len(table))
+        counts[keys[position]] -= 1
+        ranked = np.argsort(-table, kind='stable')
+        ranked = ranked[(table[ranked] > 0) & (counts[ranked] > 0)]
+        if not len(ranked):
+            return []
+        cutoff = min(np.searchsorted(np.cumsum(counts[ranked]), k), len(ranked) - 1)
+        candidates = np.flatnonzero(table[keys] >= table[ranked[cutoff]])
+        candidates = candidates[candidates != position]
+        scores = table[keys[candidates]]
+        order = np.lexsort((self.__ids[candidates], -scores))[:k]
+        return list(zip(self.__ids[candidates[order]].tolist(), scores[order].tolist()))
+
+    def __mask(self, kinds):
+        mask = np.zeros(self.__words.shape[1], dtype=np.uint64)
+        for column, (kind, name) in enumerate(self.__features):
+            if kind in kinds:
+                mask[column // 64] |= np.uint64(1) << np.uint64(column % 64)
+        return mask
+
+    def __rows(self, patient_ids):
+        added = [patient_id for patient_id in patient_ids if patient_id not in self.__patients]
+        for patient_id in added:
+            self.__patients[patient_id] = self.__free.pop() if self.__free else len(self.__patients) + len(self.__free)
+        size = len(self.__patients) + len(self.__free)
+        capacity = len(self.__words)
+        if size > capacity:
+            capacity = max(size, 2 * capacity)
+            words = np.zeros((capacity, self.__words.shape[1]), dtype=np.uint64)
+            words[:len(self.__words)] = self.__words
+            self.__words = words
+            sizes = np.zeros(capacity, dtype=np.int64)
+            sizes[:len(self.__sizes)] = self.__sizes
+            self.__sizes = sizes
+        if size > len(self.__ids):
+            ids = np.full(size, -1, dtype=np.int64)
+            ids[:len(self.__ids)] = self.__ids
+            self.__ids = ids
+        positions = np.array([self.__patients[patient_id] for patient_id in patient_ids], dtype=np.int64)
+        self.__ids[positions] = patient_ids
+        return positions
+
+    def __add_columns(self, kind, names):
+        added = [name for name in dict.fromkeys(names) if (kind, name) not in self.__columns]
+        for name in added:
+            self.__columns[(kind, name)] = len(self.__features)
+            self.__features.append((kind, name))
+        width = (len(self.__features) + 63) // 64
+        if width > self.__words.shape[1]:
+            self.__words = np.hstack([self.__words,
+                                      np.zeros((len(self.__words), width - self.__words.shape[1]), dtype=np.uint64)])
+
+    def save(self, path):
+        patient_ids = list(self.__patients)
+        positions = np.array([self.__patients[patient_id] for patient_id in patient_ids], dtype=np.int64)
+        np.savez_compressed(aggregates.store_path(path), patient_ids=np.array(patient_ids, dtype=np.int64),
+                            kinds=np.array([kind for kind, name in self.__features], dtype=str),
+                            names=np.array([name for kind, name in self.__features], dtype=str),
+                            words=self.__words[positions].reshape(len(positions), -1))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(aggregates.store_path(path)) as arrays:
+            matrix = cls()
+            for kind, name in zip(arrays['kinds'].tolist(), arrays['names'].tolist()):
+                matrix.__add_columns(kind, [name])
+            patient_ids = arrays['patient_ids'].tolist()
+            if patient_ids:
+                positions = matrix.__rows(patient_ids)
+                matrix.__words[positions] = arrays['words']
+                matrix.__sizes[positions] = row_popcount(matrix.__words[positions])
+        return matrix
+
+
+# Matrix of the patients of the study, events and summary exports
+def build(parser, study_df, events_df, summary_df):
+    matrix = FeatureMatrix.from_parser(parser)
+    matrix.update_studies(parser.parse_study_rows(study_df))
+    matrix.update_epilepsy(*parser.parse_epilepsy_rows(summary_df))
+    matrix.update_events(parser.parse_event_rows(events_df))
+    return matrix
+
+
+# Opens the matrix at path, or an empty one with the reference names of the parser when there is none yet
+def load_or_create(path, parser):
+    if os.path.exists(aggregates.store_path(path)):
+        return FeatureMatrix.load(path)
+    return FeatureMatrix.from_parser(parser)
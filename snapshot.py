@@ -0,0 +1,178 @@
+import json
+import os
+import pandas as pd
+import database_api as api
+import main as org
+
+
+# Columnar snapshot of the patient graph for analytical sessions. Every node and relationship set is written in
+# the shape GraphParser produces (patients with one column per property, events with their chain position, and
+# (id, name) links per reference type) as Arrow IPC files, which are reopened memory mapped without copying, or
+# as Parquet files. The batches are streamed from the database or from the input files, so neither side holds
+# the whole graph. pyarrow is only needed for the functions of this module and is imported inside them.
+
+LINK_TABLES = ['studies', 'seizures', 'lateralizations', 'medications']
+DATE_PROPERTIES = ['date_of_birth', 'date_of_death']
+
+SNAPSHOT_QUERIES = {
+    'patients': "MATCH (p:Patient) RETURN p.id AS id, properties(p) AS properties",
+    'events': (
+        "MATCH (p:Patient)-[:next]->(first:Event) "
+        "MATCH chain = (first)-[:next*0..]->(e:Event) "
+        "RETURN p.id AS id, length(chain) AS position, e.name AS name, e.date AS date"
+    ),
+}
+for table in LINK_TABLES:
+    SNAPSHOT_QUERIES[table] = f"MATCH (p:Patient) MATCH {api.COHORT_PATTERNS[table]} RETURN p.id AS id, x.name AS name"
+
+
+def patient_columns(parser):
+    return list(dict.fromkeys(parser.patient_property_dict.values()))
+
+
+def schemas(parser):
+    import pyarrow as pa
+    patient_fields = [pa.field('id', pa.int64())]
+    for column in patient_columns(parser):
+        if column in DATE_PROPERTIES:
+            patient_fields.append(pa.field(column, pa.date32()))
+        elif column != 'id':
+            patient_fields.append(pa.field(column, pa.string()))
+    link = pa.schema([pa.field('id', pa.int64()), pa.field('name', pa.string())])
+    tables = {
+        'patients': pa.schema(patient_fields),
+        'events': pa.schema([pa.field('id', pa.int64()), pa.field('position', pa.int32()),
+                             pa.field('name', pa.string()), pa.field('date', pa.date32())]),
+    }
+    tables.update({table: link for table in LINK_TABLES})
+    return tables
+
+
+class SnapshotWriter:
+
+    # file_format is "arrow" (IPC file, memory mappable) or "parquet"
+    def __init__(self, path, parser, file_format="arrow"):
+        if file_format not in ("arrow", "parquet"):
+            raise ValueError(f"Unknown snapshot format {file_format}, expected arrow or parquet")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.file_format = file_format
+        self.schemas = schemas(parser)
+        self.rows = {table: 0 for table in self.schemas}
+        self.__writers = {}
+
+    def write(self, table, frame):
+        import pyarrow as pa
+        if not len(frame):
+            return
+        schema = self.schemas[table]
+        frame = frame.reindex(columns=schema.names)
+        # Columns without a value in the batch (missing ones or ones that are NaN in every row) are float64, which
+        # has no cast to the date and string types
+        for column in schema.names:
+            if frame[column].isna().all():
+                frame[column] = pd.Series(None, index=frame.index, dtype=object)
+        batch = pa.RecordBatch.from_pandas(frame, schema=schema, preserve_index=False)
+        self.__writer(table).write_batch(batch)
+        self.rows[table] += len(frame)
+
+    def __writer(self, table):
+        writer = self.__writers.get(table)
+        if writer is None:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            filename = os.path.join(self.path, f"{table}.{self.file_format}")
+            if self.file_format == "arrow":
+                writer = pa.ipc.new_file(filename, self.schemas[table])
+            else:
+                writer = pq.ParquetWriter(filename, self.schemas[table])
+            self.__writers[table] = writer
+        return writer
+
+    def close(self):
+        for writer in self.__writers.values():
+            writer.close()
+        # Tables without rows still get an empty file, so a snapshot always has every table
+        for table in self.schemas:
+            if table not in self.__writers:
+                self.__writer(table).close()
+        with open(os.path.join(self.path, "snapshot.json"), "w") as outfile:
+            json.dump({'format': self.file_format, 'rows': self.rows}, outfile, indent=2)
+
+
+# Snapshot of the database, every table is streamed with fetch_size records per pull and written in batches of
+# batch_size rows
+def export_database(connection, parser, path, batch_size=10000, file_format="arrow"):
+    writer = SnapshotWriter(path, parser, file_format)
+    try:
+        for table, query in SNAPSHOT_QUERIES.items():
+            batch = []
+            for record in connection.stream(query, fetch_size=batch_size):
+                batch.append(record_row(table, record))
+                if len(batch) >= batch_size:
+                    writer.write(table, pd.DataFrame(batch))
+                    batch = []
+            writer.write(table, pd.DataFrame(batch))
+    finally:
+        writer.close()
+    return writer.rows
+
+
+def record_row(table, record):
+    if table == 'patients':
+        row = {key: native(value) for key, value in record['properties'].items()}
+        row['id'] = record['id']
+        return row
+    if table == 'events':
+        return {'id': record['id'], 'position': record['position'], 'name': record['name'],
+                'date': native(record['date'])}
+    return {'id': record['id'], 'name': record['name']}
+
+
+# neo4j.time values to datetime ones
+def native(value):
+    return value.to_native() if hasattr(value, 'to_native') else value
+
+
+# Snapshot straight from the input files, read in chunks of chunk_size rows with the streaming import readers
+def export_input(parser, input_path, path, chunk_size=10000, file_format="arrow"):
+    writer = SnapshotWriter(path, parser, file_format)
+    try:
+        for chunk in org.read_patient_chunks(os.path.join(input_path, "patient.csv"), parser, chunk_size):
+            long = parser.patient_frame(chunk)
+            wide = long.reset_index().pivot_table(index='index', columns='key', values='value', aggfunc='last')
+            writer.write('patients', wide)
+        for chunk in org.read_event_chunks(os.path.join(input_path, "events.csv"), parser, chunk_size):
+            events = parser.event_frame(chunk)
+            events['position'] = events.groupby(level=0).cumcount()
+            writer.write('events', events)
+        for chunk in org.read_study_chunks(os.path.join(input_path, "protocols.csv"), parser, chunk_size):
+            writer.write('studies', parser.study_frame(chunk))
+        for chunk in org.read_summary_chunks(os.path.join(input_path, "summary.csv"), parser, chunk_size):
+            for table, frame in zip(LINK_TABLES[1:], parser.epilepsy_frames(chunk)):
+                writer.write(table, frame)
+    finally:
+        writer.close()
+    return writer.rows
+
+
+# Opens a snapshot. Arrow files are memory mapped, so the numeric columns of the returned tables point into the
+# page cache instead of being read and copied. With as_pandas every table becomes a DataFrame indexed by patient
+# id, with the strings as categoricals; otherwise the pyarrow Tables are returned as they are.
+def load_snapshot(path, tables=None, as_pandas=True):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    with open(os.path.join(path, "snapshot.json")) as infile:
+        file_format = json.load(infile)['format']
+    loaded = {}
+    for table in tables or ['patients', 'events'] + LINK_TABLES:
+        filename = os.path.join(path, f"{table}.{file_format}")
+        if file_format == "arrow":
+            with pa.memory_map(filename) as source:
+                loaded[table] = pa.ipc.open_file(source).read_all()
+        else:
+            loaded[table] = pq.read_table(filename, memory_map=True)
+    if not as_pandas:
+        return loaded
+    return {table: data.to_pandas(split_blocks=True, strings_to_categorical=True, date_as_object=False).set_index('id')
+            for table, data in loaded.items()}
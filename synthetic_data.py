@@ -0,0 +1,99 @@
+import csv
+import os
+import numpy as np
+import pandas as pd
+import graphParser as gp
+
+
+# Writes REDCap shaped patient.csv, protocols.csv, events.csv and summary.csv files with random content for
+# the benchmarks. The headers are copied from the files in the input directory, so the generated exports have
+# the same columns as the real ones.
+
+def read_header(filename):
+    with open(filename, encoding='utf-8-sig') as infile:
+        return next(csv.reader(infile))
+
+
+def random_dates(rnd, quantity, start, end, fill_rate):
+    days = rnd.integers(0, (pd.Timestamp(end) - pd.Timestamp(start)).days, quantity)
+    dates = (pd.Timestamp(start) + pd.to_timedelta(days, unit='D')).strftime('%m/%d/%Y')
+    return np.where(rnd.random(quantity) < fill_rate, dates, '')
+
+
+def create_patient_df(header, ids, rnd):
+    n = len(ids)
+    df = pd.DataFrame('', index=range(n), columns=header)
+    df[header[0]] = ids
+    df['dob'] = random_dates(rnd, n, '1940-01-01', '2005-01-01', 1.0)
+    df['dod'] = random_dates(rnd, n, '2010-01-01', '2023-01-01', 0.05)
+    df['dx'] = 'Epilepsy Patient'
+    df['inst'] = 'Penn'
+    df['sex'] = rnd.choice(['Male', 'Female'], n)
+    df['gender'] = rnd.choice(['Man', 'Woman', ''], n)
+    df['race'] = rnd.choice(['Asian', 'White', 'Black or African American', ''], n)
+    df['ethnicity'] = rnd.choice(['Not Hispanic or Latinx', 'Hispanic or Latinx', ''], n)
+    df['lang_dom'] = rnd.choice(['Left', 'Right', ''], n)
+    df['social_edu'] = rnd.choice(['High school graduate', "Bachelor's degree (BA, AB, BS, BBS)", ''], n)
+    return df
+
+
+def create_protocol_df(header, ids, rnd):
+    n = len(ids)
+    df = pd.DataFrame('', index=range(n), columns=header)
+    df[header[0]] = ids
+    for column in header:
+        if column.startswith('protocols___') and not column.endswith('_date'):
+            checked = rnd.random(n) < 0.4
+            df[column] = np.where(checked, 'Checked', '')
+            if column + '_date' in df.columns:
+                df[column + '_date'] = np.where(checked, random_dates(rnd, n, '2010-01-01', '2023-01-01', 0.8), '')
+    return df
+
+
+def create_event_df(header, ids, rnd):
+    n = len(ids)
+    df = pd.DataFrame('', index=range(n), columns=header)
+    df[header[0]] = ids
+    for column in header:
+        if column.endswith('_date'):
+            df[column] = random_dates(rnd, n, '2010-01-01', '2023-01-01', 0.7)
+    df['T3_subject_id'] = np.where(df['T3_scan_date'] != '', '3T_P' + df[header[0]].astype(str), '')
+    df['T7_subject_id'] = np.where(df['T7_scan_date'] != '', '7T_P' + df[header[0]].astype(str), '')
+    df['Surgical_intervention'] = np.where(df['Surgical_intervention_date'] != '',
+                                           rnd.choice(['Resection', 'Ablation', 'RNS'], n), '')
+    return df
+
+
+def create_summary_df(header, ids, rnd):
+    n = len(ids)
+    # Duplicate and empty column names in the real export would be merged by a DataFrame, keep them positional
+    df = pd.DataFrame('', index=range(n), columns=range(len(header)))
+    df[0] = ids
+    for position, column in enumerate(header):
+        if column.startswith('sz_types_pecclinical___'):
+            df[position] = rnd.choice(['1', '0', ''], n, p=[0.3, 0.5, 0.2])
+    medications = np.array(gp.GraphParser.medication_list + ['Keppra', 'lamotrigine', 'Vitamin D'], dtype=object)
+    counts = rnd.integers(0, 4, n)
+    picks = rnd.integers(0, len(medications), counts.sum())
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    df[header.index('medication')] = [', '.join(medications[picks[offsets[i]:offsets[i + 1]]]) for i in range(n)]
+    lateralizations = gp.GraphParser.lateralization + ['']
+    df[header.index('emu_seizure_lateralization_pecclinical')] = rnd.choice(lateralizations, n)
+    df.columns = header
+    return df
+
+
+def write_input_files(path, patients, seed=0, template_path="input", first_id=1):
+    os.makedirs(path, exist_ok=True)
+    rnd = np.random.default_rng(seed)
+    ids = np.arange(first_id, first_id + patients)
+    frames = {
+        "patient.csv": create_patient_df,
+        "protocols.csv": create_protocol_df,
+        "events.csv": create_event_df,
+        "summary.csv": create_summary_df,
+    }
+    for filename, create_df in frames.items():
+        header = read_header(os.path.join(template_path, filename))
+        create_df(header, ids, rnd).to_csv(os.path.join(path, filename), index=False)
+    return path
@@ -1,10 +1,14 @@
+import argparse
+import csv
+import json
+import os
+import sys
 import neo4jConnection as con
 import main as org
+import schema
 import random
 import timeit
 import numpy as np
-import matplotlib.pyplot as plt
-import database_api
 
 
 chain_query = "MATCH (p:Patient)-[:next*]->(e:Event) WHERE p.id = 1235 AND e.name=\"Target\" RETURN e"
@@ -12,24 +16,25 @@ star_query = "MATCH (p:Patient)-[:performed]->(e:Event) WHERE p.id = 1234 AND e.
 skiplist_query = "MATCH (p:Patient)-[:nextTarget*]->(e:Event) WHERE p.id = 1235 RETURN e"
 
 
-def initialize(db, event_num, event_perc):
+def initialize(db, event_num, event_perc, rnd=random):
     create_patients(db)
-    events = create_events(event_num, event_perc)
+    events = create_events(event_num, event_perc, rnd)
     stars = create_star_queries(1234, events)
     chains = create_chain_skiplist_queries(1235, events)
     db.run_query_list(stars)
     db.run_query_list(chains)
 
 
-def create_events(quantity, target_percentage):
+# Pass a seeded random.Random as rnd to get the same event lists on every run
+def create_events(quantity, target_percentage, rnd=random):
     target_number = int(quantity * target_percentage)
     random_number = quantity - target_number
     events = ["3T", "7T", "Implant", "Preimplant MRI", "Surgical intervention", "Preoperative neuropsych"]
     random_events = []
     for i in range(random_number):
-        random_events.append(random.choice(events))
+        random_events.append(rnd.choice(events))
     event_list = ["Target"] * target_number + random_events
-    random.shuffle(event_list)
+    rnd.shuffle(event_list)
     return event_list
 
 
@@ -88,36 +93,41 @@ def create_patients(db):
     db.run_query("MERGE (p:Patient {id: 1235})")
 
 
-def measure_time(db):
-    warm_cache(db)
-    start = timeit.default_timer()
-    db.run_query(star_query)
-    end = timeit.default_timer()
-    star_time = end - start
+# Every sample is the end-to-end latency of one query, including fetching and consuming all of its records
+def time_query(db, query):
     start = timeit.default_timer()
-    db.run_query(chain_query)
+    db.fetch_all(query)
     end = timeit.default_timer()
-    chain_time = end - start
-    start = timeit.default_timer()
-    db.run_query(skiplist_query)
-    end = timeit.default_timer()
-    skiplist_time = end - start
-    return star_time, chain_time, skiplist_time
+    return end - start
+
 
+def sample_query(db, query, warmup, repetitions):
+    for i in range(warmup):
+        time_query(db, query)
+    return [time_query(db, query) for i in range(repetitions)]
 
-def measure_index_time(db):
-    delete_indexes(db)
+
+def measure_time(db, warmup=1, repetitions=5):
     warm_cache(db)
-    start = timeit.default_timer()
-    db.run_query(skiplist_query)
-    end = timeit.default_timer()
-    noindex_time = end - start
-    org.create_indexes(db)
-    start = timeit.default_timer()
-    db.run_query(skiplist_query)
-    end = timeit.default_timer()
-    index_time = end - start
-    return noindex_time, index_time
+    star_times = sample_query(db, star_query, warmup, repetitions)
+    chain_times = sample_query(db, chain_query, warmup, repetitions)
+    skiplist_times = sample_query(db, skiplist_query, warmup, repetitions)
+    return star_times, chain_times, skiplist_times
+
+
+# The Patient.id lookup of the benchmarked query is served by the index of the patients uniqueness constraint,
+# so the constraint is dropped together with the plain indexes
+def measure_index_time(db, warmup=1, repetitions=5):
+    manager = schema.SchemaManager(db)
+    manager.drop_indexes()
+    manager.drop_constraints(['patients'])
+    warm_cache(db)
+    noindex_times = sample_query(db, skiplist_query, warmup, repetitions)
+    manager.create_constraints(['patients'])
+    manager.create_indexes()
+    manager.wait_online()
+    index_times = sample_query(db, skiplist_query, warmup, repetitions)
+    return noindex_times, index_times
 
 
 def clear_db(db):
@@ -128,142 +138,157 @@ def warm_cache(db):
     db.run_query("MATCH (n) OPTIONAL MATCH (n) -[r]->() RETURN count(n.prop) + count(r.prop)")
 
 
-def delete_indexes(connection):
-    connection.run_query('DROP INDEX patient_name_index IF EXISTS ')
-    connection.run_query('DROP INDEX event_name_index IF EXISTS ')
-    connection.run_query('DROP INDEX study_name_index IF EXISTS ')
-    connection.run_query('DROP INDEX seizure_name_index IF EXISTS ')
-    connection.run_query('DROP INDEX later_name_index IF EXISTS ')
-    connection.run_query('DROP INDEX medication_name_index IF EXISTS ')
-
-
-def event_variable_test(db, event_num_array, event_perc):
-    star_times_matrix = []
-    chain_times_matrix = []
-    skiplist_times_matrix = []
-    for iteration in range(5):
-        print(f"Run: {iteration+1} out of 5.")
-        star_times = []
-        chain_times = []
-        skiplist_times = []
-        for i in range(len(event_num_array)):
-            print(f"Currently on search of {event_num_array[i]} events")
-            initialize(db, event_num_array[i], event_perc)
-            star_time, chain_time, skiplist_time = measure_time(db)
-            star_times.append(star_time)
-            chain_times.append(chain_time)
-            skiplist_times.append(skiplist_time)
-            clear_db(db)
-        star_times_matrix.append(star_times)
-        chain_times_matrix.append(chain_times)
-        skiplist_times_matrix.append(skiplist_times)
-    return np.median(star_times_matrix, axis=0), np.median(chain_times_matrix, axis=0), np.median(skiplist_times_matrix, axis=0)
-
-
-def percentage_variable_test(db, event_num, event_perc_array):
-    star_times_matrix = []
-    chain_times_matrix = []
-    skiplist_times_matrix = []
-    for iteration in range(5):
-        print(f"Run: {iteration + 1} out of 5.")
-        star_times = []
-        chain_times = []
-        skiplist_times = []
-        for i in range(len(event_perc_array)):
-            initialize(db, event_num, event_perc_array[i])
-            star_time, chain_time, skiplist_time = measure_time(db)
-            star_times.append(star_time)
-            chain_times.append(chain_time)
-            skiplist_times.append(skiplist_time)
-            clear_db(db)
-        star_times_matrix.append(star_times)
-        chain_times_matrix.append(chain_times)
-        skiplist_times_matrix.append(skiplist_times)
-    return np.median(star_times_matrix, axis=0), np.median(chain_times_matrix, axis=0), np.median(skiplist_times_matrix, axis=0)
-
-
-def index_variable_test(db, event_num_array, event_perc):
-    noindex_matrix = []
-    index_matrix = []
-    for iteration in range(5):
-        print(f"Run: {iteration+1} out of 5.")
-        noindex_times = []
-        index_times = []
-        for i in range(len(event_num_array)):
-            print(f"Currently on search of {event_num_array[i]} events")
-            initialize(db, event_num_array[i], event_perc)
-            warm_cache(db)
-            noindex_time, index_time = measure_index_time(db)
-            noindex_times.append(noindex_time)
-            index_times.append(index_time)
-            clear_db(db)
-        noindex_matrix.append(noindex_times)
-        index_matrix.append(index_times)
-    return np.median(noindex_matrix, axis=0), np.median(index_matrix, axis=0)
-
-
-def print_graph(x, y_star, y_chain, y_skip, xlabel, title):
-    plt.plot(x, y_star, label="Star model")
-    plt.plot(x, y_chain, label="Chain model")
-    plt.plot(x, y_skip, label="Skip list model")
-    plt.xlabel(xlabel)
-    plt.ylabel('Execution time [s]')
-    plt.title(title)
+# The *_variable_test functions return, for every model, one list of samples per tested value
+
+def event_variable_test(db, event_num_array, event_perc, warmup=1, repetitions=5, seed=0):
+    rnd = random.Random(seed)
+    results = {"Star model": [], "Chain model": [], "Skip list model": []}
+    for event_num in event_num_array:
+        print(f"Currently on search of {event_num} events")
+        initialize(db, event_num, event_perc, rnd)
+        for model, samples in zip(results, measure_time(db, warmup, repetitions)):
+            results[model].append(samples)
+        clear_db(db)
+    return results
+
+
+def percentage_variable_test(db, event_num, event_perc_array, warmup=1, repetitions=5, seed=0):
+    rnd = random.Random(seed)
+    results = {"Star model": [], "Chain model": [], "Skip list model": []}
+    for event_perc in event_perc_array:
+        print(f"Currently on search with {event_perc} target events")
+        initialize(db, event_num, event_perc, rnd)
+        for model, samples in zip(results, measure_time(db, warmup, repetitions)):
+            results[model].append(samples)
+        clear_db(db)
+    return results
+
+
+def index_variable_test(db, event_num_array, event_perc, warmup=1, repetitions=5, seed=0):
+    rnd = random.Random(seed)
+    results = {"Skiplist without indexes": [], "Skiplist with indexes": []}
+    for event_num in event_num_array:
+        print(f"Currently on search of {event_num} events")
+        initialize(db, event_num, event_perc, rnd)
+        for model, samples in zip(results, measure_index_time(db, warmup, repetitions)):
+            results[model].append(samples)
+        clear_db(db)
+    return results
+
+
+SUITES = {
+    "index": (lambda db, x, *args: index_variable_test(db, x, 0.2, *args), list(range(500, 10001, 500)),
+              "Number of events", "Comparison of query execution speed with and without indexes on event name"),
+    "events-small": (lambda db, x, *args: event_variable_test(db, x, 0.2, *args), list(range(5, 201, 5)),
+                     "Number of events", "Variable number of events, constant target percentage"),
+    "events-large": (lambda db, x, *args: event_variable_test(db, x, 0.2, *args), list(range(500, 10001, 500)),
+                     "Number of events", "Variable number of events, constant target percentage"),
+    "percentage": (lambda db, x, *args: percentage_variable_test(db, 1000, x, *args),
+                   [0.001, 0.01, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9],
+                   "Ratio of target events", "Constant number of events, variable target percentage"),
+}
+
+
+def summarize(samples):
+    return {
+        "p50": float(np.percentile(samples, 50)),
+        "p95": float(np.percentile(samples, 95)),
+        "p99": float(np.percentile(samples, 99)),
+        "mean": float(np.mean(samples)),
+        "min": float(np.min(samples)),
+        "max": float(np.max(samples)),
+    }
+
+
+def run_suite(db, name, warmup, repetitions, seed):
+    test, values, xlabel, title = SUITES[name]
+    results = test(db, values, warmup, repetitions, seed)
+    return {
+        "suite": name,
+        "title": title,
+        "xlabel": xlabel,
+        "x": values,
+        "warmup": warmup,
+        "repetitions": repetitions,
+        "seed": seed,
+        "models": {model: [summarize(samples) for samples in per_value] for model, per_value in results.items()},
+    }
+
+
+def write_report(report, path):
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, f"{report['suite']}.json"), 'w') as outfile:
+        json.dump(report, outfile, indent=2)
+    with open(os.path.join(path, f"{report['suite']}.csv"), 'w', newline='') as outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(["suite", "model", "x", "p50", "p95", "p99", "mean", "min", "max"])
+        for model, stats in report["models"].items():
+            for x, stat in zip(report["x"], stats):
+                writer.writerow([report["suite"], model, x, stat["p50"], stat["p95"], stat["p99"], stat["mean"],
+                                 stat["min"], stat["max"]])
+
+
+# Returns one message per (model, value) whose statistic got slower than the baseline by more than the tolerance
+def compare_with_baseline(report, baseline, metric="p50", tolerance=0.2):
+    regressions = []
+    for model, stats in report["models"].items():
+        baseline_stats = dict(zip(baseline["x"], baseline["models"].get(model, [])))
+        for x, stat in zip(report["x"], stats):
+            if x in baseline_stats and stat[metric] > baseline_stats[x][metric] * (1 + tolerance):
+                regressions.append(f"{report['suite']} / {model} / {x}: {metric} {stat[metric] * 1000:.3f} ms "
+                                   f"vs baseline {baseline_stats[x][metric] * 1000:.3f} ms")
+    return regressions
+
+
+def print_graph(report, path, metric="p50"):
+    # Rendered to a file without a display
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    figure = plt.figure()
+    for model, stats in report["models"].items():
+        plt.plot(report["x"], [stat[metric] for stat in stats], label=model)
+    plt.xlabel(report["xlabel"])
+    plt.ylabel(f'Execution time {metric} [s]')
+    plt.title(report["title"])
     plt.legend()
-    plt.show()
-
-
-def make_example_patients(db):
-    event_num = 15
-    event_perc = 0.3
-    db.run_query("MERGE (p:Patient {id: 1234, name:\"star\"})")
-    db.run_query("MERGE (p:Patient {id: 1235, name: \"chain\"})")
-    db.run_query("MERGE (p:Patient {id: 1236, name:\"skiplist\"})")
-    events = create_events(event_num, event_perc)
-    stars = create_star_queries(1234, events)
-    chains = create_chain_queries(1235, events)
-    skiplist = create_chain_skiplist_queries(1236, events)
-    db.run_query_list(stars)
-    db.run_query_list(chains)
-    db.run_query_list(skiplist)
+    figure.savefig(os.path.join(path, f"{report['suite']}.png"))
+    plt.close(figure)
 
 
 def main():
-    uri, username, password = org.read_config('config.ini')
-    db = con.Neo4jConnection(uri, username, password)
-    org.create_constrains(db)
-    org.create_indexes(db)
-    make_example_patients(db)
-
-    percentages = [0.001, 0.01, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
-    events_small = list(range(5, 201, 5))
-    events_large = list(range(500, 10001, 500))
-    initialize(db, 20, 0.2)
-
-    noindex, index = index_variable_test(db, events_large, 0.2)
-    plt.plot(events_large, noindex, label="Skiplist without indexes")
-    plt.plot(events_large, index, label="Skiplist with indexes")
-    plt.xlabel("Number of events")
-    plt.ylabel('Execution time [s]')
-    plt.title("Comparison of query execution speed with and without indexes on event name")
-    plt.legend()
-    plt.show()
-
-    star, chain, skiplist = event_variable_test(db, events_small, 0.2)
-    # print("Star: ", star)
-    # print("Chain: ", chain)
-    print_graph(events_small, star, chain, skiplist, "Number of events", "Variable number of events, constant target percentage")
-
-    star, chain, skiplist = event_variable_test(db, events_large, 0.2)
-    # print("Star: ", star)
-    # print("Chain: ", chain)
-    print_graph(events_large, star, chain, skiplist, "Number of events", "Variable number of events, constant target percentage")
-
-    star, chain, skiplist = percentage_variable_test(db, 1000, percentages)
-    # print("Star: ", star)
-    # print("Chain: ", chain)
-    print_graph(percentages, star, chain, skiplist, "Ratio of target events", "Constant number of events, variable target percentage")
+    argument_parser = argparse.ArgumentParser(description="Timeline model benchmarks (star vs chain vs skip list)")
+    argument_parser.add_argument("--suites", nargs="+", choices=list(SUITES), default=list(SUITES))
+    argument_parser.add_argument("--warmup", type=int, default=1)
+    argument_parser.add_argument("--repetitions", type=int, default=10)
+    argument_parser.add_argument("--seed", type=int, default=0)
+    argument_parser.add_argument("--config", default="config.ini",
+                                 help="config file with the database to run against, e.g. a local Neo4j container")
+    argument_parser.add_argument("--output", default="benchmark_results")
+    argument_parser.add_argument("--baseline", help="directory with the <suite>.json files of a previous run")
+    argument_parser.add_argument("--metric", choices=["p50", "p95", "p99", "mean"], default="p50")
+    argument_parser.add_argument("--tolerance", type=float, default=0.2,
+                                 help="allowed relative slowdown against the baseline")
+    args = argument_parser.parse_args()
+
+    uri, username, password = org.read_config(args.config)
+    db = con.Neo4jConnection(uri, username, password, **org.read_driver_config(args.config))
+    schema.SchemaManager(db).apply()
+    clear_db(db)
+
+    regressions = []
+    for name in args.suites:
+        report = run_suite(db, name, args.warmup, args.repetitions, args.seed)
+        write_report(report, args.output)
+        print_graph(report, args.output, args.metric)
+        if args.baseline:
+            with open(os.path.join(args.baseline, f"{name}.json")) as infile:
+                regressions += compare_with_baseline(report, json.load(infile), args.metric, args.tolerance)
+    db.close()
+    for regression in regressions:
+        print("Regression:", regression)
+    return 1 if regressions else 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,22 @@
+import asyncio
+import async_database_api as async_api
+import database_api as api
+
+
+# Answers the single lookups with one record per matching patient, the node being its id
+class FakeConnection:
+
+    def __init__(self, patients):
+        self.patients = patients
+
+    async def run_query(self, query, parameters=None):
+        if query == api.FIND_PATIENT_QUERY:
+            return [{'n': parameters['id']}] if parameters['id'] in self.patients else []
+        return [{'p': patient} for patient, names in self.patients.items() if parameters['name'] in names]
+
+
+def test_bulk_lookups_return_patient_nodes_per_key():
+    db = async_api.AsyncDatabaseAPI(None, None, None, connection=FakeConnection({1: ['A'], 2: ['A', 'B']}))
+    assert asyncio.run(db.find_patients([1, 3, 1])) == {1: [1], 3: []}
+    assert asyncio.run(db.find_patients_by_studies(['A', 'C'])) == {'A': [1, 2], 'C': []}
+    assert asyncio.run(db.find_patients_by_seizures(['B'])) == {'B': [2]}
@@ -0,0 +1,28 @@
+import os
+import bulk_export
+import graphParser as gp
+import main as org
+import synthetic_data
+
+
+def test_export_matches_the_online_import(tmp_path):
+    input_path = str(tmp_path / "input")
+    synthetic_data.write_input_files(input_path, 100, 0)
+    parser = gp.GraphParser()
+    bulk_export.export(parser, input_path, str(tmp_path / "export"), chunk_size=30)
+    expected = bulk_export.online_graph(parser, *org.read_all_files(input_path))
+    assert expected[0] and expected[1] and expected[2]
+    assert bulk_export.read_export(str(tmp_path / "export")) == expected
+
+
+def test_import_command_only_lists_the_written_files(tmp_path):
+    input_path = str(tmp_path / "input")
+    export_path = str(tmp_path / "export")
+    synthetic_data.write_input_files(input_path, 20, 0)
+    os.makedirs(export_path)
+    leftover = os.path.join(export_path, "skip_old_patient.csv")
+    open(leftover, "w").close()
+    command = bulk_export.export(gp.GraphParser(), input_path, export_path)
+    assert f"--relationships={leftover}" not in command
+    assert f"--relationships={os.path.join(export_path, 'consents.csv')}" in command
+    assert f"--nodes=Patient={os.path.join(export_path, 'patients.csv')}" in command
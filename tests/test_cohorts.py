@@ -0,0 +1,41 @@
+import pytest
+import database_api as api
+import graphParser as gp
+import main as org
+import memory_graph
+import synthetic_data
+
+
+class RecordingConnection:
+
+    def __init__(self):
+        self.queries = []
+
+    def run_query(self, query, parameters=None):
+        self.queries.append((query, parameters))
+        return []
+
+
+@pytest.fixture
+def memory_api(tmp_path):
+    synthetic_data.write_input_files(str(tmp_path), 50, 0)
+    graph = memory_graph.MemoryGraph(gp.GraphParser(), *org.read_all_files(str(tmp_path)))
+    return memory_graph.MemoryDatabaseAPI(graph)
+
+
+def cohort_query(**filters):
+    connection = RecordingConnection()
+    api.DatabaseAPI(None, None, None, connection=connection).find_cohort(**filters)
+    return connection.queries[-1][0]
+
+
+def test_empty_all_of_filter_is_not_the_anchor():
+    assert cohort_query(all_of={'studies': []}).startswith("MATCH (p:Patient) ")
+    query = cohort_query(all_of={'studies': [], 'seizures': ['Focal']})
+    assert query.startswith(f"MATCH {api.COHORT_PATTERNS['seizures']} WHERE x.name IN $all_seizures ")
+
+
+def test_empty_all_of_filter_matches_every_patient_in_memory(memory_api):
+    everyone = memory_api.find_cohort()
+    assert len(everyone) == 50
+    assert memory_api.find_cohort(all_of={'studies': []}) == everyone
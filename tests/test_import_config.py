@@ -0,0 +1,27 @@
+import pytest
+import main as org
+
+
+def write_config(tmp_path, **options):
+    path = tmp_path / "config.ini"
+    path.write_text("[IMPORT]\n" + "".join(f"{key} = {value}\n" for key, value in options.items()))
+    return str(path)
+
+
+@pytest.mark.parametrize("options", [
+    {'BATCH_SIZE': 1000},
+    {'CHUNK_SIZE': 1000},
+    {'CHUNK_SIZE': 1000, 'WRITERS': 2},
+    {'STATE_FILE': 'state.sqlite'},
+])
+def test_reference_cache_with_a_supported_mode(tmp_path, options):
+    org.read_import_config(write_config(tmp_path, REFERENCE_CACHE_SIZE=100, **options))
+
+
+@pytest.mark.parametrize("options", [
+    {'BATCH_SIZE': 0},
+    {'BATCH_SIZE': 1000, 'WRITERS': 2},
+])
+def test_reference_cache_with_an_unsupported_mode(tmp_path, options):
+    with pytest.raises(ValueError):
+        org.read_import_config(write_config(tmp_path, REFERENCE_CACHE_SIZE=100, **options))
@@ -0,0 +1,124 @@
+import pytest
+import graphParser as gp
+import incremental
+import main as org
+import synthetic_data
+
+
+# Minimal stand-in for the database: keeps the patients and, per patient, the events and the linked reference
+# names the statements of incremental.py write, with the MATCH semantics of those statements (rows of patients
+# that do not exist are ignored)
+class FakeGraph:
+
+    def __init__(self, parser):
+        self.event_query = parser.event_batch_query()
+        self.patients = set()
+        self.events = {}
+        self.links = {}
+        self.applied = []
+
+    def run_query(self, query, parameters=None):
+        return []
+
+    def run_query_list(self, queries, transaction_size=None):
+        pass
+
+    def run_batched(self, query, rows, batch_size):
+        for row in rows:
+            self.apply(query, row)
+        return len(rows)
+
+    def apply(self, query, row):
+        patient = row['id']
+        self.applied.append((query, patient))
+        if query == incremental.REPLACE_PATIENT_QUERY:
+            self.patients.add(patient)
+        elif query == incremental.DELETE_PATIENT_QUERY:
+            self.patients.discard(patient)
+            self.events.pop(patient, None)
+            self.links.pop(patient, None)
+        elif query == incremental.DELETE_EVENTS_QUERY:
+            self.events.pop(patient, None)
+        elif query == incremental.DELETE_STUDY_LINKS_QUERY:
+            self.links[patient] = {link for link in self.links.get(patient, set()) if link[0] != 'consents'}
+        elif query == incremental.DELETE_DIAGNOSIS_LINKS_QUERY:
+            self.links[patient] = {link for link in self.links.get(patient, set()) if link[0] == 'consents'}
+        elif patient not in self.patients:
+            return
+        elif query == self.event_query:
+            self.events.setdefault(patient, []).extend(event['name'] for event in row['events'])
+        else:
+            relationship = {gp.STUDY_BATCH_QUERY: 'consents', gp.SEIZURE_BATCH_QUERY: 'experiences',
+                            gp.LATERALIZATION_BATCH_QUERY: 'localized', gp.MEDICATION_BATCH_QUERY: 'takes'}[query]
+            self.links.setdefault(patient, set()).add((relationship, row['name']))
+
+    def snapshot(self, patient):
+        return sorted(self.events.get(patient, [])), sorted(self.links.get(patient, set()))
+
+
+@pytest.fixture
+def export(tmp_path):
+    synthetic_data.write_input_files(str(tmp_path), 20, 0)
+    return org.read_all_files(str(tmp_path))
+
+
+def run(db, parser, state, patient_df, study_df, events_df, summary_df):
+    return incremental.run_incremental(db, parser, str(state), patient_df, study_df, events_df, summary_df, 100)
+
+
+def patient_with_history(db):
+    return next(patient for patient in sorted(db.patients) if db.events.get(patient) and db.links.get(patient))
+
+
+def test_deleted_patient_added_again_gets_its_events_and_links_back(export, tmp_path):
+    patient_df, study_df, events_df, summary_df = export
+    parser = gp.GraphParser()
+    db = FakeGraph(parser)
+    state = tmp_path / "state.sqlite"
+    run(db, parser, state, *export)
+    patient = patient_with_history(db)
+    expected = db.snapshot(patient)
+
+    run(db, parser, state, patient_df[patient_df['record_id'] != patient], study_df, events_df, summary_df)
+    assert patient not in db.patients
+    assert db.snapshot(patient) == ([], [])
+
+    run(db, parser, state, *export)
+    assert patient in db.patients
+    assert db.snapshot(patient) == expected
+
+
+def test_patient_added_after_its_other_rows_gets_its_events_and_links(export, tmp_path):
+    patient_df, study_df, events_df, summary_df = export
+    parser = gp.GraphParser()
+    complete = FakeGraph(parser)
+    run(complete, parser, tmp_path / "complete.sqlite", *export)
+    patient = patient_with_history(complete)
+
+    db = FakeGraph(parser)
+    state = tmp_path / "state.sqlite"
+    run(db, parser, state, patient_df[patient_df['record_id'] != patient], study_df, events_df, summary_df)
+    assert db.snapshot(patient) == ([], [])
+
+    run(db, parser, state, *export)
+    assert db.snapshot(patient) == complete.snapshot(patient)
+
+
+def test_updated_patient_keeps_its_events_and_links(export, tmp_path):
+    patient_df, study_df, events_df, summary_df = export
+    parser = gp.GraphParser()
+    db = FakeGraph(parser)
+    state = tmp_path / "state.sqlite"
+    run(db, parser, state, *export)
+    patient = patient_with_history(db)
+    expected = db.snapshot(patient)
+
+    edited = patient_df.copy()
+    edited.loc[edited['record_id'] == patient, 'inst'] = "Edited"
+    db.applied = []
+    changes = run(db, parser, state, edited, study_df, events_df, summary_df)
+    assert changes["patient.csv"] == (0, 1, 0)
+    for file in ["protocols.csv", "events.csv", "summary.csv"]:
+        assert changes[file] == (0, 0, 0)
+    assert db.applied == [(incremental.REPLACE_PATIENT_QUERY, patient)]
+    assert db.snapshot(patient) == expected
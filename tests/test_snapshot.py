@@ -0,0 +1,19 @@
+import pytest
+import graphParser as gp
+import main as org
+import snapshot
+
+pytest.importorskip("pyarrow")
+
+
+@pytest.mark.parametrize("file_format", ["arrow", "parquet"])
+def test_input_export_reloads(file_format, tmp_path):
+    parser = gp.GraphParser()
+    rows = snapshot.export_input(parser, "input", str(tmp_path), file_format=file_format)
+    tables = snapshot.load_snapshot(str(tmp_path))
+    assert {table: len(frame) for table, frame in tables.items()} == rows
+    patient_df, study_df, events_df, summary_df = org.read_all_files("input")
+    assert tables['patients'].index.tolist() == [row['id'] for row in parser.parse_patient_rows(patient_df)]
+    assert rows['events'] == sum(len(row['events']) for row in parser.parse_event_rows(events_df))
+    assert rows['studies'] == len(parser.parse_study_rows(study_df))
+    assert set(tables['patients'].columns) == set(snapshot.patient_columns(parser)) - {'id'}
@@ -0,0 +1,45 @@
+import pytest
+import aggregates
+import benchmark_similarity
+import graphParser as gp
+import main as org
+import similarity
+import synthetic_data
+
+
+@pytest.fixture
+def parsed(tmp_path):
+    synthetic_data.write_input_files(str(tmp_path / "input"), 100, 0)
+    parser = gp.GraphParser()
+    patient_df, study_df, events_df, summary_df = org.read_all_files(str(tmp_path / "input"))
+    return parser, study_df, events_df, summary_df
+
+
+def test_aggregates_reload_from_a_path_without_extension(parsed, tmp_path):
+    parser, study_df, events_df, summary_df = parsed
+    store = aggregates.AggregateStore.from_parser(parser)
+    store.update_studies(parser.parse_study_rows(study_df))
+    store.update_epilepsy(*parser.parse_epilepsy_rows(summary_df))
+    path = str(tmp_path / "aggregates")
+    store.save(path)
+    loaded = aggregates.load_or_create(path, parser)
+    assert loaded.patient_count() == store.patient_count() > 0
+    for kind in aggregates.KINDS:
+        assert loaded.counts(kind).equals(store.counts(kind))
+
+
+def test_similarity_reloads_from_a_path_without_extension(parsed, tmp_path):
+    parser, study_df, events_df, summary_df = parsed
+    matrix = similarity.build(parser, study_df, events_df, summary_df)
+    path = str(tmp_path / "similarity")
+    matrix.save(path)
+    loaded = similarity.load_or_create(path, parser)
+    assert loaded.patient_count() == matrix.patient_count() > 0
+    assert loaded.features() == matrix.features()
+
+
+def test_similarity_search_matches_brute_force(parsed):
+    parser, study_df, events_df, summary_df = parsed
+    matrix = similarity.build(parser, study_df, events_df, summary_df)
+    patient_ids = summary_df['record_id'].dropna().astype('int64').unique().tolist()
+    benchmark_similarity.check(matrix, patient_ids, patient_ids[:20], 10)